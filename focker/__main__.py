@@ -9,6 +9,7 @@
 from .command import create_parser
 from .plugin import PLUGIN_MANAGER
 from .misc import focker_lock
+from .core import DatasetIndex
 import sys
 
 
@@ -21,9 +22,10 @@ def main(args=None):
     if not hasattr(args, 'func'): # pragma: no cover
         parser.print_usage()
         sys.exit('You must choose an action')
-    PLUGIN_MANAGER.execute_pre_hooks(args.hook_name, args)
-    args.func(args)
-    PLUGIN_MANAGER.execute_post_hooks(args.hook_name, args)
+    with DatasetIndex():
+        PLUGIN_MANAGER.execute_pre_hooks(args.hook_name, args)
+        args.func(args)
+        PLUGIN_MANAGER.execute_post_hooks(args.hook_name, args)
 
 
 if __name__ == '__main__':
@@ -10,8 +10,16 @@ from tabulate import tabulate
 import argparse
 from ..core import JlsCache, \
     ZfsPropertyCache, \
-    JailConfCache
+    JailConfCache, \
+    DEFAULT_DESTROY_WORKERS, \
+    zfs_nicenum, \
+    open_trace_sink, \
+    parallel_start_jails, \
+    parallel_stop_jails
+from ..core.image.trace import TRACE_FORMATS
 from functools import partial
+from contextlib import nullcontext
+import time
 
 
 DISPLAY_FIELDS = ['name', 'tags', 'sha256', 'mountpoint', 'is_protected',
@@ -59,7 +67,16 @@ def standard_fobject_commands(fobject_class,
         ),
         prune=dict(
             aliases=['pru', 'p'],
-            func=kwargs.get('prune', lambda args: cmd_fobject_prune(args, fobject_class))
+            func=kwargs.get('prune', lambda args: cmd_fobject_prune(args, fobject_class)),
+            jobs=dict(
+                aliases=['j'],
+                type=int,
+                default=DEFAULT_DESTROY_WORKERS
+            ),
+            quiet=dict(
+                aliases=['q'],
+                action='store_true'
+            )
         ),
         tag=dict(
             aliases=['t'],
@@ -210,6 +227,67 @@ def standard_fobject_commands(fobject_class,
     return res
 
 
+def build_trace_args():
+    return dict(
+        trace=dict(
+            type=str,
+            default=None
+        ),
+        trace_format=dict(
+            type=str,
+            default='json',
+            choices=list(TRACE_FORMATS.keys())
+        )
+    )
+
+
+def open_build_trace(args):
+    if args.trace is None:
+        return nullcontext()
+    return open_trace_sink(args.trace, args.trace_format)
+
+
+def jail_schedule_args():
+    return dict(
+        jobs=dict(
+            aliases=['j'],
+            type=int,
+            default=None
+        )
+    )
+
+
+def schedule_jails(names, stop=False, jobs=None):
+    if not names:
+        return {}
+    if stop:
+        fn, verb, done, noop = parallel_stop_jails, 'stop', 'Stopped', 'Not running'
+    else:
+        fn, verb, done, noop = parallel_start_jails, 'start', 'Started', 'Already running'
+
+    def report(res):
+        if res.status == 'ok':
+            print(f'{done}: {res.name} ({res.duration:.2f}s)')
+        elif res.status == 'noop':
+            print(f'{noop}: {res.name}')
+        elif res.status == 'failed':
+            print(f'{verb.capitalize()} failed: {res.name} - {res.error}')
+        else:
+            print(f'Skipped: {res.name} - {res.error}')
+
+    t_0 = time.monotonic()
+    results = fn(names, jobs=jobs, callback=report)
+    counts = { k: sum(1 for r in results.values() if r.status == k) \
+        for k in [ 'ok', 'noop', 'failed', 'skipped' ] }
+    print(f'{done} {counts["ok"]} jail(s) in {time.monotonic() - t_0:.2f}s, '
+        f'{counts["noop"]} unchanged, {counts["failed"]} failed, '
+        f'{counts["skipped"]} skipped.')
+    failed = sorted(r.name for r in results.values() if r.status == 'failed')
+    if failed:
+        raise RuntimeError(f'Failed to {verb} jail(s): {", ".join(failed)}')
+    return results
+
+
 def cmd_taggable_list(args, tcls):
     with ZfsPropertyCache(), \
         JlsCache(), \
@@ -243,8 +321,16 @@ def cmd_fobject_create(args, fobject_class):
     print('Created', o.name, 'mounted at', o.path)
 
 
-def cmd_fobject_prune(args, fobject_class):
-    fobject_class.prune()
+def cmd_fobject_prune(args, fobject_class, **kwargs):
+    count = 0
+    def progress(name, used):
+        nonlocal count
+        count += 1
+        if not args.quiet:
+            print('Destroyed', name, f'({zfs_nicenum(used)})')
+    reclaimed = fobject_class.prune(max_workers=args.jobs, progress=progress,
+        **kwargs)
+    print(f'Pruned {count} dataset(s), reclaimed {zfs_nicenum(reclaimed)}')
 
 
 def cmd_fobject_tag(args, fobject_class):
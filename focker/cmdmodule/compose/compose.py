@@ -8,6 +8,10 @@
 
 from ...plugin import Plugin
 from .image import build_images
+from ..common import build_trace_args, \
+    open_build_trace, \
+    jail_schedule_args, \
+    schedule_jails
 from .volume import build_volumes
 from .jail import build_jails
 from .hook import exec_prebuild, \
@@ -17,7 +21,7 @@ from ...core.fenv import fenv_from_arg, \
     fenv_from_spec
 from ...core import OSJail
 import os
-from ...core import Volume, JailFs
+from ...core import Volume, JailFs, ZfsBatch
 from pathlib import Path
 import json
 
@@ -56,7 +60,8 @@ class ComposePlugin(Plugin):
                             aliases=['e'],
                             type=str,
                             nargs='+'
-                        )
+                        ),
+                        **build_trace_args()
                     ),
 
                     snapshot=dict(
@@ -94,7 +99,8 @@ class ComposePlugin(Plugin):
                         spec_filename=dict(
                             positional=True,
                             type=str
-                        )
+                        ),
+                        **jail_schedule_args()
                     ),
 
                     start=dict(
@@ -102,7 +108,8 @@ class ComposePlugin(Plugin):
                         spec_filename=dict(
                             positional=True,
                             type=str
-                        )
+                        ),
+                        **jail_schedule_args()
                     ),
                 )
             )
@@ -144,22 +151,21 @@ def load_spec(filename: str):
     return spec
 
     
-def stop_jails(jail_refs):
+def jail_names(jail_refs):
+    res = []
     for ref in jail_refs:
         j = OSJail.from_any_id(ref, raise_exc=False)
-        if j is None:
-            continue
-        if j.is_running:
-            j.stop()
+        if j is not None:
+            res.append(j.name)
+    return res
 
 
-def start_jails(jail_refs):
-    for ref in jail_refs:
-        j = OSJail.from_any_id(ref, raise_exc=False)
-        if j is None:
-            continue
-        if not j.is_running:
-            j.start()
+def stop_jails(jail_refs, jobs=None):
+    schedule_jails(jail_names(jail_refs), stop=True, jobs=jobs)
+
+
+def start_jails(jail_refs, jobs=None):
+    schedule_jails(jail_names(jail_refs), jobs=jobs)
 
 
 def cmd_compose_info(args):
@@ -181,7 +187,9 @@ def cmd_compose_build(args):
 
     stop_jails(spec.get('jails', {}).keys())
     exec_prebuild(spec.get('exec.prebuild', []), spec_dir, fenv=fenv)
-    build_images(spec.get('images', {}), spec_dir, fenv=fenv, squeeze=args.squeeze)
+    with open_build_trace(args) as trace:
+        build_images(spec.get('images', {}), spec_dir, fenv=fenv, squeeze=args.squeeze,
+            trace=trace)
     build_volumes(spec.get('volumes', {}), fenv=fenv)
     if 'jails' in spec:
         build_jails(spec['jails'], fenv=fenv)
@@ -193,11 +201,15 @@ def cmd_compose_snapshot(args):
 
     stop_jails(spec.get('jails', {}).keys())
 
-    for key, cls in [('volumes', Volume), ('jails', JailFs)]:
-        for tag in spec.get(key, {}).keys():
-            obj = cls.from_tag(tag)
-            res = obj.snapshot(args.snapshot_name)
-            print(f"{cls.__name__} snapshot created: {res}")
+    created = []
+    with ZfsBatch() as batch:
+        for key, cls in [('volumes', Volume), ('jails', JailFs)]:
+            for tag in spec.get(key, {}).keys():
+                obj = cls.from_tag(tag)
+                res = obj.snapshot(args.snapshot_name, batch=batch)
+                created.append((cls, res))
+    for cls, res in created:
+        print(f"{cls.__name__} snapshot created: {res}")
 
 
 def cmd_compose_rollback_destroy(args):
@@ -220,7 +232,7 @@ def cmd_compose_stop(args):
         print("No jails to stop.")
         return
 
-    stop_jails(spec.get('jails', {}).keys())
+    stop_jails(spec.get('jails', {}).keys(), jobs=args.jobs)
     print("Jails stopped.")
 
 
@@ -231,5 +243,5 @@ def cmd_compose_start(args):
         print("No jails to start.")
         return
 
-    start_jails(spec.get('jails', {}).keys())
+    start_jails(spec.get('jails', {}).keys(), jobs=args.jobs)
     print("Jails started.")
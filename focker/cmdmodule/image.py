@@ -8,9 +8,15 @@
 
 from ..plugin import Plugin
 from ..core import Image, \
-    ImageBuilder
-from .common import standard_fobject_commands
+    ImageBuilder, \
+    zfs_nicestrtonum
+from .common import standard_fobject_commands, \
+    cmd_fobject_prune, \
+    build_trace_args, \
+    open_build_trace
 from ..core.fenv import fenv_from_arg
+from tabulate import tabulate
+import json
 
 
 class ImagePlugin(Plugin):
@@ -20,7 +26,7 @@ class ImagePlugin(Plugin):
             image=dict(
                 aliases=['ima', 'img', 'im', 'i'],
                 subparsers=dict(
-                    **standard_fobject_commands(Image),
+                    **image_fobject_commands(),
                     build=dict(
                         aliases=['bld', 'b'],
                         func=cmd_image_build,
@@ -46,16 +52,69 @@ class ImagePlugin(Plugin):
                             aliases=['e'],
                             type=str,
                             nargs='+'
-                        )
+                        ),
+                        plan=dict(
+                            aliases=['n'],
+                            action='store_true'
+                        ),
+                        hash_jobs=dict(
+                            aliases=['j'],
+                            type=int,
+                            default=None
+                        ),
+                        checkpoint=dict(
+                            aliases=['c'],
+                            action='store_true'
+                        ),
+                        **build_trace_args()
                     )
                 )
             )
         )
 
 
+def image_fobject_commands():
+    res = standard_fobject_commands(Image, prune=cmd_image_prune)
+    res['prune'].update(
+        max_size=dict(
+            aliases=['m'],
+            type=zfs_nicestrtonum,
+            default=None
+        ),
+        keep_recent=dict(
+            aliases=['k'],
+            type=int,
+            default=None
+        )
+    )
+    return res
+
+
+def cmd_image_prune(args):
+    cmd_fobject_prune(args, Image, max_size=args.max_size,
+        keep_recent=args.keep_recent)
+
+
+def print_build_plan(plan):
+    res = []
+    for i, layer in enumerate(plan.layers):
+        steps = '; '.join(json.dumps(st) for st in layer.specs)
+        if len(steps) > 60:
+            steps = steps[:57] + '...'
+        res.append([ i + 1, layer.sha256[:12], plan.status(i), steps ])
+    print('Base:', plan.base.name)
+    print(tabulate(res, [ 'Layer', 'SHA256', 'Status', 'Steps' ]))
+
+
 def cmd_image_build(args):
     fenv = fenv_from_arg(args.fenv, {})
-    bld = ImageBuilder(args.focker_dir, squeeze=args.squeeze, atomic=args.atomic, fenv=fenv)
-    im = bld.build()
+    with open_build_trace(args) as trace:
+        bld = ImageBuilder(args.focker_dir, squeeze=args.squeeze, atomic=args.atomic,
+            fenv=fenv, hash_workers=args.hash_jobs, checkpoint=args.checkpoint,
+            trace=trace)
+        if args.plan:
+            print_build_plan(bld.plan())
+            return
+        im = bld.build()
     im.add_tags(args.tags)
     print(f'Created {im.name}, mounted at {im.path}, with tags: {", ".join(args.tags)}')
@@ -16,9 +16,12 @@ from ..core import JailFs, \
     TemporaryOSJail, \
     clone_image_jailspec
 from ..core.jailspec import JailSpec
+from ..misc import jailconf_store
 from .common import standard_fobject_commands, \
     DISPLAY_FIELDS, \
-    DEFAULT_DISPLAY_FIELDS
+    DEFAULT_DISPLAY_FIELDS, \
+    jail_schedule_args, \
+    schedule_jails
 from contextlib import ExitStack
 
 
@@ -98,24 +101,42 @@ class JailPlugin(Plugin):
                         func=cmd_jail_start,
                         jail_reference=dict(
                             positional=True,
-                            type=str
-                        )
+                            type=str,
+                            nargs='*'
+                        ),
+                        all=dict(
+                            aliases=['a'],
+                            action='store_true'
+                        ),
+                        **jail_schedule_args()
                     ),
                     stop=dict(
                         aliases=['sto', 'S'],
                         func=cmd_jail_stop,
                         jail_reference=dict(
                             positional=True,
-                            type=str
-                        )
+                            type=str,
+                            nargs='*'
+                        ),
+                        all=dict(
+                            aliases=['a'],
+                            action='store_true'
+                        ),
+                        **jail_schedule_args()
                     ),
                     restart=dict(
                         aliases=['re'],
                         func=cmd_jail_restart,
                         jail_reference=dict(
                             positional=True,
-                            type=str
-                        )
+                            type=str,
+                            nargs='*'
+                        ),
+                        all=dict(
+                            aliases=['a'],
+                            action='store_true'
+                        ),
+                        **jail_schedule_args()
                     )
                 )
             )
@@ -155,14 +176,20 @@ def cmd_jail_fromimage(args):
         print('Added jail', ospec.name, 'with path', jfs.path)
 
 
+def jail_names_from_args(args):
+    if args.all:
+        return sorted(jailconf_store().entries)
+    if not args.jail_reference:
+        raise ValueError('Specify at least one jail reference or --all')
+    return [ OSJail.from_any_id(ref).name for ref in args.jail_reference ]
+
+
 def cmd_jail_start(args):
-    j = OSJail.from_any_id(args.jail_reference)
-    j.start()
+    schedule_jails(jail_names_from_args(args), jobs=args.jobs)
 
 
 def cmd_jail_stop(args):
-    j = OSJail.from_any_id(args.jail_reference)
-    j.stop()
+    schedule_jails(jail_names_from_args(args), stop=True, jobs=args.jobs)
 
 
 def cmd_jail_restart(args):
@@ -17,5 +17,11 @@ from .misc import *
 from .osjail import *
 from .process import *
 from .zfs import *
+from .zfsbackend import *
+from .zfsprogram import *
+from .prefixindex import *
+from .origingraph import *
 from .config import FOCKER_CONFIG
 from .cache import *
+from .datasetindex import *
+from .jailscheduler import *
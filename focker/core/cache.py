@@ -83,13 +83,7 @@ class ZfsPropertyCache(CacheBase):
         self.focker_type = focker_type
 
     def generate_cache(self):
-        if self.focker_type is not None:
-            data = {}
-            for ft in self.focker_type:
-                data.update(zfs_properties_cache(ft))
-        else:
-            data = zfs_properties_cache()
-        return data
+        return zfs_properties_cache(self.focker_type)
 
     def _get_property(self, name, propname):
         return self.data.get(name, {}).get(propname, '-')
@@ -8,7 +8,12 @@
 
 from .zfs import *
 from .cache import ZfsPropertyCache
+from .prefixindex import PrefixIndex
+from .datasetindex import DatasetIndex
 from operator import itemgetter, attrgetter, methodcaller
+import time
+from typing import Dict, \
+    List
 
 
 Dataset = 'Dataset'
@@ -33,6 +38,9 @@ class Dataset:
 
     @classmethod
     def from_name(cls, name):
+        index = DatasetIndex.table_for(cls)
+        if index is not None and name in index:
+            return index[name]
         if ZfsPropertyCache.is_available():
             sha256 = ZfsPropertyCache.instance()[name]['focker:sha256']
             mountpoint = ZfsPropertyCache.instance()[name]['mountpoint']
@@ -42,6 +50,14 @@ class Dataset:
         return cls(init_key=cls._init_key, name=name, sha256=sha256,
             mountpoint=mountpoint)
 
+    @classmethod
+    def from_listing(cls, name, sha256, mountpoint):
+        index = DatasetIndex.table_for(cls)
+        if index is not None and name in index:
+            return index[name]
+        return cls._meta_class(init_key=cls._init_key, name=name, sha256=sha256,
+            mountpoint=mountpoint)
+
     @classmethod
     def from_mountpoint(cls, mountpoint):
         if ZfsPropertyCache.is_available():
@@ -68,14 +84,33 @@ class Dataset:
             raise RuntimeError(f'{base.__class__.__name__} must be finalized')
         if sha256 is None:
             sha256 = random_sha256_hexdigest()
-        if zfs_exists_props({ 'focker:sha256': sha256 }, focker_type=cls._meta_focker_type,
-            zfs_type=cls._meta_zfs_type):
+        res = zfs_probe_unique_name(sha256, focker_type=cls._meta_focker_type)
+        if res is None:
             raise RuntimeError(f'{cls.__name__} with specified SHA256 already exists')
-        name = zfs_shortest_unique_name(sha256, focker_type=cls._meta_focker_type)
+        name, mountpoint = res
         zfs_clone(base.snapshot_name, name, { 'focker:sha256': sha256 })
-        mountpoint = zfs_mountpoint(name)
-        return cls._meta_class(init_key=cls._init_key, name=name, sha256=sha256,
+        base.touch()
+        if mountpoint is None:
+            mountpoint = zfs_mountpoint(name)
+        res = cls._meta_class(init_key=cls._init_key, name=name, sha256=sha256,
             mountpoint=mountpoint)
+        cls._index_add(res)
+        return res
+
+    def rename_to_sha256(self, sha256: str) -> Dataset:
+        res = zfs_probe_unique_name(sha256, focker_type=self._meta_focker_type)
+        if res is None:
+            raise RuntimeError(f'{self.__class__.__name__} with specified SHA256 already exists')
+        name, mountpoint = res
+        zfs_rename(self.name, name)
+        zfs_set_props(name, { 'focker:sha256': sha256 })
+        if mountpoint is None:
+            mountpoint = zfs_mountpoint(name)
+        DatasetIndex.notify_destroyed(self.name)
+        res = self._meta_class(init_key=self._init_key, name=name, sha256=sha256,
+            mountpoint=mountpoint)
+        self._index_add(res)
+        return res
 
     def finalize(self):
         if not self._meta_can_finalize:
@@ -95,6 +130,16 @@ class Dataset:
         res = [ t for t in res if t != '-' ]
         return set(res)
 
+    def touch(self):
+        zfs_set_props(self.name, { 'focker:last_used': str(int(time.time())) })
+
+    @property
+    def last_used(self):
+        res = self.get_property('focker:last_used')
+        if res == '-':
+            return None
+        return int(res)
+
     @property
     def snapshot_name(self):
         return self.name + '@1'
@@ -138,12 +183,23 @@ class Dataset:
         else:
             raise RuntimeError('Ambiguous reference')
 
+    @classmethod
+    def exists_indexed(cls, **kwargs):
+        lst = DatasetIndex.table_for(cls).find(**kwargs)
+        if len(lst) > 1:
+            raise RuntimeError('Ambiguous reference')
+        return ( len(lst) == 1 )
+
     @classmethod
     def exists_sha256(cls, sha256: str):
+        if DatasetIndex.is_available():
+            return cls.exists_indexed(sha256=sha256)
         return cls.exists_predicate(lambda e: e[2] == sha256)
 
     @classmethod
     def exists_tag(cls, tag: str):
+        if DatasetIndex.is_available():
+            return cls.exists_indexed(tag=tag)
         return cls.exists_predicate(lambda e: tag in e[3].split(' '))
 
     @classmethod
@@ -159,24 +215,74 @@ class Dataset:
         return cls._meta_class(init_key=cls._init_key, name=name, sha256=sha256,
             mountpoint=mountpoint)
 
+    @classmethod
+    def from_indexed(cls, raise_exc=True, **kwargs):
+        lst = DatasetIndex.table_for(cls).find(**kwargs)
+        lst = cls.from_predicate_handle_corner_cases(lst, raise_exc=raise_exc)
+        if lst is None:
+            return None
+        return lst[0]
+
     @classmethod
     def from_sha256(cls, sha256: str, raise_exc=True):
+        if DatasetIndex.is_available():
+            return cls.from_indexed(sha256=sha256, raise_exc=raise_exc)
         return cls.from_predicate(lambda e: e[2] == sha256, raise_exc=raise_exc)
 
+    @classmethod
+    def from_sha256_many(cls, sha256s: List[str]) -> Dict[str, Dataset]:
+        index = DatasetIndex.table_for(cls)
+        res = {}
+        if index is not None:
+            for sha256 in sha256s:
+                lst = index.find(sha256=sha256)
+                if len(lst) == 1:
+                    res[sha256] = lst[0]
+            return res
+        wanted = set(sha256s)
+        lst = zfs_list([ 'name', 'mountpoint' ],
+            focker_type=cls._meta_focker_type, zfs_type=cls._meta_zfs_type)
+        for name, mountpoint, sha256 in lst:
+            if sha256 in wanted:
+                res[sha256] = cls._meta_class(init_key=cls._init_key, name=name,
+                    sha256=sha256, mountpoint=mountpoint)
+        return res
+
     @classmethod
     def from_tag(cls, tag: str, raise_exc=True):
+        if DatasetIndex.is_available():
+            return cls.from_indexed(tag=tag, raise_exc=raise_exc)
         return cls.from_predicate(lambda e: tag in e[3].split(' '), raise_exc=raise_exc)
 
     @classmethod
-    def from_partial_sha256(cls, sha256: str):
-        return cls.from_predicate(lambda e: e[2].startswith(sha256))
+    def sha256_index(cls) -> PrefixIndex:
+        lst = zfs_list(cls._meta_list_columns,
+            focker_type=cls._meta_focker_type, zfs_type=cls._meta_zfs_type)
+        return PrefixIndex((e[2], e) for e in lst)
+
+    @classmethod
+    def from_partial_sha256(cls, sha256: str, index: PrefixIndex = None):
+        if index is None and DatasetIndex.is_available():
+            return cls.from_indexed(sha256=sha256, prefix=True)
+        if index is None:
+            index = cls.sha256_index()
+        lst = [ e for _, e in index.find_prefix(sha256) ]
+        lst = cls.from_predicate_handle_corner_cases(lst)
+        name, mountpoint, sha256, *_ = lst[0]
+        return cls._meta_class(init_key=cls._init_key, name=name, sha256=sha256,
+            mountpoint=mountpoint)
 
     @classmethod
     def from_partial_tag(cls, tag: str):
+        if DatasetIndex.is_available():
+            return cls.from_indexed(tag=tag, prefix=True)
         return cls.from_predicate(lambda e: any(t.startswith(tag) for t in e[3].split(' ')))
 
     @classmethod
     def from_any_id(cls, id_: str, strict=True, raise_exc=True):
+        if DatasetIndex.is_available():
+            return cls.from_indexed(tag=id_, sha256=id_, prefix=not strict,
+                raise_exc=raise_exc)
         if strict:
             return cls.from_predicate(lambda e: \
                 id_ in e[3].split(' ') or e[2] == id_, raise_exc=raise_exc)
@@ -188,19 +294,24 @@ class Dataset:
     def add_tags(self, tags):
         if tags is None:
             return
-        zfs_untag(tags, focker_type=self._meta_focker_type)
-        zfs_tag(self.name, tags)
+        zfs_retag(self.name, tags, focker_type=self._meta_focker_type)
+        index = DatasetIndex.table_for(self.__class__)
+        if index is not None:
+            index.retag(self.name, tags)
 
     def remove_tags(self, tags):
         if tags is None:
             return
         if any(t not in self.tags for t in tags):
             raise RuntimeError(f'This {self.__class__.__name__.lower()} does not seem to be tagged with all the specified tags')
-        zfs_untag(tags, focker_type=self._meta_focker_type)
+        self.untag(tags)
 
     @classmethod
     def untag(cls, tags):
-        zfs_untag(tags, focker_type=cls._meta_focker_type)
+        zfs_retag(None, tags, focker_type=cls._meta_focker_type)
+        index = DatasetIndex.table_for(cls)
+        if index is not None:
+            index.untag(tags)
 
     def in_use(self):
         if not zfs_exists(self.name):
@@ -217,26 +328,58 @@ class Dataset:
     def create(cls, sha256=None):
         if sha256 is None:
             sha256 = random_sha256_hexdigest()
-        if cls.exists_sha256(sha256):
+        res = zfs_probe_unique_name(sha256, cls._meta_focker_type)
+        if res is None:
             raise RuntimeError(f'{cls.__name__} with the given SHA256 already exists')
-        name = zfs_shortest_unique_name(sha256, cls._meta_focker_type)
-        zfs_create(name, { 'focker:sha256': sha256 })
-        return cls.from_sha256(sha256)
+        name, mountpoint = res
+        zfs_create(name, { 'focker:sha256': sha256 }, check_exists=False)
+        if mountpoint is None:
+            mountpoint = zfs_mountpoint(name)
+        res = cls._meta_class(init_key=cls._init_key, name=name, sha256=sha256,
+            mountpoint=mountpoint)
+        cls._index_add(res)
+        return res
+
+    @classmethod
+    def _index_add(cls, ds):
+        index = DatasetIndex.table_for(cls)
+        if index is not None:
+            index.add(ds)
 
     def destroy(self, force=False):
         if self.in_use() and not force:
             raise RuntimeError(f'This {self.__class__.__name__.lower()} is in use')
+        self.before_destroy()
         zfs_destroy(self.name)
+        DatasetIndex.notify_destroyed(self.name)
+
+    def before_destroy(self):
+        pass
 
     @classmethod
-    def prune(cls):
+    def destroy_many(cls, lst, max_workers: int = None, progress=None) -> int:
+        used = zfs_check_unprotected([ ds.name for ds in lst ])
+        for ds in lst:
+            ds.before_destroy()
+        def done(name):
+            DatasetIndex.notify_destroyed(name)
+            if progress is not None:
+                progress(name, used.get(name, 0))
+        zfs_destroy_many([ ds.name for ds in lst ], max_workers=max_workers,
+            callback=done)
+        return sum(used.values())
+
+    @classmethod
+    def prune(cls, max_workers: int = None, progress=None):
+        reclaimed = 0
         while True:
             lst = cls.list_unused()
             lst = [ ds for ds in lst if not ds.tags ]
             if len(lst) == 0:
                 break
-            for ds in lst:
-                ds.destroy()
+            reclaimed += cls.destroy_many(lst, max_workers=max_workers,
+                progress=progress)
+        return reclaimed
 
     @property
     def is_protected(self):
@@ -315,11 +458,14 @@ class Dataset:
         snapshots = list(_)
         return snapshots
     
-    def snapshot(self, snapshot_name: str):
+    def snapshot(self, snapshot_name: str, batch: ZfsBatch = None):
         snapshots = self.list_snapshots()
         if snapshot_name in snapshots:
             raise ValueError("Snapshot with that name already exists")
-        zfs_snapshot(f"{self.name}@{snapshot_name}")
+        if batch is not None:
+            batch.snapshot(f"{self.name}@{snapshot_name}")
+        else:
+            zfs_snapshot(f"{self.name}@{snapshot_name}")
         return f"{self.name}@{snapshot_name}"
     
     def rollback(self, snapshot_name: str, force: bool = False):
@@ -0,0 +1,128 @@
+#
+# Copyright (C) Stanislaw Adaszewski, 2020-2021
+# License: GNU General Public License v3.0
+# URL: https://github.com/sadaszewski/focker
+# URL: https://adared.ch/focker
+#
+
+
+from contextvars import ContextVar
+from .cache import CacheBase
+from ..misc import on_focker_relock
+from .prefixindex import PrefixIndex
+from .zfs import zfs_list
+from typing import Iterable, \
+    List
+
+
+DatasetTable = 'DatasetTable'
+
+class DatasetTable:
+    def __init__(self, cls):
+        self.cls = cls._meta_class
+        self.datasets = {}
+        self.tags = {}
+        self.sha256_index = PrefixIndex()
+        self.tag_index = PrefixIndex()
+        lst = zfs_list([ 'name', 'mountpoint', 'focker:sha256', 'focker:tags' ],
+            focker_type=cls._meta_focker_type, zfs_type=cls._meta_zfs_type)
+        for name, mountpoint, sha256, tags, *_ in lst:
+            ds = self.cls(init_key=self.cls._init_key, name=name, sha256=sha256,
+                mountpoint=mountpoint)
+            self.add(ds, tags.split(' '))
+
+    def __contains__(self, name: str):
+        return name in self.datasets
+
+    def __getitem__(self, name: str):
+        return self.datasets[name]
+
+    def add(self, ds, tags: Iterable[str] = []):
+        self.discard(ds.name)
+        self.datasets[ds.name] = ds
+        self.tags[ds.name] = set()
+        self.sha256_index.add(ds.sha256, ds.name)
+        self.add_tags(ds.name, tags)
+
+    def discard(self, name: str):
+        if name not in self.datasets:
+            return
+        self.remove_tags(name, list(self.tags[name]))
+        self.sha256_index.remove(self.datasets[name].sha256, name)
+        del self.datasets[name]
+        del self.tags[name]
+
+    def add_tags(self, name: str, tags: Iterable[str]):
+        for t in tags:
+            if t == '-' or t in self.tags[name]:
+                continue
+            self.tags[name].add(t)
+            self.tag_index.add(t, name)
+
+    def remove_tags(self, name: str, tags: Iterable[str]):
+        for t in tags:
+            if t not in self.tags[name]:
+                continue
+            self.tags[name].remove(t)
+            self.tag_index.remove(t, name)
+
+    def retag(self, name: str, tags: List[str]):
+        self.untag(tags)
+        if name is not None and name in self.datasets:
+            self.add_tags(name, tags)
+
+    def untag(self, tags: List[str]):
+        for t in tags:
+            for _, name in self.tag_index.find_prefix(t):
+                if t in self.tags[name]:
+                    self.remove_tags(name, [ t ])
+
+    def _lookup(self, index: PrefixIndex, key: str, prefix: bool):
+        res = index.find_prefix(key)
+        if not prefix:
+            res = [ (k, v) for k, v in res if k == key ]
+        return list(dict.fromkeys(name for _, name in res))
+
+    def find(self, sha256: str = None, tag: str = None, prefix: bool = False):
+        names = []
+        if tag is not None:
+            names += self._lookup(self.tag_index, tag, prefix)
+        if sha256 is not None:
+            names += self._lookup(self.sha256_index, sha256, prefix)
+        return [ self.datasets[n] for n in dict.fromkeys(names) ]
+
+
+class DatasetIndex(CacheBase):
+    context_var = ContextVar('DATASET_INDEX', default=None)
+
+    def generate_cache(self):
+        return {}
+
+    def table(self, cls) -> DatasetTable:
+        key = (cls._meta_focker_type, cls._meta_zfs_type)
+        if key not in self.data:
+            self.data[key] = DatasetTable(cls)
+        return self.data[key]
+
+    def discard(self, name: str):
+        for tbl in self.data.values():
+            tbl.discard(name)
+
+    @classmethod
+    def table_for(cls, ds_cls):
+        if not cls.is_available():
+            return None
+        return cls.instance().table(ds_cls)
+
+    @classmethod
+    def notify_destroyed(cls, name: str):
+        if cls.is_available():
+            cls.instance().discard(name)
+
+    @classmethod
+    def notify_relocked(cls):
+        if cls.is_available():
+            cls.instance().data = {}
+
+
+on_focker_relock(DatasetIndex.notify_relocked)
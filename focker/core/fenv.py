@@ -1,9 +1,17 @@
 import re
-from typing import Dict
+import hashlib
+import json
+from typing import Dict, \
+    Iterable, \
+    Iterator, \
+    List, \
+    Set
 from .. import yaml
 from ..misc import merge_dicts
 
 
+MAX_MARKER_LEN = 64 * 1024
+CHUNK_SIZE = 1024 * 1024
 LINE_CONTINUATION = re.compile(r'\\[ \t\r]*\n')
 SUBST_MARKER = re.compile(r'\$\{\{[ \n\t\r]*("(\\"|[^"])*"|\'(\\\'|[^\'])*\'|[a-zA-Z0-9_]*)[ \n\t\r]*\}\}')
 
@@ -33,6 +41,78 @@ def substitute_focker_env_vars(s: str, fenv_vars: Dict[str, str]) -> str:
     return s
 
 
+def _marker_var_name(m):
+    name = m.group(1)
+    if name and not name.startswith('"') and not name.startswith("'"):
+        return name.lower()
+    return None
+
+
+def fenv_referenced_vars(s: str) -> List[str]:
+    res = set(_marker_var_name(m) for m in SUBST_MARKER.finditer(s))
+    res.discard(None)
+    return sorted(res)
+
+
+def iter_substitute_focker_env_vars(chunks: Iterable[str],
+    fenv_vars: Dict[str, str], referenced: Set[str] = None) -> Iterator[str]:
+
+    # Markers longer than MAX_MARKER_LEN which are still incomplete
+    # at the end of the buffer are treated as literal text.
+    handler = handle_subst_marker(fenv_vars)
+    buf = ''
+    eof = False
+    chunks = iter(chunks)
+    while not eof:
+        data = next(chunks, None)
+        if data is None:
+            eof = True
+        else:
+            buf += data
+        out = []
+        pos = 0
+        while True:
+            i = buf.find('${{', pos)
+            if i < 0:
+                end = len(buf)
+                if not eof:
+                    end -= 2 if buf.endswith('${') else 1 if buf.endswith('$') else 0
+                out.append(buf[pos:end])
+                pos = end
+                break
+            m = SUBST_MARKER.match(buf, i)
+            if m is not None:
+                out.append(buf[pos:i])
+                out.append(handler(m))
+                if referenced is not None and _marker_var_name(m) is not None:
+                    referenced.add(_marker_var_name(m))
+                pos = m.end()
+            elif not eof and len(buf) - i < MAX_MARKER_LEN:
+                out.append(buf[pos:i])
+                pos = i
+                break
+            else:
+                out.append(buf[pos:i + 1])
+                pos = i + 1
+        buf = buf[pos:]
+        res = ''.join(out)
+        if res:
+            yield res
+
+
+def iter_file_chunks(f, chunk_size: int = CHUNK_SIZE) -> Iterator:
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            break
+        yield data
+
+
+def fenv_digest(names: List[str], fenv_vars: Dict[str, str]) -> str:
+    data = [ [ k, str(fenv_vars[k]) if k in fenv_vars else None ] for k in names ]
+    return hashlib.sha256(json.dumps(data).encode('utf-8')).hexdigest()
+
+
 def rec_subst_fenv_vars(o: object, fenv_vars: Dict[str, str]) -> object:
     if isinstance(o, str):
         return substitute_focker_env_vars(o, fenv_vars)
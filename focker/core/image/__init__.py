@@ -7,4 +7,10 @@
 
 
 from .image import Image
-from .build import ImageBuilder
+from .build import ImageBuilder, \
+    BuildPlan, \
+    BuildLayer
+from .trace import TraceSink, \
+    JsonLinesTraceSink, \
+    HumanTraceSink, \
+    open_trace_sink
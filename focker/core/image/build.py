@@ -9,10 +9,26 @@
 import os
 from ... import yaml
 from functools import reduce
-from .steps import create_step
+from .steps import create_step, \
+    prehash_steps, \
+    BuildSession
 from .image import Image
 from contextlib import ExitStack
 from ..fenv import fenv_from_spec
+from .trace import TraceSink, \
+    trace_event
+from ..zfs import zfs_destroy_snapshots, \
+    zfs_get_numeric, \
+    zfs_parse_output, \
+    zfs_rollback, \
+    zfs_run, \
+    zfs_set_props, \
+    zfs_snapshot
+from ...misc import FileHashCache
+from typing import Dict, \
+    List, \
+    Union
+import time
 
 
 def validate(spec):
@@ -23,14 +39,65 @@ def validate(spec):
         raise RuntimeError('Exactly one of "steps" or "facets" must be specified')
 
 
+CHECKPOINT_PREFIX = 'ckpt-'
+
+
+def checkpoint_name(prefix_sha256: str) -> str:
+    return CHECKPOINT_PREFIX + prefix_sha256
+
+
+BuildLayer = 'BuildLayer'
+
+class BuildLayer:
+    def __init__(self, specs, steps, sha256, prefixes=None):
+        self.specs = specs
+        self.steps = steps
+        self.sha256 = sha256
+        self.prefixes = prefixes or []
+        self.image = None
+
+
+class BuildPlan:
+    def __init__(self, base: Image, layers: List[BuildLayer], jailspec: Dict = {}):
+        self.base = base
+        self.layers = layers
+        self.jailspec = jailspec
+
+    @property
+    def deepest_cached(self) -> int:
+        for i in reversed(range(len(self.layers))):
+            if self.layers[i].image is not None:
+                return i
+        return -1
+
+    def status(self, i: int) -> str:
+        start = self.deepest_cached
+        if i < start:
+            return 'skip'
+        elif i == start:
+            return 'cached'
+        return 'build'
+
+
 class ImageBuilder:
-    def __init__(self, focker_dir, squeeze=False, atomic=False, fenv={}):
+    def __init__(self, focker_dir, squeeze=False, atomic=False, fenv={},
+        hash_workers=None, checkpoint=False, trace: TraceSink = None):
+
+        if atomic and checkpoint:
+            raise ValueError('Atomic builds cannot use checkpoints')
+
         self.focker_dir = focker_dir
         self.squeeze = squeeze
         self.atomic = atomic
         self.fenv = fenv
+        self.hash_workers = hash_workers
+        self.checkpoint = checkpoint
+        self.trace = trace
 
-    def build(self) -> Image:
+    def trace_event(self, event: str, **kwargs):
+        trace_event(self.trace, event, **kwargs)
+
+    def load_spec(self):
         if not os.path.exists(os.path.join(self.focker_dir, 'Fockerfile')):
             raise RuntimeError('Fockerfile not found in the specified directory')
 
@@ -41,14 +108,40 @@ class ImageBuilder:
 
         fenv = fenv_from_spec(spec, self.fenv)
 
-        if 'steps' in spec:
-            im = self.process_steps(spec, fenv)
-        else:
-            im = self.process_facets(spec, fenv)
+        return spec, fenv
+
+    @staticmethod
+    def hash_cache(save: bool = True) -> FileHashCache:
+        from ..config import FOCKER_CONFIG
+        return FileHashCache(os.path.join(FOCKER_CONFIG.zfs.root_mountpoint,
+            '.focker-filehash.json'), save=save)
+
+    def build(self) -> Image:
+        t_0 = time.monotonic()
+        self.trace_event('build_start', focker_dir=self.focker_dir)
+
+        spec, fenv = self.load_spec()
 
+        with self.hash_cache():
+            if 'steps' in spec:
+                im = self.process_steps(spec, fenv)
+            else:
+                im = self.process_facets(spec, fenv)
+
+        self.trace_event('build_end', name=im.name, sha256=im.sha256,
+            duration=time.monotonic() - t_0)
         return im
 
-    def process_steps(self, spec, fenv) -> Image:
+    def plan(self) -> BuildPlan:
+        spec, fenv = self.load_spec()
+
+        if 'facets' in spec:
+            spec = self.merge_facets(spec)
+
+        with self.hash_cache(save=False):
+            return self.plan_steps(spec, fenv)
+
+    def plan_steps(self, spec, fenv) -> BuildPlan:
         steps = spec['steps']
 
         if isinstance(steps, list):
@@ -64,32 +157,160 @@ class ImageBuilder:
 
         base_im = Image.from_any_id(spec['base'], strict=True)
 
+        all_steps = [ [ create_step(st, self.focker_dir, fenv) for st in group ] \
+            for group in steps ]
+        prehash_steps(reduce(list.__add__, all_steps, []),
+            max_workers=self.hash_workers)
+
+        jailspec = { 'scratch': spec['scratch'] } if 'scratch' in spec else {}
+
         sha256 = base_im.sha256
-        im = base_im
+        layers = []
+        for group, group_steps in zip(steps, all_steps):
+            prefixes = []
+            for st in group_steps:
+                sha256 = st.hash(sha256, scratch=jailspec.get('scratch'))
+                prefixes.append(sha256)
+            layers.append(BuildLayer(group, group_steps, sha256, prefixes))
+
+        found = Image.from_sha256_many([ l.sha256 for l in layers ])
+        for l in layers:
+            l.image = found.get(l.sha256)
+
+        return BuildPlan(base_im, layers, jailspec)
+
+    def process_steps(self, spec, fenv) -> Image:
+        return self.execute_plan(self.plan_steps(spec, fenv))
+
+    def execute_plan(self, plan: BuildPlan) -> Image:
+        start = plan.deepest_cached
+        if self.trace is not None:
+            self.trace_plan(plan)
+        if start >= 0:
+            im = plan.layers[start].image
+            im.touch()
+        else:
+            im = plan.base
         with ExitStack() as stack:
-            for group in steps:
-                for st in group:
-                    st = create_step(st, self.focker_dir, fenv)
-                    sha256 = st.hash(sha256)
-                if Image.exists_sha256(sha256):
-                    im = Image.from_sha256(sha256)
-                    continue
-                im = Image.clone_from(im, sha256=sha256)
-                try:
-                    for st in group:
-                        st = create_step(st, self.focker_dir, fenv)
-                        st.execute(im)
-                except:
-                    im.destroy()
-                    raise
-                im.finalize()
+            for i in range(start + 1, len(plan.layers)):
+                t_0 = time.monotonic()
+                if self.checkpoint:
+                    im = self.build_layer_checkpointed(im, i, plan.layers[i], plan.jailspec)
+                else:
+                    im = self.build_layer(im, i, plan.layers[i], plan.jailspec)
+                if self.trace is not None:
+                    self.trace_event('finalize', layer=i, name=im.name,
+                        duration=time.monotonic() - t_0,
+                        **zfs_get_numeric(im.name, [ 'used', 'written' ]))
                 if self.atomic:
                     stack.callback(im.destroy)
             _ = stack.pop_all()
 
         return im
 
-    def process_facets(self, spec, fenv) -> Image:
+    def trace_plan(self, plan: BuildPlan):
+        start = plan.deepest_cached
+        self.trace_event('plan', base=plan.base.name, layers=len(plan.layers),
+            cached=start + 1, to_build=len(plan.layers) - start - 1,
+            hit_ratio=(start + 1) / len(plan.layers) if plan.layers else 1.0)
+        for i, layer in enumerate(plan.layers):
+            if i <= start:
+                self.trace_event('cache_hit', layer=i, sha256=layer.sha256,
+                    name=layer.image.name)
+            else:
+                self.trace_event('cache_miss', layer=i, sha256=layer.sha256)
+
+    def execute_steps(self, im: Image, layer_no: int, steps, jailspec: Dict,
+        checkpoints: List[str] = [], first: int = 0):
+
+        with BuildSession(im, jailspec) as session:
+            for i, st in enumerate(steps):
+                t_0 = time.monotonic()
+                self.trace_event('step_start', layer=layer_no, step=first + i,
+                    kind=st.kind)
+                try:
+                    st.execute(im, session=session, max_workers=self.hash_workers)
+                except Exception as e:
+                    self.trace_event('step_error', layer=layer_no, step=first + i,
+                        kind=st.kind, duration=time.monotonic() - t_0, error=str(e))
+                    raise
+                self.trace_event('step_end', layer=layer_no, step=first + i,
+                    kind=st.kind, duration=time.monotonic() - t_0)
+                if i < len(checkpoints):
+                    zfs_snapshot(f'{im.name}@{checkpoints[i]}')
+
+    def build_layer(self, base: Image, layer_no: int, layer: BuildLayer,
+        jailspec: Dict) -> Image:
+
+        im = Image.clone_from(base, sha256=layer.sha256)
+        self.trace_event('clone', layer=layer_no, name=im.name, origin=base.name)
+        try:
+            self.execute_steps(im, layer_no, layer.steps, jailspec)
+        except:
+            im.destroy()
+            raise
+        im.finalize()
+        return im
+
+    @staticmethod
+    def find_checkpoint(layer: BuildLayer):
+        # Work-in-progress clones are marked with the hash of the first step
+        # of their layer, only their snapshots need to be looked at.
+        if len(layer.prefixes) < 2:
+            return None, 0
+        from ..config import FOCKER_CONFIG
+        lst = zfs_parse_output([ 'zfs', 'list', '-H', '-o', 'name,focker:checkpoint',
+            '-t', 'filesystem', '-d', '1', FOCKER_CONFIG.zfs.root_dataset + '/images' ])
+        snapshots = {}
+        for name, ckpt in lst:
+            if ckpt != layer.prefixes[0]:
+                continue
+            for snap in ImageBuilder.list_checkpoints(name):
+                snapshots.setdefault(snap.split('@')[1], name)
+        for i in reversed(range(len(layer.prefixes) - 1)):
+            snap = checkpoint_name(layer.prefixes[i])
+            if snap in snapshots:
+                return Image.from_name(snapshots[snap]), i + 1
+        return None, 0
+
+    @staticmethod
+    def list_checkpoints(im: Union[Image, str]) -> List[str]:
+        name = im if isinstance(im, str) else im.name
+        lst = zfs_parse_output([ 'zfs', 'list', '-H', '-o', 'name',
+            '-t', 'snapshot', '-d', '1', name ])
+        return [ snap for snap, *_ in lst \
+            if snap.split('@')[1].startswith(CHECKPOINT_PREFIX) ]
+
+    def build_layer_checkpointed(self, base: Image, layer_no: int,
+        layer: BuildLayer, jailspec: Dict) -> Image:
+
+        # The work-in-progress clone gets a random SHA256 so that it is
+        # never mistaken for the finished layer, until it is renamed.
+        im, done = self.find_checkpoint(layer)
+        if im is None:
+            im = Image.clone_from(base)
+            if len(layer.prefixes) > 1:
+                zfs_set_props(im.name, { 'focker:checkpoint': layer.prefixes[0] })
+            self.trace_event('clone', layer=layer_no, name=im.name, origin=base.name)
+        else:
+            zfs_rollback(f'{im.name}@{checkpoint_name(layer.prefixes[done - 1])}',
+                force=True)
+            self.trace_event('resume', layer=layer_no, name=im.name, done=done)
+        try:
+            self.execute_steps(im, layer_no, layer.steps[done:], jailspec,
+                [ checkpoint_name(p) for p in layer.prefixes[done:-1] ], first=done)
+        except:
+            if not self.list_checkpoints(im):
+                im.destroy()
+            raise
+        zfs_destroy_snapshots(im.name, [ snap.split('@')[1] \
+            for snap in self.list_checkpoints(im) ])
+        zfs_run([ 'zfs', 'inherit', 'focker:checkpoint', im.name ])
+        im = im.rename_to_sha256(layer.sha256)
+        im.finalize()
+        return im
+
+    def merge_facets(self, spec):
         steps = []
 
         for fname in spec['facets']:
@@ -115,4 +336,7 @@ class ImageBuilder:
         del spec['facets']
         spec['steps'] = steps
 
-        return self.process_steps(spec, fenv)
+        return spec
+
+    def process_facets(self, spec, fenv) -> Image:
+        return self.process_steps(self.merge_facets(spec), fenv)
@@ -7,9 +7,10 @@
 
 
 from ..dataset import Dataset
-from ..zfs import zfs_list, \
-    zfs_destroy
-from functools import reduce
+from ..datasetindex import DatasetIndex
+from ..origingraph import OriginGraph
+from ..zfs import zfs_check_unprotected, \
+    zfs_destroy_many
 
 
 Image='Image'
@@ -21,48 +22,36 @@ class Image(Dataset):
         super().__init__(**kwargs)
 
     @staticmethod
-    def list_unused():
-        fields = ['name', 'origin']
-        lst = zfs_list(fields, focker_type='image') + \
-            zfs_list(fields, focker_type='jail')
-        used = set()
-        for item in lst:
-            used.add(item[1].split('@')[0])
-        lst = zfs_list(fields, focker_type='image')
-        lst = [ Image.from_name(item[0]) for item in lst if item[0] not in used ]
-        return lst
+    def list_unused(graph: OriginGraph = None):
+        graph = graph or OriginGraph.from_zfs()
+        return [ Image.from_listing(name, graph.sha256[name], graph.mountpoint[name]) \
+            for name in sorted(graph.unused('image')) ]
+
+    def in_use(self, graph: OriginGraph = None):
+        graph = graph or OriginGraph.from_zfs()
+        return graph.in_use(self.name)
 
     @staticmethod
-    def prune():
-        fields = [ 'name', 'origin', 'focker:tags' ]
-        tree = {}
-        for focker_type in [ 'image', 'jail' ]:
-            lst = zfs_list(fields, focker_type=focker_type)
-            for name, origin, tags, *_ in lst:
-                origin = origin.split('@')[0]
-                node = tree.get(origin, {})
-                children = node.get('children', [])
-                children.append(name)
-                node['children'] = children
-                tree[origin] = node
-                if focker_type == 'image' and tags == '-':
-                    node = tree.get(name, {})
-                    node.update({ 'parent': origin, 'tags': tags })
-                    tree[name] = node
-        batches = []
-        while True:
-            bat = set([ k for k, v in tree.items() if not v.get('children') ])
-            if not bat:
-                break
-            batches.append(bat)
-            tree = { k: v for k, v in tree.items() if k not in bat }
-            for name in bat:
-                for v in tree.values():
-                    if name in v.get('children', []):
-                        v['children'].remove(name)
-        batches = reduce(list.__add__, map(list, batches), [])
-        for name in batches:
-            zfs_destroy(name)
+    def prune(graph: OriginGraph = None, max_workers: int = None, progress=None,
+        max_size: int = None, keep_recent: int = None):
+
+        graph = graph or OriginGraph.from_zfs()
+        if max_size is None and keep_recent is None:
+            batches = graph.prune_batches('image')
+        else:
+            batches = graph.batches(graph.evict_order('image',
+                max_size=max_size, keep_recent=keep_recent or 0))
+        reclaimed = 0
+        for batch in batches:
+            used = zfs_check_unprotected(batch)
+            def done(name):
+                graph.remove(name)
+                DatasetIndex.notify_destroyed(name)
+                if progress is not None:
+                    progress(name, used.get(name, 0))
+            zfs_destroy_many(batch, max_workers=max_workers, callback=done)
+            reclaimed += sum(used.values())
+        return reclaimed
 
 Image._meta_class = Image
 Image._meta_cloneable_from = Image
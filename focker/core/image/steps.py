@@ -7,18 +7,65 @@
 
 import hashlib
 import json
-import shutil
 import os
 import shlex
-from ...misc import filehash
+import stat
+import subprocess
+import sys
+import threading
+from fnmatch import fnmatch
+from ...misc import cached_filehash, \
+    fast_copyfile, \
+    FileHashCache, \
+    focker_unlock
+from ..process import focker_subprocess_popen
 from ..jailspec import ImageBuildJailSpec
 from ..osjail import TemporaryOSJail
-from ..fenv import substitute_focker_env_vars
-import io
+from ..mount import MountSpec, \
+    mount_from_spec, \
+    scratch_mount_specs, \
+    scratch_paths
+from ..volume import Volume
+from .image import Image
+from ..fenv import substitute_focker_env_vars, \
+    iter_substitute_focker_env_vars, \
+    iter_file_chunks, \
+    fenv_digest
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from contextlib import ExitStack
+
+
+DEFAULT_HASH_WORKERS = min(8, os.cpu_count() or 1)
+DEFAULT_COPY_WORKERS = DEFAULT_HASH_WORKERS
+DEFAULT_PARALLEL_JOBS = os.cpu_count() or 1
+
+
+class BuildSession:
+    def __init__(self, im, jailspec={}):
+        self.im = im
+        self.jailspec = jailspec
+        self.stack = ExitStack()
+        self.jail = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excinfo):
+        self.stack.close()
+        self.jail = None
+
+    def osjail(self) -> TemporaryOSJail:
+        if self.jail is None:
+            jspec = ImageBuildJailSpec.from_image_and_dict(self.im, self.jailspec)
+            self.jail = self.stack.enter_context(TemporaryOSJail(jspec))
+        return self.jail
 
 
 class RunStep(object):
-    def __init__(self, spec, src_dir, fenv):
+    kind = 'run'
+
+    def __init__(self, spec, src_dir, fenv, cache=None, scratch=None):
         if isinstance(spec, list):
             spec = [ substitute_focker_env_vars(s, fenv) for s in spec ]
         elif isinstance(spec, str):
@@ -26,25 +73,110 @@ class RunStep(object):
         else:
             raise TypeError('Run spec must be a list or a string')
 
+        cache = cache or {}
+        if not isinstance(cache, dict):
+            raise TypeError('Run step cache must be a dictionary')
+        cache = { substitute_focker_env_vars(k, fenv): substitute_focker_env_vars(v, fenv) \
+            for k, v in cache.items() }
+        if any(k.startswith('/') for k in cache.keys()):
+            raise ValueError('Run step cache must refer to volumes, not host paths')
+
         self.spec = spec
         self.src_dir = src_dir
         self.fenv = fenv
+        self.cache = cache
+        self.scratch = scratch_mount_specs(scratch or [])
 
-    def hash(self, base, **kwargs):
+    def hash(self, base, scratch=None, **kwargs):
+        # Scratch paths end up empty in the snapshot
+        scratch = scratch_paths(self.scratch + scratch_mount_specs(scratch or []))
         res = hashlib.sha256(
-            json.dumps(( base, self.spec ))
+            json.dumps(( base, self.spec, scratch ) if scratch else ( base, self.spec ))
             .encode('utf-8')).hexdigest()
         return res
 
-    def execute(self, im, **kwargs):
+    def cache_mounts(self, im):
+        res = []
+        for source, target in self.cache.items():
+            tag = source.split('/')[0]
+            if not Volume.exists_tag(tag):
+                v = Volume.create()
+                v.add_tags([ tag ])
+            res.append(mount_from_spec(MountSpec(source, target), im.path))
+        return res
+
+    def mounts(self, im):
+        return self.cache_mounts(im) + \
+            [ mount_from_spec(m, im.path) for m in self.scratch ]
+
+    def execute(self, im, session: BuildSession = None, **kwargs):
         spec = self.spec
         if isinstance(spec, list):
             spec = ' && ' .join(self.spec)
-        jspec = ImageBuildJailSpec.from_image_and_dict(im, {})
-        with TemporaryOSJail(jspec) as j:
+        with ExitStack() as stack:
+            if session is None:
+                session = stack.enter_context(BuildSession(im))
+            j = session.osjail()
+            for m in self.mounts(im):
+                m.mount()
+                stack.callback(m.unmount)
             j.run([ '/bin/sh', '-c', spec ])
 
 
+class ParallelStep(object):
+    kind = 'parallel'
+
+    def __init__(self, spec, src_dir, fenv, jobs=None):
+        if not isinstance(spec, list):
+            raise TypeError('Parallel step spec must be a list')
+        spec = [ RunStep(s, src_dir, fenv).spec for s in spec ]
+
+        self.spec = spec
+        self.src_dir = src_dir
+        self.fenv = fenv
+        self.jobs = jobs or DEFAULT_PARALLEL_JOBS
+        self.commands = [ ' && '.join(s) if isinstance(s, list) else s \
+            for s in spec ]
+
+    def hash(self, base, scratch=None, **kwargs):
+        scratch = scratch_paths(scratch_mount_specs(scratch or []))
+        res = hashlib.sha256(
+            json.dumps(( base, 'parallel', self.spec, scratch ) if scratch \
+                else ( base, 'parallel', self.spec ))
+            .encode('utf-8')).hexdigest()
+        return res
+
+    def execute(self, im, session: BuildSession = None, **kwargs):
+        out_lock = threading.Lock()
+        failed = []
+
+        def run_one(i, j):
+            if failed:
+                return
+            p = focker_subprocess_popen(j.jexec_command([ '/bin/sh', '-c', self.commands[i] ]),
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            for ln in p.stdout:
+                with out_lock:
+                    sys.stdout.write(f'[{i + 1}] ' + ln.decode('utf-8', 'replace'))
+                    sys.stdout.flush()
+            if p.wait() != 0:
+                failed.append((i, p.returncode))
+
+        with ExitStack() as stack:
+            if session is None:
+                session = stack.enter_context(BuildSession(im))
+            j = session.osjail()
+            with focker_unlock(), \
+                ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                futures = [ pool.submit(run_one, i, j) for i in range(len(self.commands)) ]
+                for fut in futures:
+                    fut.result()
+
+        if failed:
+            raise RuntimeError('Parallel command(s) failed: ' + ', '.join(f'[{i + 1}] with exit code {rc}' \
+                for i, rc in sorted(failed)))
+
+
 class CopyStepEntry:
     def __init__(self, spec, src_dir, fenv):
         if not isinstance(spec, list):
@@ -55,33 +187,189 @@ class CopyStepEntry:
         self.src_dir = src_dir
         self.fenv = fenv
 
-        self.src_file = os.path.join(self.src_dir, spec[0])
         self.dst_file = spec[1]
         self.options = spec[2] if len(spec) > 2 else {}
         self.use_fenv = self.options.get('use_fenv', False)
+        if 'from' in self.options:
+            self.from_image = Image.from_any_id(self.options['from'], strict=True)
+            if not self.from_image.is_finalized:
+                raise RuntimeError('Image to copy from must be finalized')
+            self.src_file = self.image_path(spec[0])
+        else:
+            self.from_image = None
+            self.src_file = os.path.join(self.src_dir, spec[0])
+        self.glob = self.options.get('glob', [])
+        if isinstance(self.glob, str):
+            self.glob = [ self.glob ]
+        self._hash = None
+        self._tree = None
+
+    def hash(self, pool: ThreadPoolExecutor = None):
+        if self._hash is None:
+            if pool is not None and self.is_tree():
+                self._hash = self.tree_hash(pool)
+            else:
+                self._hash = self.compute_hash()
+        return self._hash
+
+    def image_path(self, path):
+        root = os.path.realpath(self.from_image.path)
+        res = os.path.realpath(os.path.join(root, path.strip('/')))
+        if res != root and not res.startswith(root + os.sep):
+            raise ValueError(f'Copy source points outside of the image: {path}')
+        return res
+
+    def is_dir(self):
+        return os.path.isdir(self.src_file)
+
+    def is_tree(self):
+        return ( self.from_image is None and self.is_dir() )
+
+    def compute_hash(self):
+        if self.from_image is not None:
+            # Finalized images are immutable, their SHA256 covers the content
+            fenv = sorted(self.fenv.items()) if self.use_fenv else None
+            return hashlib.sha256(json.dumps(( self.from_image.sha256,
+                self.spec[0], fenv )).encode('utf-8')).hexdigest()
+        if self.is_dir():
+            return self.tree_hash()
+        return self.file_hash(self.src_file)
+
+    def file_hash(self, src_file):
+        if not self.use_fenv:
+            return cached_filehash(src_file)
+        cache = FileHashCache.instance()
+        key = os.path.abspath(src_file) + '|fenv'
+        st = os.stat(src_file)
+        if cache is not None:
+            e = cache.lookup(key, st, lambda e: \
+                e['fenv_digest'] == fenv_digest(e['fenv_vars'], self.fenv))
+            if e is not None:
+                return e['sha256']
+        h = hashlib.sha256()
+        names = set()
+        for s in self.iter_substituted(src_file, names):
+            h.update(s.encode('utf-8'))
+        res = h.hexdigest()
+        names = sorted(names)
+        if cache is not None:
+            cache.store(key, st, dict(sha256=res, fenv_vars=names,
+                fenv_digest=fenv_digest(names, self.fenv)))
+        return res
+
+    def iter_substituted(self, src_file, referenced=None):
+        with open(src_file) as f:
+            yield from iter_substitute_focker_env_vars(iter_file_chunks(f),
+                self.fenv, referenced)
+
+    def matches(self, rel_path):
+        return ( not self.glob or any(fnmatch(rel_path, g) for g in self.glob) )
+
+    def scan_tree(self):
+        if self._tree is None:
+            self._tree = self._scan_dir(self.src_file, '')
+        return self._tree
+
+    def _scan_dir(self, path, rel_path):
+        res = []
+        with os.scandir(path) as it:
+            for de in sorted(it, key=lambda a: a.name):
+                rel = f'{rel_path}/{de.name}' if rel_path else de.name
+                st = de.stat(follow_symlinks=False)
+                if stat.S_ISDIR(st.st_mode):
+                    children = self._scan_dir(de.path, rel)
+                    if children or not self.glob:
+                        res.append((rel, st, children))
+                elif not stat.S_ISREG(st.st_mode) and not stat.S_ISLNK(st.st_mode):
+                    raise ValueError(f'Unsupported file type in copy source: {de.path}')
+                elif self.matches(rel):
+                    res.append((rel, st, None))
+        return res
 
-    def hash(self):
+    @staticmethod
+    def _walk(nodes):
+        for node in nodes:
+            yield node
+            if node[2] is not None:
+                yield from CopyStepEntry._walk(node[2])
+
+    def tree_hash(self, pool: ThreadPoolExecutor = None):
+        if pool is None:
+            with ThreadPoolExecutor(max_workers=DEFAULT_HASH_WORKERS) as pool:
+                return self.tree_hash(pool)
+        nodes = self.scan_tree()
+        files = [ rel for rel, st, _ in self._walk(nodes) if stat.S_ISREG(st.st_mode) ]
+        futures = [ pool.submit(copy_context().run, self.file_hash,
+            os.path.join(self.src_file, rel)) for rel in files ]
+        hashes = { rel: fut.result() for rel, fut in zip(files, futures) }
+
+        def node_hash(node):
+            rel, st, children = node
+            if children is not None:
+                content = [ node_hash(c) for c in children ]
+            elif stat.S_ISLNK(st.st_mode):
+                content = os.readlink(os.path.join(self.src_file, rel))
+            else:
+                content = hashes[rel]
+            return hashlib.sha256(json.dumps(( os.path.basename(rel),
+                stat.S_IFMT(st.st_mode), stat.S_IMODE(st.st_mode),
+                st.st_uid, st.st_gid, content )).encode('utf-8')).hexdigest()
+
+        return hashlib.sha256(json.dumps([ node_hash(n) for n in nodes ]) \
+            .encode('utf-8')).hexdigest()
+
+    def copy_file(self, src_file, dst_fnam):
         if self.use_fenv:
-            with open(self.src_file) as f:
-                s = f.read()
-                s = substitute_focker_env_vars(s, self.fenv)
-                s = s.encode('utf-8')
-                return filehash(io.BytesIO(s))
+            with open(dst_fnam, 'wb') as f:
+                for s in self.iter_substituted(src_file):
+                    f.write(s.encode('utf-8'))
         else:
-            return filehash(self.src_file)
+            fast_copyfile(src_file, dst_fnam)
+
+    def copy_tree(self, dst_dir, max_workers: int = None):
+        def preserve(path, st):
+            os.lchown(path, st.st_uid, st.st_gid)
+            if not stat.S_ISLNK(st.st_mode):
+                os.chmod(path, stat.S_IMODE(st.st_mode))
+
+        os.makedirs(dst_dir, exist_ok=True)
+        nodes = list(self._walk(self.scan_tree()))
+        files = []
+        for rel, st, children in nodes:
+            dst = os.path.join(dst_dir, rel)
+            if children is not None:
+                os.makedirs(dst, exist_ok=True)
+            elif stat.S_ISLNK(st.st_mode):
+                if os.path.lexists(dst):
+                    os.unlink(dst)
+                os.symlink(os.readlink(os.path.join(self.src_file, rel)), dst)
+                preserve(dst, st)
+            else:
+                files.append((rel, st))
 
-    def execute(self, im):
+        def copy_one(rel, st):
+            dst = os.path.join(dst_dir, rel)
+            self.copy_file(os.path.join(self.src_file, rel), dst)
+            preserve(dst, st)
+
+        with ThreadPoolExecutor(max_workers=max_workers or DEFAULT_COPY_WORKERS) as pool:
+            futures = [ pool.submit(copy_context().run, copy_one, rel, st) \
+                for rel, st in files ]
+            for fut in futures:
+                fut.result()
+
+        # Directory modes last, so that read-only ones do not block the copy
+        for rel, st, children in reversed(nodes):
+            if children is not None:
+                preserve(os.path.join(dst_dir, rel), st)
+
+    def execute(self, im, max_workers: int = None):
         dst_fnam = os.path.join(im.path, self.dst_file.strip('/'))
-        os.makedirs(os.path.split(dst_fnam)[0], exist_ok=True)
-        if self.use_fenv:
-            with open(self.src_file) as f_1, \
-                open(dst_fnam, 'wb') as f_2:
-                s = f_1.read()
-                s = substitute_focker_env_vars(s, self.fenv)
-                s = s.encode('utf-8')
-                f_2.write(s)
+        if self.is_dir():
+            self.copy_tree(dst_fnam, max_workers)
         else:
-            shutil.copyfile(self.src_file, dst_fnam)
+            os.makedirs(os.path.split(dst_fnam)[0], exist_ok=True)
+            self.copy_file(self.src_file, dst_fnam)
 
         if 'chmod' in self.options:
             mode = self.options['chmod']
@@ -94,6 +382,8 @@ class CopyStepEntry:
 
 
 class CopyStep(object):
+    kind = 'copy'
+
     def __init__(self, spec, src_dir, fenv):
         if not isinstance(spec, list):
             raise TypeError('CopyStep spec should be a list')
@@ -115,9 +405,27 @@ class CopyStep(object):
             .encode('utf-8')).hexdigest()
         return res
 
-    def execute(self, im, **kwargs):
+    def execute(self, im, max_workers: int = None, **kwargs):
         for e in self.entries:
-            e.execute(im)
+            e.execute(im, max_workers)
+
+
+def prehash_steps(steps, max_workers: int = None):
+    entries = [ e for st in steps if isinstance(st, CopyStep) \
+        for e in st.entries ]
+    if not entries:
+        return
+    max_workers = max_workers or DEFAULT_HASH_WORKERS
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # Trees are walked from this thread and their files hashed in the
+        # same pool, workers never wait on each other
+        trees = [ e for e in entries if e.is_tree() ]
+        futures = [ pool.submit(copy_context().run, e.hash) \
+            for e in entries if not e.is_tree() ]
+        for e in trees:
+            e.hash(pool)
+        for fut in futures:
+            fut.result()
 
 
 def create_step(spec, src_dir, fenv):
@@ -125,6 +433,10 @@ def create_step(spec, src_dir, fenv):
         raise TypeError(f'Step specification must be a dictionary, got: {spec.__class__.__name__} ({spec})')
     if 'copy' in spec:
         return CopyStep(spec['copy'], src_dir=src_dir, fenv=fenv)
+    elif 'parallel' in spec:
+        return ParallelStep(spec['parallel'], src_dir=src_dir, fenv=fenv,
+            jobs=spec.get('jobs'))
     elif 'run' in spec:
-        return RunStep(spec['run'], src_dir=src_dir, fenv=fenv)
+        return RunStep(spec['run'], src_dir=src_dir, fenv=fenv,
+            cache=spec.get('cache'), scratch=spec.get('scratch'))
     raise ValueError('Unrecognized step spec: ' + json.dumps(spec))
@@ -0,0 +1,95 @@
+#
+# Copyright (C) Stanislaw Adaszewski, 2020-2021
+# License: GNU General Public License v3.0
+# URL: https://github.com/sadaszewski/focker
+# URL: https://adared.ch/focker
+#
+
+
+from ..zfs import zfs_nicenum
+import json
+import sys
+import time
+from typing import Dict
+
+
+class TraceSink:
+    def __init__(self, f=None):
+        self.f = f or sys.stdout
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excinfo):
+        self.close()
+
+    def emit(self, event: Dict):
+        raise NotImplementedError
+
+    def close(self):
+        if self.f not in (sys.stdout, sys.stderr):
+            self.f.close()
+
+
+class JsonLinesTraceSink(TraceSink):
+    def emit(self, event: Dict):
+        self.f.write(json.dumps(event) + '\n')
+        self.f.flush()
+
+
+class HumanTraceSink(TraceSink):
+    def __init__(self, f=None):
+        super().__init__(f)
+        self.t_0 = None
+
+    def format(self, event: Dict) -> str:
+        ev = event['event']
+        layer = f'layer {event["layer"] + 1}: ' if 'layer' in event else ''
+        if ev == 'build_start':
+            return f'Building {event["focker_dir"]}'
+        elif ev == 'plan':
+            return f'Plan: {event["layers"]} layer(s) on top of {event["base"]}, ' \
+                f'{event["cached"]} cached, cache hit ratio {event["hit_ratio"]:.0%}'
+        elif ev in ('cache_hit', 'cache_miss'):
+            return f'{layer}cache {ev[6:]} for {event["sha256"][:12]}'
+        elif ev == 'clone':
+            return f'{layer}cloned {event["name"]} from {event["origin"]}'
+        elif ev == 'resume':
+            return f'{layer}resumed {event["name"]} after {event["done"]} step(s)'
+        elif ev == 'step_start':
+            return f'{layer}step {event["step"] + 1} ({event["kind"]}) started'
+        elif ev == 'step_end':
+            return f'{layer}step {event["step"] + 1} ({event["kind"]}) done in {event["duration"]:.2f}s'
+        elif ev == 'step_error':
+            return f'{layer}step {event["step"] + 1} ({event["kind"]}) failed after ' \
+                f'{event["duration"]:.2f}s: {event["error"]}'
+        elif ev == 'finalize':
+            return f'{layer}finalized {event["name"]} in {event["duration"]:.2f}s, ' \
+                f'used {zfs_nicenum(event["used"])}, written {zfs_nicenum(event["written"])}'
+        elif ev == 'build_end':
+            return f'Built {event["name"]} in {event["duration"]:.2f}s'
+        return f'{layer}{ev}'
+
+    def emit(self, event: Dict):
+        if self.t_0 is None:
+            self.t_0 = event['time']
+        self.f.write(f'[{event["time"] - self.t_0:8.2f}s] {self.format(event)}\n')
+        self.f.flush()
+
+
+TRACE_FORMATS = {
+    'json': JsonLinesTraceSink,
+    'human': HumanTraceSink
+}
+
+
+def open_trace_sink(fname: str, fmt: str = 'json') -> TraceSink:
+    if fmt not in TRACE_FORMATS:
+        raise ValueError(f'Unknown trace format: {fmt}')
+    f = sys.stdout if fname == '-' else open(fname, 'w')
+    return TRACE_FORMATS[fmt](f)
+
+
+def trace_event(sink: TraceSink, event: str, **kwargs):
+    if sink is not None:
+        sink.emit(dict(event=event, time=time.time(), **kwargs))
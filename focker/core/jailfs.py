@@ -14,7 +14,7 @@ from .process import focker_subprocess_check_output
 from .misc import ensure_list
 from .osjail import OSJail
 import json
-from ..misc import load_jailconf
+from ..misc import jailconf_store
 
 
 JailFs = 'JailFs'
@@ -27,11 +27,10 @@ class JailFs(Dataset):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
-    def destroy(self, force=False):
+    def before_destroy(self):
         jail = OSJail.from_mountpoint(self.path, raise_exc=False)
         if jail is not None:
             jail.remove()
-        super().destroy(force=force)
 
     @property
     def jid(self):
@@ -42,13 +41,8 @@ class JailFs(Dataset):
 
     @staticmethod
     def list_unused():
-        conf = load_jailconf()
-        used = set()
-        for k, v in conf.items():
-            for jname in v.get('depend', []):
-                if jname not in conf:
-                    continue
-                used.add(conf[jname]['path'])
+        store = jailconf_store()
+        used = set(store[jname]['path'] for jname in store.depended_on())
         lst = zfs_list(['name', 'mountpoint'], focker_type='jail')
         lst = [ JailFs.from_name(item[0]) for item in lst if item[1] not in used ]
         return lst
@@ -0,0 +1,168 @@
+#
+# Copyright (C) Stanislaw Adaszewski, 2020-2021
+# License: GNU General Public License v3.0
+# URL: https://github.com/sadaszewski/focker
+# URL: https://adared.ch/focker
+#
+
+
+from .osjail import OSJail
+from ..misc import jailconf_store
+from concurrent.futures import ThreadPoolExecutor, \
+    FIRST_COMPLETED, \
+    wait
+from contextvars import copy_context
+from subprocess import CalledProcessError, \
+    PIPE, \
+    STDOUT
+from typing import Callable, \
+    Dict, \
+    Iterable, \
+    List
+import os
+import time
+
+
+DEFAULT_JAIL_JOBS = os.cpu_count() or 1
+
+
+class JailTaskResult:
+    def __init__(self, name: str, status: str, duration: float = 0.0,
+        error: str = None):
+
+        self.name = name
+        self.status = status
+        self.duration = duration
+        self.error = error
+
+    def __repr__(self):
+        return f'JailTaskResult({self.name!r}, {self.status!r}, {self.duration:.2f})'
+
+
+JailScheduler = 'JailScheduler'
+
+class JailScheduler:
+    def __init__(self, depend: Dict[str, Iterable[str]], jobs: int = None):
+        self.names = sorted(depend)
+        self.depend = { name: sorted(set(d for d in deps if d in depend and d != name)) \
+            for name, deps in depend.items() }
+        self.dependents = { name: [] for name in self.names }
+        for name in self.names:
+            for dep in self.depend[name]:
+                self.dependents[dep].append(name)
+        self.jobs = jobs or DEFAULT_JAIL_JOBS
+
+    @classmethod
+    def from_jailconf(cls, names: Iterable[str], closure: bool = False,
+        dependents: bool = False, jobs: int = None) -> JailScheduler:
+
+        store = jailconf_store()
+        names = list(names)
+        if closure:
+            names = [ n for name in names for n in store.closure(name) ]
+        if dependents:
+            names = [ n for name in names for n in store.reverse_closure(name) ]
+        return cls({ name: store.dependencies(name) for name in names }, jobs=jobs)
+
+    def _edges(self, reverse: bool):
+        if reverse:
+            return self.dependents, self.depend
+        return self.depend, self.dependents
+
+    def batches(self, reverse: bool = False) -> List[List[str]]:
+        prereqs, followers = self._edges(reverse)
+        waiting = { name: len(prereqs[name]) for name in self.names }
+        batch = [ name for name in self.names if waiting[name] == 0 ]
+        res = []
+        while batch:
+            res.append(batch)
+            nxt = []
+            for name in batch:
+                for f in followers[name]:
+                    waiting[f] -= 1
+                    if waiting[f] == 0:
+                        nxt.append(f)
+            batch = sorted(nxt)
+        if sum(len(b) for b in res) != len(self.names):
+            cycle = sorted(name for name in self.names if waiting[name] > 0)
+            raise ValueError(f'Dependency cycle between jails: {", ".join(cycle)}')
+        return res
+
+    def run(self, fn: Callable[[str], str], reverse: bool = False,
+        callback: Callable[[JailTaskResult], None] = None) -> Dict[str, JailTaskResult]:
+
+        self.batches(reverse)
+        prereqs, followers = self._edges(reverse)
+        waiting = { name: len(prereqs[name]) for name in self.names }
+        ready = [ name for name in self.names if waiting[name] == 0 ]
+        results = {}
+
+        def finish(res):
+            results[res.name] = res
+            if callback is not None:
+                callback(res)
+            for f in followers[res.name]:
+                if f in results:
+                    continue
+                if res.status in ('failed', 'skipped'):
+                    finish(JailTaskResult(f, 'skipped',
+                        error=f'{res.name} {res.status}'))
+                else:
+                    waiting[f] -= 1
+                    if waiting[f] == 0:
+                        ready.append(f)
+
+        def run_one(name):
+            t_0 = time.monotonic()
+            try:
+                status = fn(name)
+            except CalledProcessError as e:
+                output = e.output.decode('utf-8', 'replace').strip() \
+                    if isinstance(e.output, bytes) else ''
+                return JailTaskResult(name, 'failed', time.monotonic() - t_0,
+                    output or str(e))
+            except Exception as e:
+                return JailTaskResult(name, 'failed', time.monotonic() - t_0, str(e))
+            return JailTaskResult(name, status or 'ok', time.monotonic() - t_0)
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            running = set()
+            while ready or running:
+                while ready and len(running) < self.jobs:
+                    name = ready.pop(0)
+                    if name not in results:
+                        running.add(pool.submit(copy_context().run, run_one, name))
+                if not running:
+                    continue
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for fut in sorted(done, key=lambda a: a.result().name):
+                    finish(fut.result())
+        return results
+
+
+def _start_one(name: str):
+    j = OSJail.from_name(name)
+    if j.is_running:
+        return 'noop'
+    j.start(stdout=PIPE, stderr=STDOUT)
+
+
+def _stop_one(name: str):
+    j = OSJail.from_name(name)
+    if not j.is_running:
+        return 'noop'
+    j.stop(stdout=PIPE, stderr=STDOUT)
+
+
+def parallel_start_jails(names: Iterable[str], jobs: int = None,
+    callback: Callable[[JailTaskResult], None] = None) -> Dict[str, JailTaskResult]:
+
+    sched = JailScheduler.from_jailconf(names, closure=True, jobs=jobs)
+    return sched.run(_start_one, callback=callback)
+
+
+def parallel_stop_jails(names: Iterable[str], jobs: int = None,
+    callback: Callable[[JailTaskResult], None] = None) -> Dict[str, JailTaskResult]:
+
+    sched = JailScheduler.from_jailconf(names, dependents=True, jobs=jobs)
+    return sched.run(_stop_one, reverse=True, callback=callback)
@@ -9,7 +9,8 @@
 from .constant import JAIL_FOCKER_PARAMS, \
     JAIL_EXEC_PARAMS, \
     JAIL_PARAMS
-from ..mount import MountSpec
+from ..mount import MountSpec, \
+    scratch_mount_specs
 from ..misc import ensure_list
 from ...misc import merge_dicts
 from ..config import FOCKER_CONFIG
@@ -80,6 +81,7 @@ class JailSpec:
 
         mounts = focker_spec.get('mounts', {})
         mounts = [ MountSpec(k, v) for k, v in mounts.items() ]
+        mounts += scratch_mount_specs(focker_spec.get('scratch', []))
         env = focker_spec.get('env', {})
         resolv_conf = focker_spec.get('resolv_conf', 'system')
 
@@ -7,7 +7,8 @@
 
 
 from .process import focker_subprocess_check_output
-from typing import Union
+from typing import List, \
+    Union
 import os
 
 
@@ -20,15 +21,49 @@ class Mount:
         self.mountpoint = mountpoint if isinstance(mountpoint, str) else mountpoint.path
         self.fs_type = fs_type
 
+    def mount(self):
+        os.makedirs(self.mountpoint, exist_ok=True)
+        focker_subprocess_check_output([ 'mount', '-t', self.fs_type,
+            self.source, self.mountpoint ])
+
+    def unmount(self):
+        focker_subprocess_check_output([ 'umount', '-f', self.mountpoint ])
+
 
 class MountSpec:
-    def __init__(self, source_spec, mountpoint_spec):
+    def __init__(self, source_spec, mountpoint_spec, fs_type='nullfs'):
         self.source_spec = source_spec
         self.mountpoint_spec = mountpoint_spec
+        self.fs_type = fs_type
+
+
+def scratch_mount_specs(paths) -> List[MountSpec]:
+    if isinstance(paths, str):
+        paths = [ paths ]
+    if not isinstance(paths, list):
+        raise TypeError('Scratch paths must be a list or a string')
+    return [ MountSpec('tmpfs', p, fs_type='tmpfs') for p in paths ]
+
+
+def scratch_paths(specs: List[MountSpec]) -> List[str]:
+    return sorted(set('/' + os.path.normpath(m.mountpoint_spec).strip('/') \
+        for m in specs))
+
+
+def resolve_mountpoint(path: str, mountpoint_spec: str) -> str:
+    # Symlinks inside the image must not redirect mounts onto the host
+    root = os.path.realpath(path)
+    res = os.path.realpath(os.path.join(root, mountpoint_spec.strip('/')))
+    if res != root and not res.startswith(root + os.sep):
+        raise ValueError(f'Mount point points outside of the image: {mountpoint_spec}')
+    return res
 
 
 def mount_from_spec(spec: MountSpec, path: str) -> Mount:
-    mountpoint = os.path.join(path, spec.mountpoint_spec.strip('/'))
+    mountpoint = resolve_mountpoint(path, spec.mountpoint_spec)
+
+    if spec.fs_type != 'nullfs':
+        return Mount(spec.source_spec, mountpoint, fs_type=spec.fs_type)
 
     if spec.source_spec.startswith('/'):
         return Mount(spec.source_spec, mountpoint)
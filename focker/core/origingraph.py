@@ -0,0 +1,167 @@
+#
+# Copyright (C) Stanislaw Adaszewski, 2020-2021
+# License: GNU General Public License v3.0
+# URL: https://github.com/sadaszewski/focker
+# URL: https://adared.ch/focker
+#
+
+
+from .zfs import zfs_parse_output
+from collections import defaultdict
+import heapq
+from typing import Iterable, \
+    List
+
+
+OriginGraph = 'OriginGraph'
+
+class OriginGraph:
+    def __init__(self):
+        self.focker_type = {}
+        self.origin = {}
+        self.tags = {}
+        self.sha256 = {}
+        self.mountpoint = {}
+        self.used = {}
+        self.last_used = {}
+        self.protected = set()
+        self.children = defaultdict(set)
+
+    @classmethod
+    def from_zfs(cls) -> OriginGraph:
+        from .config import FOCKER_CONFIG
+        root = FOCKER_CONFIG.zfs.root_dataset
+        lst = zfs_parse_output([ 'zfs', 'list', '-H', '-p', '-t', 'filesystem', '-d', '2',
+            '-o', 'name,origin,focker:tags,focker:sha256,mountpoint,used,creation,focker:last_used,focker:protect',
+            root ])
+        res = cls()
+        for name, origin, tags, sha256, mountpoint, used, creation, last_used, protect in lst:
+            parent = '/'.join(name.split('/')[:-1])
+            if sha256 == '-' or not parent.startswith(root + '/'):
+                continue
+            focker_type = parent[len(root) + 1:-1]
+            origin = origin.split('@')[0] if origin != '-' else None
+            if last_used == '-':
+                last_used = creation
+            res.add(name, focker_type, origin, tags.split(' '), sha256, mountpoint,
+                used=int(used) if used.isdigit() else 0,
+                last_used=int(last_used) if last_used.isdigit() else 0,
+                protected=(protect != '-'))
+        return res
+
+    def __contains__(self, name: str):
+        return name in self.focker_type
+
+    def add(self, name: str, focker_type: str, origin: str = None,
+        tags: Iterable[str] = [], sha256: str = None, mountpoint: str = None,
+        used: int = 0, last_used: int = 0, protected: bool = False):
+
+        self.focker_type[name] = focker_type
+        self.origin[name] = origin
+        self.tags[name] = set(t for t in tags if t != '-')
+        self.sha256[name] = sha256
+        self.mountpoint[name] = mountpoint
+        self.used[name] = used
+        self.last_used[name] = last_used
+        if protected:
+            self.protected.add(name)
+        if origin is not None:
+            self.children[origin].add(name)
+
+    def remove(self, name: str):
+        if self.children.get(name):
+            raise RuntimeError(f'{name} has dependent clones')
+        origin = self.origin.pop(name)
+        if origin is not None:
+            self.children[origin].discard(name)
+        del self.focker_type[name]
+        del self.tags[name]
+        del self.sha256[name]
+        del self.mountpoint[name]
+        del self.used[name]
+        del self.last_used[name]
+        self.protected.discard(name)
+        self.children.pop(name, None)
+
+    def refcount(self, name: str) -> int:
+        return len(self.children.get(name, ()))
+
+    def in_use(self, name: str) -> bool:
+        return ( self.refcount(name) > 0 )
+
+    def unused(self, focker_type: str) -> List[str]:
+        return [ name for name, ft in self.focker_type.items() \
+            if ft == focker_type and not self.in_use(name) ]
+
+    def is_kept(self, name: str) -> bool:
+        return ( bool(self.tags[name]) or name in self.protected )
+
+    def prune_batches(self, focker_type: str = 'image') -> List[List[str]]:
+        def prunable(name):
+            return ( self.focker_type.get(name) == focker_type and \
+                not self.is_kept(name) )
+        refcount = { name: self.refcount(name) for name in self.focker_type }
+        batch = sorted(name for name, cnt in refcount.items() \
+            if cnt == 0 and prunable(name))
+        res = []
+        while batch:
+            res.append(batch)
+            nxt = []
+            for name in batch:
+                origin = self.origin[name]
+                if origin is None or origin not in refcount:
+                    continue
+                refcount[origin] -= 1
+                if refcount[origin] == 0 and prunable(origin):
+                    nxt.append(origin)
+            batch = sorted(nxt)
+        return res
+
+    def prune_order(self, focker_type: str = 'image') -> List[str]:
+        return [ name for batch in self.prune_batches(focker_type) \
+            for name in batch ]
+
+    def evict_order(self, focker_type: str = 'image', max_size: int = None,
+        keep_recent: int = 0) -> List[str]:
+
+        # Kept images are never evicted, they do not count as recent ones
+        recent = sorted((name for name, ft in self.focker_type.items() \
+            if ft == focker_type and not self.is_kept(name)),
+            key=lambda a: self.last_used[a], reverse=True)
+        keep = set(recent[:keep_recent])
+        def evictable(name):
+            return ( self.focker_type.get(name) == focker_type and \
+                not self.is_kept(name) and name not in keep )
+        total = sum(self.used[name] for name, ft in self.focker_type.items() \
+            if ft == focker_type)
+        refcount = { name: self.refcount(name) for name in self.focker_type }
+        heap = [ (self.last_used[name], name) for name, cnt in refcount.items() \
+            if cnt == 0 and evictable(name) ]
+        heapq.heapify(heap)
+        res = []
+        while heap and ( max_size is None or total > max_size ):
+            _, name = heapq.heappop(heap)
+            res.append(name)
+            total -= self.used[name]
+            origin = self.origin[name]
+            if origin is None or origin not in refcount:
+                continue
+            refcount[origin] -= 1
+            if refcount[origin] == 0 and evictable(origin):
+                heapq.heappush(heap, (self.last_used[origin], origin))
+        return res
+
+    def batches(self, order: List[str]) -> List[List[str]]:
+        res = []
+        batch = []
+        origins = set()
+        for name in order:
+            if name in origins:
+                res.append(batch)
+                batch = []
+                origins = set()
+            batch.append(name)
+            origins.add(self.origin[name])
+        if batch:
+            res.append(batch)
+        return res
@@ -18,8 +18,6 @@ from typing import Dict
 import subprocess
 from ..cache import JlsCache
 import tempfile
-from ...jailconf import JailConf, \
-    JailBlock
 
 
 OSJail = 'OSJail'
@@ -42,10 +40,9 @@ class OSJail:
 
     @classmethod
     def from_mountpoint(cls, path, raise_exc=True):
-        conf = load_jailconf()
-        for k, blk in conf.items():
-            if 'path' in blk and blk['path'] == path:
-                return OSJail(init_key=cls._init_key, name=k)
+        names = jailconf_find_by_path(path)
+        if names:
+            return OSJail(init_key=cls._init_key, name=names[0])
         if raise_exc:
             raise RuntimeError('OSJail with the given mountpoint not found')
         else:
@@ -92,26 +89,29 @@ class OSJail:
                 cmd.append(f'{k}={v}')
         return cmd
 
+    def render_conf(self, stop: bool = False):
+        if stop:
+            return jailconf_render(jailconf_stop_closure(name=self.name))
+        return jailconf_render(jailconf_closure(name=self.name))
+
     def start(self, **kwargs):
-        jc = JailConf()
-        for k, v in load_jailconf().items():
-            jc[k] = JailBlock.create(k, v)
         cmd = [ 'jail', '-f', '-', '-c', self.name ]
-        focker_subprocess_run(cmd, input=str(jc).encode('utf-8'), **kwargs)
+        focker_subprocess_run(cmd, input=self.render_conf().encode('utf-8'), **kwargs)
 
     def stop(self, **kwargs):
-        jc = JailConf()
-        for k, v in load_jailconf().items():
-            jc[k] = JailBlock.create(k, v)
         cmd = [ 'jail', '-f', '-', '-r', self.name ]
-        focker_subprocess_run(cmd, input=str(jc).encode('utf-8'), **kwargs)
+        focker_subprocess_run(cmd, input=self.render_conf(stop=True).encode('utf-8'), **kwargs)
 
-    def jexec(self, cmd, wrapper, *args, **kwargs):
+    def jexec_command(self, cmd):
         final_cmd = []
         fib = self.exec_fib
         if fib is not None:
             final_cmd.extend([ 'setfib', str(fib) ])
         final_cmd.extend([ 'jexec', self.name, '/bin/sh', '-c', ' '.join([ shlex.quote(c) for c in cmd ]) ])
+        return final_cmd
+
+    def jexec(self, cmd, wrapper, *args, **kwargs):
+        final_cmd = self.jexec_command(cmd)
         with focker_unlock():
             return wrapper(final_cmd, *args, **kwargs)
 
@@ -0,0 +1,59 @@
+#
+# Copyright (C) Stanislaw Adaszewski, 2020-2021
+# License: GNU General Public License v3.0
+# URL: https://github.com/sadaszewski/focker
+# URL: https://adared.ch/focker
+#
+
+
+from bisect import bisect_left
+from typing import Any, \
+    Iterable, \
+    List, \
+    Tuple
+
+
+class PrefixIndex:
+    def __init__(self, items: Iterable[Tuple[str, Any]] = []):
+        self.entries = sorted(items, key=lambda a: a[0])
+        self.keys = [ k for k, _ in self.entries ]
+
+    @classmethod
+    def from_keys(cls, keys: Iterable[str]):
+        return cls((k, None) for k in keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key: str):
+        i = bisect_left(self.keys, key)
+        return ( i < len(self.keys) and self.keys[i] == key )
+
+    def add(self, key: str, value: Any = None):
+        i = bisect_left(self.keys, key)
+        self.keys.insert(i, key)
+        self.entries.insert(i, (key, value))
+
+    def remove(self, key: str, value: Any = None):
+        i = bisect_left(self.keys, key)
+        while i < len(self.keys) and self.keys[i] == key:
+            if value is None or self.entries[i][1] == value:
+                del self.keys[i]
+                del self.entries[i]
+                return
+            i += 1
+        raise KeyError(key)
+
+    def find_prefix(self, prefix: str) -> List[Tuple[str, Any]]:
+        i = bisect_left(self.keys, prefix)
+        res = []
+        while i < len(self.keys) and self.keys[i].startswith(prefix):
+            res.append(self.entries[i])
+            i += 1
+        return res
+
+    def shortest_unique(self, key: str, min_len: int = 7) -> str:
+        for pre in range(min_len, len(key) + 1):
+            if key[:pre] not in self:
+                return key[:pre]
+        return key
@@ -16,3 +16,7 @@ def focker_subprocess_run(command, *args, check=True, **kwargs):
 
 def focker_subprocess_check_output(command, *args, **kwargs):
     return subprocess.check_output(command, *args, **kwargs)
+
+
+def focker_subprocess_popen(command, *args, **kwargs):
+    return subprocess.Popen(command, *args, **kwargs)
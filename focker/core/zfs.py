@@ -6,29 +6,32 @@
 #
 
 
-from .process import focker_subprocess_check_output, \
-    focker_subprocess_run
+from .zfsbackend import ZfsBatch, \
+    zfs_backend
+from .prefixindex import PrefixIndex
 from typing import Dict, \
-    Tuple
+    List, \
+    Tuple, \
+    Union
 import subprocess
-import io
-import csv
 import os
 from functools import reduce
+from concurrent.futures import ThreadPoolExecutor, \
+    as_completed
+from contextvars import copy_context
 import random
-from collections import defaultdict
+
+
+DEFAULT_DESTROY_WORKERS = 4
 
 
 def zfs_run(command):
-    out = focker_subprocess_check_output(command, stderr=subprocess.STDOUT)
+    out = zfs_backend().run(command)
     return out
 
 
 def zfs_parse_output(command):
-    out = focker_subprocess_check_output(command, stderr=subprocess.STDOUT)
-    s = io.StringIO(out.decode('utf-8'))
-    r = csv.reader(s, delimiter='\t')
-    return [ a for a in r ]
+    return zfs_backend().parse_output(command)
 
 
 def zfs_poolname():
@@ -47,8 +50,8 @@ def zfs_exists(name):
     return True
 
 
-def zfs_create(name, props={}, exist_ok=False):
-    if zfs_exists(name):
+def zfs_create(name, props={}, exist_ok=False, check_exists=True):
+    if check_exists and zfs_exists(name):
         if exist_ok:
             return
         else:
@@ -57,7 +60,7 @@ def zfs_create(name, props={}, exist_ok=False):
     props = reduce(list.__add__, props, [])
     cmd = [ 'zfs', 'create', *props, name ]
     # print('cmd:', cmd)
-    focker_subprocess_run(cmd)
+    zfs_run(cmd)
 
 
 def zfs_init():
@@ -107,12 +110,18 @@ def zfs_untag(tags, focker_type='image'):
     lst = zfs_parse_output(['zfs', 'list', '-o', 'name,focker:tags', '-H', '-r',
         FOCKER_CONFIG.zfs.root_dataset + '/' + focker_type + 's'])
     lst = filter(lambda a: any([b in a[1].split(' ') for b in tags]), lst)
-    for row in lst:
-        cur_tags = row[1].split(' ')
-        for t in tags:
-            if t in cur_tags:
-                cur_tags.remove(t)
-        zfs_tag(row[0], cur_tags, replace=True)
+    with ZfsBatch() as batch:
+        for row in lst:
+            cur_tags = row[1].split(' ')
+            cur_tags = [ t for t in cur_tags if t not in tags and t != '-' ]
+            if cur_tags:
+                batch.set_props(row[0], { 'focker:tags': ' '.join(cur_tags) })
+            else:
+                batch.inherit(row[0], 'focker:tags')
+
+
+def zfs_retag(name, tags, focker_type='image'):
+    zfs_backend().retag(name, tags, focker_type)
 
 
 def zfs_destroy(name):
@@ -122,6 +131,41 @@ def zfs_destroy(name):
     zfs_run(['zfs', 'destroy', '-r', '-f', name])
 
 
+def zfs_destroy_snapshots(name: str, snapshots: List[str]):
+    if not snapshots:
+        return
+    zfs_run(['zfs', 'destroy', name + '@' + ','.join(snapshots)])
+
+
+def zfs_check_unprotected(names: List[str]) -> Dict[str, int]:
+    if not names:
+        return {}
+    lst = zfs_parse_output(['zfs', 'get', '-H', '-p', '-o', 'name,property,value',
+        'focker:protect,used', *names])
+    used = {}
+    for name, propname, value in lst:
+        if propname == 'focker:protect' and value != '-':
+            raise RuntimeError('%s is protected against removal' % name)
+        if propname == 'used':
+            used[name] = int(value)
+    return used
+
+
+def zfs_destroy_many(names: List[str], max_workers: int = None, callback=None):
+    max_workers = max_workers or DEFAULT_DESTROY_WORKERS
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = { pool.submit(copy_context().run, zfs_run,
+            ['zfs', 'destroy', '-r', '-f', name]): name for name in names }
+        for fut in as_completed(futures):
+            if fut.exception() is not None:
+                errors.append(fut.exception())
+            elif callback is not None:
+                callback(futures[fut])
+    if errors:
+        raise errors[0]
+
+
 def zfs_protect(name):
     zfs_run(['zfs', 'set', 'focker:protect=on', name])
 
@@ -136,6 +180,12 @@ def zfs_get_property(name, prop_name):
     return lst[0][2]
 
 
+def zfs_get_numeric(name, props: List[str]) -> Dict[str, int]:
+    lst = zfs_parse_output([ 'zfs', 'get', '-H', '-p', '-o', 'property,value',
+        ','.join(props), name ])
+    return { k: int(v) if v.isdigit() else 0 for k, v, *_ in lst }
+
+
 def zfs_clone(name, target_name, props={}):
     cmd = [ 'zfs', 'clone' ]
     for k, v in props.items():
@@ -145,6 +195,10 @@ def zfs_clone(name, target_name, props={}):
     zfs_run(cmd)
 
 
+def zfs_rename(name, new_name):
+    zfs_run(['zfs', 'rename', name, new_name])
+
+
 def zfs_mountpoint(name):
     lst = zfs_parse_output(['zfs', 'list', '-o', 'mountpoint', '-H', name])
     return lst[0][0]
@@ -165,19 +219,59 @@ def zfs_exists_props(props: Dict[str, str], focker_type: str, zfs_type: str) ->
     return ( len(lst) > 0 )
 
 
-def zfs_find_prefix(head, tail):
+def zfs_children_index(parent: str) -> PrefixIndex:
+    lst = zfs_parse_output(['zfs', 'list', '-H', '-o', 'name', '-d', '1', parent])
+    head = parent + '/'
+    return PrefixIndex.from_keys(name[len(head):] for name, *_ in lst \
+        if name.startswith(head))
+
+
+def zfs_find_prefix(head, tail, index: PrefixIndex = None):
     assert len(tail) > 7
-    for pre in range(7, len(tail) + 1):
-        name = head + tail[:pre]
-        if not zfs_exists(name):
-            break
-    return name
+    if index is None:
+        index = zfs_children_index(head.rstrip('/'))
+    return head + index.shortest_unique(tail, 7)
 
 
-def zfs_shortest_unique_name(name: str, focker_type: str) -> str:
+def zfs_shortest_unique_name(name: str, focker_type: str,
+    index: PrefixIndex = None) -> str:
     from .config import FOCKER_CONFIG
     head = f'{FOCKER_CONFIG.zfs.root_dataset}/{focker_type}s/'
-    return zfs_find_prefix(head, name)
+    return zfs_find_prefix(head, name, index)
+
+
+def zfs_probe_unique_name(sha256: str, focker_type: str):
+    return zfs_backend().probe_unique_name(sha256, focker_type)
+
+
+def zfs_nicenum(num: int) -> str:
+    n = num
+    index = 0
+    while n >= 1024 and index < 6:
+        n //= 1024
+        index += 1
+    unit = 'BKMGTPE'[index]
+    if index == 0 or num % (1024 ** index) == 0:
+        return f'{n}{unit}'
+    for prec in [ 2, 1, 0 ]:
+        res = f'{num / 1024 ** index:.{prec}f}{unit}'
+        if len(res) <= 5:
+            break
+    return res
+
+
+def zfs_nicestrtonum(size: str) -> int:
+    s = size.strip().upper()
+    if s.endswith('B'):
+        s = s[:-1]
+    mult = 1
+    if s and s[-1] in 'KMGTPE':
+        mult = 1024 ** ( 'KMGTPE'.index(s[-1]) + 1 )
+        s = s[:-1]
+    try:
+        return int(float(s) * mult)
+    except ValueError:
+        raise ValueError(f'Invalid size: {size}')
 
 
 def random_sha256_hexdigest():
@@ -189,8 +283,8 @@ def random_sha256_hexdigest():
 
 
 def zfs_set_props(name, props):
-    for (k, v) in props.items():
-        zfs_run(['zfs', 'set', k + '=' + v, name])
+    with ZfsBatch() as batch:
+        batch.set_props(name, props)
 
 
 def zfs_snapshot(name):
@@ -204,13 +298,11 @@ def zfs_rollback(name, force=False):
         zfs_run(['zfs', 'rollback', name])
 
 
-def zfs_properties_cache(focker_type: str = None):
+def zfs_properties_cache(focker_type: Union[str, List[str]] = None):
     from .config import FOCKER_CONFIG
-    cmd = [ 'zfs', 'get', '-r', '-H', 'all' ]
-    if focker_type is not None:
-        cmd.append(f'{FOCKER_CONFIG.zfs.root_dataset}/{focker_type}s')
-    lst = zfs_parse_output(cmd)
-    res = defaultdict(lambda: {})
-    for (name, propname, propvalue, *_) in lst:
-        res[name][propname] = propvalue
-    return res
+    if focker_type is None:
+        focker_type = []
+    elif isinstance(focker_type, str):
+        focker_type = [ focker_type ]
+    roots = [ f'{FOCKER_CONFIG.zfs.root_dataset}/{ft}s' for ft in focker_type ]
+    return zfs_backend().properties_cache(roots)
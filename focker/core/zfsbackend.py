@@ -0,0 +1,650 @@
+#
+# Copyright (C) Stanislaw Adaszewski, 2020-2021
+# License: GNU General Public License v3.0
+# URL: https://github.com/sadaszewski/focker
+# URL: https://adared.ch/focker
+#
+
+
+from .process import focker_subprocess_check_output, \
+    CalledProcessError
+from contextvars import ContextVar
+from collections import defaultdict
+from typing import Dict, \
+    List
+import subprocess
+import threading
+import io
+import csv
+import json
+
+
+ZFS_BACKEND = ContextVar('ZFS_BACKEND', default=None)
+
+
+class ZfsBackend:
+    def __init__(self):
+        self.tok = None
+
+    def __enter__(self):
+        self.tok = ZFS_BACKEND.set(self)
+        return self
+
+    def __exit__(self, *excinfo):
+        ZFS_BACKEND.reset(self.tok)
+        self.tok = None
+
+    def run(self, command: List[str], input: bytes = None) -> bytes:
+        raise NotImplementedError
+
+    def parse_output(self, command: List[str], input: bytes = None) -> List[List[str]]:
+        out = self.run(command, input=input)
+        s = io.StringIO(out.decode('utf-8'))
+        r = csv.reader(s, delimiter='\t')
+        return [ a for a in r ]
+
+    def properties_cache(self, roots: List[str] = []) -> Dict[str, Dict[str, str]]:
+        lst = self.parse_output([ 'zfs', 'get', '-r', '-H', 'all', *roots ])
+        res = defaultdict(lambda: {})
+        for (name, propname, propvalue, *_) in lst:
+            res[name][propname] = propvalue
+        for props in res.values():
+            if 'readonly' in props:
+                props['rdonly'] = props['readonly']
+        return res
+
+    def probe_unique_name(self, sha256: str, focker_type: str):
+        from .config import FOCKER_CONFIG
+        from .prefixindex import PrefixIndex
+        assert len(sha256) > 7
+        parent = f'{FOCKER_CONFIG.zfs.root_dataset}/{focker_type}s'
+        lst = self.parse_output([ 'zfs', 'list', '-H', '-o', 'name,focker:sha256',
+            '-d', '1', parent ])
+        if any(sha == sha256 for _, sha in lst):
+            return None
+        index = PrefixIndex.from_keys(name[len(parent) + 1:] \
+            for name, _ in lst if name != parent)
+        return f'{parent}/{index.shortest_unique(sha256, 7)}', None
+
+    def retag(self, name: str, tags: List[str], focker_type: str):
+        from .zfs import zfs_untag, \
+            zfs_tag
+        zfs_untag(tags, focker_type=focker_type)
+        if name is not None:
+            zfs_tag(name, tags)
+
+
+class SubprocessZfsBackend(ZfsBackend):
+    def run(self, command, input=None):
+        return focker_subprocess_check_output(command, input=input,
+            stderr=subprocess.STDOUT)
+
+
+_DEFAULT_ZFS_BACKEND = None
+
+
+def default_zfs_backend() -> ZfsBackend:
+    from ..misc import load_overrides
+    conf = load_overrides('focker.conf', env_prefix='FOCKER_CONF_')
+    backend = conf.get('zfs_backend', 'subprocess')
+    if backend == 'subprocess':
+        return SubprocessZfsBackend()
+    elif backend == 'channel_program':
+        from .zfsprogram import ChannelProgramZfsBackend
+        return ChannelProgramZfsBackend()
+    raise ValueError(f'Unsupported ZFS backend: {backend}')
+
+
+def zfs_backend() -> ZfsBackend:
+    global _DEFAULT_ZFS_BACKEND
+    res = ZFS_BACKEND.get()
+    if res is not None:
+        return res
+    if _DEFAULT_ZFS_BACKEND is None:
+        _DEFAULT_ZFS_BACKEND = default_zfs_backend()
+    return _DEFAULT_ZFS_BACKEND
+
+
+#
+# In-memory backend
+#
+
+_STUB_INHERITABLE = { 'mountpoint', 'readonly', 'canmount' }
+
+_STUB_ALIASES = { 'rdonly': 'readonly' }
+
+_STUB_NUMERIC = { 'used', 'referenced', 'written' }
+
+_STUB_DEFAULTS = { 'readonly': 'off', 'canmount': 'on', 'used': '0',
+    'referenced': '0', 'written': '0' }
+
+
+#
+# Channel programs are executed with a real Lua interpreter (lupa),
+# against a zfs table backed by the in-memory datasets below.
+#
+
+_STUB_LUA_ZFS = '''
+local api = ...
+
+local function iter(lst)
+    local i = 0
+    return function()
+        i = i + 1
+        if lst[i] ~= nil then
+            return table.unpack(lst[i])
+        end
+    end
+end
+
+return {
+    exists = function(name) return api.exists(name) end,
+    get_prop = function(name, prop) return api.get_prop(name, prop) end,
+    list = {
+        children = function(name) return iter(api.list_children(name)) end,
+        snapshots = function(name) return iter(api.list_snapshots(name)) end,
+        user_properties = function(name) return iter(api.list_user_properties(name)) end
+    },
+    sync = {
+        snapshot = function(name) return api.sync_snapshot(name) end,
+        set_prop = function(name, prop, value) return api.sync_set_prop(name, prop, value) end,
+        inherit = function(name, prop) return api.sync_inherit(name, prop) end,
+        destroy = function(name) return api.sync_destroy(name) end
+    }
+}
+'''
+
+
+def _lua_to_python(lupa, value):
+    if lupa.lua_type(value) != 'table':
+        return value
+    return { k: _lua_to_python(lupa, v) for k, v in value.items() }
+
+
+def stub_run_channel_program(script: str, zfs, argv: List[str]):
+    import lupa
+    lua = lupa.LuaRuntime(unpack_returned_tuples=True)
+    rows = lambda lst: lua.table_from([ lua.table_from(list(r)) \
+        if isinstance(r, tuple) else lua.table_from([ r ]) for r in lst ])
+    api = lua.table_from({
+        'exists': zfs.exists,
+        'get_prop': zfs.get_prop,
+        'list_children': lambda name: rows(zfs.list_children(name)),
+        'list_snapshots': lambda name: rows(zfs.list_snapshots(name)),
+        'list_user_properties': lambda name: rows(zfs.list_user_properties(name)),
+        'sync_snapshot': zfs.sync_snapshot,
+        'sync_set_prop': zfs.sync_set_prop,
+        'sync_inherit': zfs.sync_inherit,
+        'sync_destroy': zfs.sync_destroy
+    })
+    lua.globals().zfs = lua.execute(_STUB_LUA_ZFS, api)
+    try:
+        chunk = lua.compile(script)
+        res = chunk(lua.table_from({ 'argv': lua.table_from(argv) }))
+    except lupa.LuaError as e:
+        raise RuntimeError(str(e))
+    return _lua_to_python(lupa, res)
+
+
+class StubChannelProgramZfs:
+    def __init__(self, backend, readonly):
+        self.backend = backend
+        self.readonly = readonly
+
+    def exists(self, name):
+        return ( name in self.backend.datasets )
+
+    def get_prop(self, name, prop):
+        value, source = self.backend._get_property(name, prop)
+        if value == '-':
+            return None
+        if prop in _STUB_NUMERIC:
+            return int(value)
+        return value
+
+    def list_user_properties(self, name):
+        return [ (p, *self.backend._get_property(name, p)) \
+            for p in self.backend._user_props(name) ]
+
+    def list_children(self, name):
+        return self.backend._children(name, 'filesystem')
+
+    def list_snapshots(self, name):
+        return self.backend._children(name, 'snapshot')
+
+    def _sync(self, command):
+        if self.readonly:
+            raise RuntimeError('Read-only channel program attempted to modify the pool')
+        try:
+            self.backend._dispatch(command)
+        except CalledProcessError:
+            return 1
+        return 0
+
+    def sync_snapshot(self, name):
+        return self._sync([ 'zfs', 'snapshot', name ])
+
+    def sync_set_prop(self, name, prop, value):
+        if ':' not in prop:
+            return 1
+        return self._sync([ 'zfs', 'set', f'{prop}={value}', name ])
+
+    def sync_inherit(self, name, prop):
+        return self._sync([ 'zfs', 'inherit', prop, name ])
+
+    def sync_destroy(self, name):
+        return self._sync([ 'zfs', 'destroy', name ])
+
+
+class StubZfsBackend(ZfsBackend):
+    def __init__(self, poolname='zroot', root_mountpoint=None):
+        super().__init__()
+        self.poolname = poolname
+        self.datasets = {}
+        self.commands = []
+        self.lock = threading.Lock()
+        self.clock = 0
+        self.datasets[poolname] = dict(type='filesystem', props={}, creation=0)
+        if root_mountpoint is not None:
+            self.datasets[poolname]['props']['mountpoint'] = root_mountpoint
+
+    def _tick(self):
+        self.clock += 1
+        return self.clock
+
+    def run(self, command, input=None):
+        with self.lock:
+            self.commands.append(list(command))
+            return self._dispatch(command, input)
+
+    def _dispatch(self, command, input=None):
+        if command[0] != 'zfs' or len(command) < 2:
+            self._fail(command, 'unsupported command')
+        handler = getattr(self, '_cmd_' + command[1], None)
+        if handler is None:
+            self._fail(command, f'unsupported subcommand: {command[1]}')
+        out = handler(command, command[2:], input)
+        return out.encode('utf-8')
+
+    @staticmethod
+    def _fail(command, message):
+        raise CalledProcessError(1, command, output=message.encode('utf-8'))
+
+    @staticmethod
+    def _split_opts(args, with_value):
+        opts = []
+        rest = []
+        i = 0
+        while i < len(args):
+            a = args[i]
+            if a.startswith('-') and len(a) > 1 and not rest:
+                for j, c in enumerate(a[1:]):
+                    if c in with_value:
+                        val = a[j + 2:] or args[i + 1]
+                        if not a[j + 2:]:
+                            i += 1
+                        opts.append((c, val))
+                        break
+                    opts.append((c, None))
+            else:
+                rest.append(a)
+            i += 1
+        return opts, rest
+
+    def _parent(self, name):
+        if '@' in name:
+            return name.split('@')[0]
+        if '/' not in name:
+            return None
+        return '/'.join(name.split('/')[:-1])
+
+    def _children(self, name, zfs_type='filesystem'):
+        res = []
+        for k, v in self.datasets.items():
+            if v['type'] == 'snapshot':
+                if zfs_type in ('snapshot', 'all') and k.split('@')[0] == name:
+                    res.append(k)
+            elif zfs_type in ('filesystem', 'all') and self._parent(k) == name:
+                res.append(k)
+        return sorted(res)
+
+    def _descendants(self, name, zfs_type='filesystem', depth=None):
+        res = []
+        if self.datasets[name]['type'] != 'snapshot' and \
+            zfs_type in ('filesystem', 'all'):
+            res.append(name)
+        stack = [ (name, 0) ]
+        while stack:
+            n, d = stack.pop(0)
+            if depth is not None and d >= depth:
+                continue
+            for k in self._children(n, 'all'):
+                if self.datasets[k]['type'] == 'snapshot':
+                    if zfs_type in ('snapshot', 'all'):
+                        res.append(k)
+                else:
+                    if zfs_type in ('filesystem', 'all'):
+                        res.append(k)
+                    stack.append((k, d + 1))
+        return res
+
+    def _require(self, command, name):
+        if name not in self.datasets:
+            self._fail(command, f'cannot open \'{name}\': dataset does not exist')
+
+    def get_property(self, name, prop):
+        return self._get_property(name, prop)[0]
+
+    def _get_property(self, name, prop):
+        prop = _STUB_ALIASES.get(prop, prop)
+        ds = self.datasets[name]
+        if prop == 'name':
+            return name, '-'
+        if prop == 'type':
+            return ds['type'], '-'
+        if prop == 'origin':
+            return ds.get('origin', '-'), '-'
+        if prop == 'creation':
+            return str(ds['creation']), '-'
+        if ds['type'] == 'snapshot' and prop in ('mountpoint', 'readonly', 'canmount'):
+            return '-', '-'
+        if prop in ds['props']:
+            return ds['props'][prop], 'local'
+        inheritable = ( prop in _STUB_INHERITABLE or ':' in prop )
+        parent = self._parent(name)
+        if inheritable and parent is not None:
+            value, source = self._get_property(parent, prop)
+            if prop == 'mountpoint' and value != '-' and '@' not in name:
+                value = value.rstrip('/') + '/' + name.split('/')[-1]
+            if source == 'local':
+                source = f'inherited from {parent}'
+            return value, source
+        if prop == 'mountpoint':
+            return '/' + name, 'default'
+        if prop in _STUB_DEFAULTS:
+            return _STUB_DEFAULTS[prop], 'default'
+        return '-', '-'
+
+    def _user_props(self, name):
+        res = set()
+        while name is not None:
+            res.update(k for k in self.datasets[name]['props'] if ':' in k)
+            name = self._parent(name)
+        return sorted(res)
+
+    def _all_props(self, name):
+        res = [ 'type', 'used', 'referenced', 'mountpoint', 'readonly',
+            'canmount', 'origin', 'written' ]
+        res += sorted(k for k in self.datasets[name]['props'] if k not in res)
+        return res
+
+    def _resolve_names(self, command, names):
+        res = []
+        for n in names:
+            if n.startswith('/'):
+                lst = [ k for k in self.datasets \
+                    if self.datasets[k]['type'] != 'snapshot' and \
+                        self.get_property(k, 'mountpoint') == n ]
+                if not lst:
+                    self._fail(command, f'cannot open \'{n}\': dataset does not exist')
+                res.append(lst[0])
+            else:
+                self._require(command, n)
+                res.append(n)
+        return res
+
+    def _cmd_list(self, command, args, input):
+        opts, names = self._split_opts(args, 'otsd')
+        opts_d = dict(opts)
+        fields = opts_d.get('o', 'name,used,mountpoint').split(',')
+        zfs_type = opts_d.get('t', 'filesystem')
+        recursive = ( 'r' in opts_d or 'd' in opts_d )
+        depth = int(opts_d['d']) if 'd' in opts_d else None
+        if not names:
+            names = [ k for k in self.datasets if self._parent(k) is None ]
+            recursive = True
+        names = self._resolve_names(command, names)
+        rows = []
+        for n in names:
+            if recursive:
+                rows.extend(self._descendants(n, zfs_type, depth))
+            elif zfs_type == 'all' or \
+                ( self.datasets[n]['type'] == 'snapshot' ) == ( zfs_type == 'snapshot' ):
+                rows.append(n)
+        out = [ '\t'.join(self.get_property(r, f) for f in fields) for r in rows ]
+        if 'H' not in opts_d:
+            out.insert(0, '\t'.join(f.upper() for f in fields))
+        return ''.join(ln + '\n' for ln in out)
+
+    def _cmd_get(self, command, args, input):
+        opts, rest = self._split_opts(args, 'ots')
+        opts_d = dict(opts)
+        if not rest:
+            self._fail(command, 'missing property argument')
+        props, *names = rest
+        recursive = ( 'r' in opts_d )
+        names = self._resolve_names(command, names)
+        rows = []
+        for n in names:
+            rows.extend(self._descendants(n, 'all') if recursive else [ n ])
+        fields = opts_d.get('o', 'name,property,value,source').split(',')
+        out = []
+        for r in rows:
+            plist = self._all_props(r) if props == 'all' else props.split(',')
+            for p in plist:
+                value, source = self._get_property(r, p)
+                row = dict(name=r, property=p, value=value, source=source)
+                out.append('\t'.join(row[f] for f in fields))
+        return ''.join(ln + '\n' for ln in out)
+
+    def _cmd_set(self, command, args, input):
+        assignments = [ a for a in args if '=' in a ]
+        names = [ a for a in args if '=' not in a ]
+        names = self._resolve_names(command, names)
+        for n in names:
+            for a in assignments:
+                k, v = a.split('=', 1)
+                self.datasets[n]['props'][_STUB_ALIASES.get(k, k)] = v
+        return ''
+
+    def _cmd_inherit(self, command, args, input):
+        opts, rest = self._split_opts(args, '')
+        prop, *names = rest
+        prop = _STUB_ALIASES.get(prop, prop)
+        names = self._resolve_names(command, names)
+        for n in names:
+            lst = self._descendants(n, 'all') if ('r', None) in opts else [ n ]
+            for k in lst:
+                self.datasets[k]['props'].pop(prop, None)
+        return ''
+
+    def _cmd_create(self, command, args, input):
+        opts, rest = self._split_opts(args, 'o')
+        name, = rest
+        if name in self.datasets:
+            self._fail(command, f'cannot create \'{name}\': dataset already exists')
+        self._require(command, self._parent(name))
+        props = dict(v.split('=', 1) for k, v in opts if k == 'o')
+        props = { _STUB_ALIASES.get(k, k): v for k, v in props.items() }
+        self.datasets[name] = dict(type='filesystem', props=props,
+            creation=self._tick())
+        return ''
+
+    def _cmd_clone(self, command, args, input):
+        opts, rest = self._split_opts(args, 'o')
+        snapshot, name = rest
+        self._require(command, snapshot)
+        if name in self.datasets:
+            self._fail(command, f'cannot create \'{name}\': dataset already exists')
+        self._require(command, self._parent(name))
+        props = dict(v.split('=', 1) for k, v in opts if k == 'o')
+        props = { _STUB_ALIASES.get(k, k): v for k, v in props.items() }
+        self.datasets[name] = dict(type='filesystem', props=props, origin=snapshot,
+            creation=self._tick())
+        return ''
+
+    def _cmd_rename(self, command, args, input):
+        _, rest = self._split_opts(args, '')
+        name, new_name = rest
+        self._require(command, name)
+        if new_name in self.datasets:
+            self._fail(command, f'cannot rename to \'{new_name}\': dataset already exists')
+        self._require(command, self._parent(new_name))
+        renamed = { k: new_name + k[len(name):] for k in self._descendants(name, 'all') }
+        renamed[name] = new_name
+        self.datasets = { renamed.get(k, k): v for k, v in self.datasets.items() }
+        for v in self.datasets.values():
+            if v.get('origin') in renamed:
+                v['origin'] = renamed[v['origin']]
+        return ''
+
+    def _cmd_snapshot(self, command, args, input):
+        _, names = self._split_opts(args, 'o')
+        for n in names:
+            if '@' not in n:
+                self._fail(command, f'cannot create snapshot \'{n}\': invalid name')
+            self._require(command, n.split('@')[0])
+            if n in self.datasets:
+                self._fail(command, f'cannot create snapshot \'{n}\': dataset already exists')
+        for n in names:
+            self.datasets[n] = dict(type='snapshot', props={}, creation=self._tick())
+        return ''
+
+    def _cmd_destroy(self, command, args, input):
+        opts, rest = self._split_opts(args, '')
+        name, = rest
+        if '@' in name and ',' in name:
+            fs, snapshots = name.split('@', 1)
+            for snap in snapshots.split(','):
+                self._cmd_destroy(command, [ a for a in args if a != name ] + \
+                    [ f'{fs}@{snap}' ], input)
+            return ''
+        self._require(command, name)
+        recursive = ( ('r', None) in opts )
+        lst = self._descendants(name, 'all')
+        if name not in lst:
+            lst.insert(0, name)
+        if len(lst) > 1 and not recursive:
+            self._fail(command, f'cannot destroy \'{name}\': filesystem has children')
+        clones = [ k for k, v in self.datasets.items() \
+            if v.get('origin') in lst and k not in lst ]
+        if clones:
+            self._fail(command, f'cannot destroy \'{name}\': snapshot has dependent clones')
+        for k in lst:
+            del self.datasets[k]
+        return ''
+
+    def _cmd_program(self, command, args, input):
+        opts, rest = self._split_opts(args, 'tm')
+        flags = { k for k, _ in opts }
+        _, script, *argv = rest
+        if script == '-':
+            script = input.decode('utf-8')
+        else:
+            with open(script) as f:
+                script = f.read()
+        try:
+            res = stub_run_channel_program(script,
+                StubChannelProgramZfs(self, readonly=( 'n' in flags )), argv)
+        except ImportError:
+            self._fail(command, 'Running channel programs requires the lupa module')
+        except RuntimeError as e:
+            self._fail(command, f'Channel program execution failed: {e}')
+        if 'j' in flags:
+            return json.dumps({ 'return': res })
+        return f'Channel program fully executed and returned:\n{res}\n'
+
+    def _cmd_rollback(self, command, args, input):
+        opts, rest = self._split_opts(args, '')
+        name, = rest
+        self._require(command, name)
+        fs, _ = name.split('@')
+        snapshots = [ k for k in self.datasets if k.startswith(fs + '@') ]
+        later = snapshots[snapshots.index(name) + 1:]
+        if later and ('r', None) not in opts:
+            self._fail(command, f'cannot rollback to \'{name}\': more recent snapshots exist')
+        for k in later:
+            del self.datasets[k]
+        return ''
+
+
+#
+# Batching executor
+#
+
+class ZfsBatch:
+    def __init__(self, backend: ZfsBackend = None):
+        self.backend = backend
+        self.groups = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.groups = []
+
+    @staticmethod
+    def _touches(grp, target):
+        for n in grp['names']:
+            n = n.split('@')[0]
+            if n == target:
+                return True
+            if grp['kind'] == 'inherit' and grp['key'][1] and \
+                target.startswith(n + '/'):
+                return True
+        return False
+
+    def _enqueue(self, kind, key, name, payload=None):
+        target = name.split('@')[0]
+        grp = None
+        for g in reversed(self.groups):
+            if g['kind'] == kind and g['key'] == key:
+                grp = g
+                break
+            if self._touches(g, target):
+                break
+        if grp is None:
+            grp = dict(kind=kind, key=key, names=[], payload={})
+            self.groups.append(grp)
+        if name not in grp['names']:
+            grp['names'].append(name)
+        if payload:
+            grp['payload'].update(payload)
+
+    def set_props(self, name: str, props: Dict[str, str]):
+        if not props:
+            return
+        self._enqueue('set', name, name, dict(props))
+
+    def inherit(self, name: str, prop: str, recursive: bool = False):
+        self._enqueue('inherit', (prop, recursive), name)
+
+    def snapshot(self, name: str):
+        self._enqueue('snapshot', name.split('/')[0], name)
+
+    def commands(self) -> List[List[str]]:
+        res = []
+        for grp in self.groups:
+            if grp['kind'] == 'set':
+                res.append([ 'zfs', 'set',
+                    *[ f'{k}={v}' for k, v in grp['payload'].items() ],
+                    grp['key'] ])
+            elif grp['kind'] == 'inherit':
+                prop, recursive = grp['key']
+                res.append([ 'zfs', 'inherit', *([ '-r' ] if recursive else []),
+                    prop, *grp['names'] ])
+            elif grp['kind'] == 'snapshot':
+                res.append([ 'zfs', 'snapshot', *grp['names'] ])
+            else:
+                raise ValueError(f'Unknown batch operation: {grp["kind"]}') # pragma: no cover
+        return res
+
+    def flush(self):
+        backend = self.backend or zfs_backend()
+        cmds = self.commands()
+        self.groups = []
+        for cmd in cmds:
+            backend.run(cmd)
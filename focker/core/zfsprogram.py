@@ -0,0 +1,230 @@
+#
+# Copyright (C) Stanislaw Adaszewski, 2020-2021
+# License: GNU General Public License v3.0
+# URL: https://github.com/sadaszewski/focker
+# URL: https://adared.ch/focker
+#
+
+
+from .zfsbackend import ZfsBackend, \
+    SubprocessZfsBackend, \
+    zfs_backend
+from .zfs import zfs_nicenum
+from typing import List
+import json
+
+
+#
+# Channel programs are passed to zfs program on stdin, their
+# arguments as argv.
+#
+
+_PREAMBLE = '''args = ...
+argv = args["argv"]
+'''
+
+
+PROBE_UNIQUE_NAME = _PREAMBLE + '''
+parent = argv[1]
+sha256 = argv[2]
+min_prefix = tonumber(argv[3])
+
+for child in zfs.list.children(parent) do
+    if zfs.get_prop(child, "focker:sha256") == sha256 then
+        return { exists = child }
+    end
+end
+
+name = parent .. "/" .. sha256
+for pre = min_prefix, string.len(sha256) do
+    local candidate = parent .. "/" .. string.sub(sha256, 1, pre)
+    if not zfs.exists(candidate) then
+        name = candidate
+        break
+    end
+end
+
+mountpoint = zfs.get_prop(parent, "mountpoint")
+if mountpoint == nil or string.sub(mountpoint, 1, 1) ~= "/" then
+    return { name = name }
+end
+if string.sub(mountpoint, -1) ~= "/" then
+    mountpoint = mountpoint .. "/"
+end
+return { name = name, mountpoint = mountpoint .. string.sub(name, string.len(parent) + 2) }
+'''
+
+
+TAGS = _PREAMBLE + '''
+parent = argv[1]
+target = argv[2]
+remove = {}
+for i = 3, #argv do
+    remove[argv[i]] = true
+end
+
+function check(err, name)
+    if err ~= 0 then
+        error("cannot update focker:tags on " .. name .. ": error " .. err)
+    end
+end
+
+for child in zfs.list.children(parent) do
+    local cur = zfs.get_prop(child, "focker:tags")
+    if cur ~= nil and child ~= target then
+        local keep = {}
+        local changed = false
+        for t in string.gmatch(cur, "[^ ]+") do
+            if remove[t] then
+                changed = true
+            elseif t ~= "-" then
+                keep[#keep + 1] = t
+            end
+        end
+        if changed then
+            if #keep > 0 then
+                check(zfs.sync.set_prop(child, "focker:tags", table.concat(keep, " ")), child)
+            else
+                check(zfs.sync.inherit(child, "focker:tags"), child)
+            end
+        end
+    end
+end
+
+if target == "" then
+    return { tags = "" }
+end
+
+tags = {}
+seen = {}
+cur = zfs.get_prop(target, "focker:tags")
+if cur ~= nil then
+    for t in string.gmatch(cur, "[^ ]+") do
+        if t ~= "-" and not seen[t] then
+            seen[t] = true
+            tags[#tags + 1] = t
+        end
+    end
+end
+for i = 3, #argv do
+    if not seen[argv[i]] then
+        seen[argv[i]] = true
+        tags[#tags + 1] = argv[i]
+    end
+end
+if #tags > 0 then
+    check(zfs.sync.set_prop(target, "focker:tags", table.concat(tags, " ")), target)
+else
+    check(zfs.sync.inherit(target, "focker:tags"), target)
+end
+return { tags = table.concat(tags, " ") }
+'''
+
+
+PROPERTIES = _PREAMBLE + '''
+native = { "mountpoint", "origin", "readonly", "used", "referenced" }
+result = {}
+
+function collect(name)
+    local props = {}
+    for _, p in ipairs(native) do
+        local v = zfs.get_prop(name, p)
+        if v ~= nil then
+            props[p] = v
+        end
+    end
+    for p, v in zfs.list.user_properties(name) do
+        if string.sub(p, 1, 7) == "focker:" then
+            props[p] = v
+        end
+    end
+    result[name] = props
+end
+
+function walk(name)
+    collect(name)
+    for snap in zfs.list.snapshots(name) do
+        collect(snap)
+    end
+    for child in zfs.list.children(name) do
+        walk(child)
+    end
+end
+
+for i = 1, #argv do
+    walk(argv[i])
+end
+return result
+'''
+
+# The result table of PROPERTIES grows with the number of datasets
+# and snapshots, raise the limit to the maximum zfs program allows.
+PROPERTIES_MEMORY_LIMIT = 100 * 1024 * 1024
+
+
+def zfs_program(pool: str, script: str, args: List[str] = [],
+    readonly: bool = False, memory_limit: int = None,
+    backend: ZfsBackend = None):
+
+    backend = backend or zfs_backend()
+    cmd = [ 'zfs', 'program', '-j' ]
+    if readonly:
+        cmd.append('-n')
+    if memory_limit is not None:
+        cmd += [ '-m', str(memory_limit) ]
+    cmd += [ pool, '-', *args ]
+    out = backend.run(cmd, input=script.encode('utf-8'))
+    return json.loads(out.decode('utf-8'))['return']
+
+
+def _validate_tags(tags):
+    if any(' ' in a for a in tags):
+        raise ValueError('Tags cannot contain spaces')
+    if any(a == '-' for a in tags):
+        raise ValueError('Tags cannot consist of just the minus sign')
+
+
+class ChannelProgramZfsBackend(ZfsBackend):
+    def __init__(self, inner: ZfsBackend = None):
+        super().__init__()
+        self.inner = inner or SubprocessZfsBackend()
+
+    def run(self, command, input=None):
+        return self.inner.run(command, input=input)
+
+    def _program(self, script, args, readonly=False, memory_limit=None):
+        from .config import FOCKER_CONFIG
+        pool = FOCKER_CONFIG.zfs.root_dataset.split('/')[0]
+        return zfs_program(pool, script, args, readonly=readonly,
+            memory_limit=memory_limit, backend=self)
+
+    @staticmethod
+    def _parent(focker_type):
+        from .config import FOCKER_CONFIG
+        return f'{FOCKER_CONFIG.zfs.root_dataset}/{focker_type}s'
+
+    def probe_unique_name(self, sha256, focker_type):
+        assert len(sha256) > 7
+        res = self._program(PROBE_UNIQUE_NAME,
+            [ self._parent(focker_type), sha256, '7' ], readonly=True)
+        if 'exists' in res:
+            return None
+        return res['name'], res.get('mountpoint')
+
+    def properties_cache(self, roots=[]):
+        from .config import FOCKER_CONFIG
+        roots = roots or [ FOCKER_CONFIG.zfs.root_dataset ]
+        res = self._program(PROPERTIES, roots, readonly=True,
+            memory_limit=PROPERTIES_MEMORY_LIMIT)
+        for name, props in res.items():
+            props['name'] = name
+            for k, v in props.items():
+                if isinstance(v, int):
+                    props[k] = zfs_nicenum(v)
+            if 'readonly' in props:
+                props['rdonly'] = props['readonly']
+        return res
+
+    def retag(self, name, tags, focker_type):
+        _validate_tags(tags)
+        self._program(TAGS, [ self._parent(focker_type), name or '', *tags ])
@@ -6,7 +6,7 @@
 #
 
 
-from .grammar import top
+from .parser import parse
 from .classes import JailConf, \
     JailBlock
 
@@ -31,14 +31,12 @@ class WrapFileOrFilename:
 
 
 def loads(s):
-    res = top.parseString(s, parseAll=True)
-    return res[0]
+    return parse(s)
 
 
 def load(file_or_filename='/etc/jail.conf'):
     with WrapFileOrFilename(file_or_filename) as f:
-        res = top.parseFile(f, parseAll=True)
-    return res[0]
+        return parse(f.read())
 
 
 def dumps(conf):
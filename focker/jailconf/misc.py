@@ -7,18 +7,28 @@
 
 
 import re
-from functools import reduce
 
 
-def flatten(x):
+_LIST_ITERATOR = iter([]).__class__
+
+
+def _flatten_into(x, res):
     try:
         it = iter(x)
     except TypeError:
-        return [ x ]
-    if isinstance(it, iter([]).__class__):
-        return reduce(list.__add__, [ flatten(y) for y in x ], [])
+        res.append(x)
+        return
+    if isinstance(it, _LIST_ITERATOR):
+        for y in it:
+            _flatten_into(y, res)
     else:
-        return [ x ]
+        res.append(x)
+
+
+def flatten(x):
+    res = []
+    _flatten_into(x, res)
+    return res
 
 
 def quote_value(s):
@@ -0,0 +1,136 @@
+#
+# Copyright (C) Stanislaw Adaszewski, 2020-2021
+# License: GNU General Public License v3.0
+# URL: https://github.com/sadaszewski/focker
+# URL: https://adared.ch/focker
+#
+
+
+from .classes import *
+import re
+
+
+#
+# Single-pass recursive descent parser producing the same object
+# model as the pyparsing grammar in grammar.py, token for token,
+# including the whitespace and comments preceding every element.
+#
+
+SPACE = re.compile(r'(?:/\*.*?\*/|//[^\n]*|#[^\n]*|[ \t\n\r]+)*', re.S)
+UNQUOTED_STRING = re.compile(r'(?:\\[ \t\r]*\n|[^"\'{}=,+; \t\r\n\\])+')
+DOUBLE_QUOTED_STRING = re.compile(r'"(?:\\"|[^"])*"')
+SINGLE_QUOTED_STRING = re.compile(r"'(?:\\'|[^'])*'")
+LINE_CONTINUATION = re.compile(r'(^|[^\\])\\[ \t\r]*\n')
+
+
+def proc_str(s):
+    s = LINE_CONTINUATION.sub('\\1', s)
+    s = s.encode('utf-8').decode('unicode_escape')
+    return s
+
+
+Parser = 'Parser'
+
+class Parser:
+    def __init__(self, text: str):
+        self.text = text
+        self.pos = 0
+
+    def error(self):
+        line = self.text.count('\n', 0, self.pos) + 1
+        col = self.pos - self.text.rfind('\n', 0, self.pos)
+        return ValueError(f'Syntax error in jail.conf at line {line}, column {col}')
+
+    def space(self):
+        m = SPACE.match(self.text, self.pos)
+        self.pos = m.end()
+        return m.group(0)
+
+    def literal(self, lit):
+        if self.text.startswith(lit, self.pos):
+            self.pos += len(lit)
+            return lit
+        return None
+
+    def string(self):
+        m = UNQUOTED_STRING.match(self.text, self.pos)
+        if m is not None:
+            self.pos = m.end()
+            return proc_str(m.group(0))
+        m = DOUBLE_QUOTED_STRING.match(self.text, self.pos) or \
+            SINGLE_QUOTED_STRING.match(self.text, self.pos)
+        if m is not None:
+            self.pos = m.end()
+            return proc_str(m.group(0)[1:-1])
+        return None
+
+    def value(self):
+        s = self.string()
+        if s is None:
+            return None
+        toks = [ Value(s) ]
+        while True:
+            start = self.pos
+            sp_1 = self.space()
+            if self.literal(',') is None:
+                self.pos = start
+                break
+            sp_2 = self.space()
+            s = self.string()
+            if s is None:
+                self.pos = start
+                break
+            toks += [ sp_1, ',', sp_2, Value(s) ]
+        if len(toks) == 1:
+            return toks[0]
+        return ListOfValues(toks)
+
+    def statement(self, allow_jail_block=False):
+        start = self.pos
+        sp_1 = self.space()
+        s = self.string()
+        if s is None:
+            self.pos = start
+            return None
+        sp_2 = self.space()
+        if self.literal(';') is not None:
+            return KeyValueToggle([ sp_1, Key(s), sp_2, ';' ])
+        op = self.literal('=') or self.literal('+=')
+        if op is not None:
+            sp_3 = self.space()
+            value = self.value()
+            sp_4 = self.space()
+            if value is None or self.literal(';') is None:
+                self.pos = start
+                return None
+            cls = KeyValuePair if op == '=' else KeyValueAppendPair
+            return cls([ sp_1, Key(s), sp_2, op, sp_3, value, sp_4, ';' ])
+        if allow_jail_block and self.literal('{') is not None:
+            statements = self.statements()
+            sp_3 = self.space()
+            if self.literal('}') is None:
+                self.pos = start
+                return None
+            return JailBlock([ sp_1, JailName(s), sp_2, '{', statements, sp_3, '}' ])
+        self.pos = start
+        return None
+
+    def statements(self, allow_jail_block=False):
+        res = []
+        while True:
+            stmt = self.statement(allow_jail_block)
+            if stmt is None:
+                break
+            res.append(stmt)
+        return res if allow_jail_block else Statements(res)
+
+    def parse(self) -> JailConf:
+        stmts = self.statements(allow_jail_block=True)
+        sp = self.space()
+        if self.pos != len(self.text):
+            raise self.error()
+        return JailConf([ stmts, sp ])
+
+
+def parse(text: str) -> JailConf:
+    return Parser(text).parse()
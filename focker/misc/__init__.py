@@ -9,7 +9,14 @@
 from .merge_dicts import merge_dicts
 from .backup_file import backup_file
 from .filehash import filehash
+from .copyfile import fast_copyfile
+from .hashcache import FileHashCache, \
+    cached_filehash
+from .jailconfstore import JailConfStore, \
+    JailConfStoreCache, \
+    JAILCONF_STORE_CACHE
 from .load_jailconf import *
 from .overrides import *
 from .lock import focker_lock, \
-    focker_unlock
+    focker_unlock, \
+    on_focker_relock
@@ -0,0 +1,42 @@
+#
+# Copyright (C) Stanislaw Adaszewski, 2020-2021
+# License: GNU General Public License v3.0
+# URL: https://github.com/sadaszewski/focker
+# URL: https://adared.ch/focker
+#
+
+
+import errno
+import os
+import shutil
+
+
+COPY_CHUNK_SIZE = 4 * 1024 * 1024
+
+_FALLBACK_ERRNOS = { errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+    errno.EOPNOTSUPP, errno.EBADF, errno.ETXTBSY }
+
+
+def _copy_file_range(f_1, f_2):
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    fd_1, fd_2 = f_1.fileno(), f_2.fileno()
+    copied = 0
+    while True:
+        try:
+            n = os.copy_file_range(fd_1, fd_2, COPY_CHUNK_SIZE)
+        except OSError as e:
+            if copied == 0 and e.errno in _FALLBACK_ERRNOS:
+                return False
+            raise
+        if n == 0:
+            return True
+        copied += n
+
+
+def fast_copyfile(src, dst):
+    with open(src, 'rb') as f_1, \
+        open(dst, 'wb') as f_2:
+        if not _copy_file_range(f_1, f_2):
+            shutil.copyfileobj(f_1, f_2, COPY_CHUNK_SIZE)
+    return dst
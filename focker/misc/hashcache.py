@@ -0,0 +1,117 @@
+#
+# Copyright (C) Stanislaw Adaszewski, 2020-2021
+# License: GNU General Public License v3.0
+# URL: https://github.com/sadaszewski/focker
+# URL: https://adared.ch/focker
+#
+
+
+from .filehash import filehash
+from contextvars import ContextVar
+import json
+import os
+import time
+
+
+FILE_HASH_CACHE = ContextVar('FILE_HASH_CACHE', default=None)
+
+# Files modified this recently could change again within the same
+# mtime tick without changing size, their hashes are not cached.
+RACY_INTERVAL_NS = 2 * 10**9
+
+
+class FileHashCache:
+    def __init__(self, fname: str = None, save: bool = True):
+        self.fname = fname
+        self.save_on_exit = save
+        self.entries = {}
+        self.used = set()
+        self.dirty = False
+        self.tok = None
+
+    def __enter__(self):
+        self.load()
+        self.tok = FILE_HASH_CACHE.set(self)
+        return self
+
+    def __exit__(self, *excinfo):
+        FILE_HASH_CACHE.reset(self.tok)
+        self.tok = None
+        if not self.save_on_exit:
+            return
+        self.prune()
+        if self.dirty:
+            self.save()
+
+    @staticmethod
+    def instance():
+        return FILE_HASH_CACHE.get()
+
+    def load(self):
+        self.entries = {}
+        self.used = set()
+        if self.fname is None or not os.path.exists(self.fname):
+            return
+        try:
+            with open(self.fname) as f:
+                self.entries = json.load(f)
+        except ValueError:
+            self.entries = {}
+
+    def save(self):
+        if self.fname is None or \
+            not os.path.isdir(os.path.dirname(self.fname) or '.'):
+            return
+        tmpname = f'{self.fname}.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmpname, self.fname)
+        self.dirty = False
+
+    def prune(self):
+        # The cache is shared by all builds, only entries for files
+        # which are gone or have changed since are dropped
+        for key in list(self.entries):
+            if key in self.used:
+                continue
+            try:
+                st = os.stat(key.split('|')[0])
+            except OSError:
+                st = None
+            if st is None or self.entries[key]['stat'] != self.stat_key(st):
+                del self.entries[key]
+                self.dirty = True
+
+    @staticmethod
+    def stat_key(st):
+        return [ st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns ]
+
+    def lookup(self, key: str, st, validate=None):
+        e = self.entries.get(key)
+        if e is None or e['stat'] != self.stat_key(st):
+            return None
+        if validate is not None and not validate(e):
+            return None
+        self.used.add(key)
+        return e
+
+    def store(self, key: str, st, entry):
+        if time.time_ns() - st.st_mtime_ns < RACY_INTERVAL_NS:
+            return
+        self.entries[key] = dict(entry, stat=self.stat_key(st))
+        self.used.add(key)
+        self.dirty = True
+
+
+def cached_filehash(fname: str) -> str:
+    cache = FileHashCache.instance()
+    if cache is None:
+        return filehash(fname)
+    key = os.path.abspath(fname)
+    st = os.stat(key)
+    e = cache.lookup(key, st)
+    if e is not None:
+        return e['sha256']
+    res = filehash(key)
+    cache.store(key, st, dict(sha256=res))
+    return res
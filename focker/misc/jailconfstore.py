@@ -0,0 +1,325 @@
+#
+# Copyright (C) Stanislaw Adaszewski, 2020-2021
+# License: GNU General Public License v3.0
+# URL: https://github.com/sadaszewski/focker
+# URL: https://adared.ch/focker
+#
+
+
+from collections import defaultdict
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import threading
+from typing import Dict, \
+    Iterable, \
+    List
+
+
+#
+# The store is an append-only journal with one JSON record per
+# line. A record is only complete once its terminating newline
+# has been written, a torn last line left by a crash is ignored
+# and cut off before the next append. Writers hold an flock on
+# the journal and catch up with records appended by others first.
+# Compaction writes a fresh journal starting with a random
+# generation record, which tells readers that the file was
+# replaced and has to be read again from the beginning.
+#
+
+COMPACT_MIN_RECORDS = 64
+COMPACT_RATIO = 2
+
+
+JailConfStore = 'JailConfStore'
+
+class JailConfStore:
+    def __init__(self, fname: str):
+        self.fname = fname
+        self.clear()
+
+    def clear(self):
+        self.entries = {}
+        self.rendered = {}
+        self.path_index = defaultdict(set)
+        self.hostname_index = defaultdict(set)
+        self.depend_index = defaultdict(set)
+        self.records = 0
+        self.offset = 0
+        self.generation = None
+
+    def load(self) -> JailConfStore:
+        self.clear()
+        return self.load_tail()
+
+    def load_tail(self) -> JailConfStore:
+        fd = os.open(self.fname, os.O_RDONLY)
+        try:
+            self._sync(fd)
+        finally:
+            os.close(fd)
+        return self
+
+    def create(self, entries: Dict[str, dict]) -> JailConfStore:
+        self.clear()
+        for name, entry in entries.items():
+            self._index(name, entry, None)
+        self.compact()
+        return self
+
+    def __contains__(self, name: str):
+        return name in self.entries
+
+    def __getitem__(self, name: str) -> dict:
+        return self.entries[name]
+
+    def find_by_path(self, path: str) -> List[str]:
+        return sorted(self.path_index.get(path, ()))
+
+    def find_by_hostname(self, hostname: str) -> List[str]:
+        return sorted(self.hostname_index.get(hostname, ()))
+
+    def dependents(self, name: str) -> List[str]:
+        return sorted(self.depend_index.get(name, ()))
+
+    def depended_on(self) -> List[str]:
+        return sorted(name for name, dependents in self.depend_index.items() \
+            if dependents and name in self.entries)
+
+    def dependencies(self, name: str) -> List[str]:
+        return self._depend(self.entries[name])
+
+    def closure(self, name: str) -> List[str]:
+        res = []
+        visited = set()
+        def visit(n):
+            if n in visited or n not in self.entries:
+                return
+            visited.add(n)
+            for dep in self._depend(self.entries[n]):
+                visit(dep)
+            res.append(n)
+        visit(name)
+        return res
+
+    def reverse_closure(self, name: str) -> List[str]:
+        res = []
+        visited = set()
+        def visit(n):
+            if n in visited or n not in self.entries:
+                return
+            visited.add(n)
+            for dep in self.dependents(n):
+                visit(dep)
+            res.append(n)
+        visit(name)
+        return res
+
+    def put(self, name: str, entry: dict, rendered: str = None):
+        rec = dict(op='put', name=name, entry=entry)
+        if rendered is not None:
+            rec['rendered'] = rendered
+        with self._lock() as fd:
+            self._sync(fd)
+            self._append(fd, rec)
+            self._index(name, entry, rendered)
+            self._maybe_compact()
+
+    def remove(self, name: str):
+        with self._lock() as fd:
+            self._sync(fd)
+            if name not in self.entries:
+                raise KeyError(name)
+            self._append(fd, dict(op='del', name=name))
+            self._discard(name)
+            self._maybe_compact()
+
+    def compact(self):
+        with self._lock():
+            self._compact()
+
+    def _compact(self):
+        generation = os.urandom(16).hex()
+        tmpname = f'{self.fname}.tmp'
+        with open(tmpname, 'wb') as f:
+            f.write(self._encode(dict(op='gen', gen=generation)))
+            for name, entry in self.entries.items():
+                rec = dict(op='put', name=name, entry=entry)
+                if name in self.rendered:
+                    rec['rendered'] = self.rendered[name]
+                f.write(self._encode(rec))
+            f.flush()
+            os.fsync(f.fileno())
+            offset = f.tell()
+        os.replace(tmpname, self.fname)
+        self.records = len(self.entries)
+        self.offset = offset
+        self.generation = generation
+
+    @staticmethod
+    def _encode(rec) -> bytes:
+        return (json.dumps(rec) + '\n').encode('utf-8')
+
+    @contextmanager
+    def _lock(self):
+        while True:
+            fd = os.open(self.fname, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                # The journal might have been replaced while waiting
+                if os.fstat(fd).st_ino == os.stat(self.fname).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            except:
+                os.close(fd)
+                raise
+            os.close(fd)
+        try:
+            yield fd
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _read_generation(fd: int) -> str:
+        head = os.pread(fd, 256, 0).split(b'\n', 1)
+        if len(head) < 2:
+            return None
+        try:
+            rec = json.loads(head[0])
+        except ValueError:
+            return None
+        return rec.get('gen') if rec.get('op') == 'gen' else None
+
+    def _sync(self, fd: int):
+        size = os.fstat(fd).st_size
+        if self.offset > 0 and ( size < self.offset or \
+            self._read_generation(fd) != self.generation ):
+            self.clear()
+        *lines, _ = os.pread(fd, size - self.offset, self.offset).split(b'\n')
+        for line in lines:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                raise RuntimeError(f'Corrupted jailconf journal record at offset {self.offset}')
+            self._apply(rec)
+            if rec['op'] != 'gen':
+                self.records += 1
+            self.offset += len(line) + 1
+
+    def _append(self, fd: int, rec):
+        # Anything past the last complete record is a torn write
+        if os.fstat(fd).st_size != self.offset:
+            os.ftruncate(fd, self.offset)
+        data = self._encode(rec)
+        while data:
+            n = os.write(fd, data)
+            data = data[n:]
+            self.offset += n
+        os.fsync(fd)
+        self.records += 1
+
+    def _maybe_compact(self):
+        if self.records > COMPACT_MIN_RECORDS and \
+            self.records > COMPACT_RATIO * len(self.entries):
+            self._compact()
+
+    def _apply(self, rec):
+        if rec['op'] == 'gen':
+            self.generation = rec['gen']
+        elif rec['op'] == 'put':
+            self._index(rec['name'], rec['entry'], rec.get('rendered'))
+        elif rec['op'] == 'del':
+            self._discard(rec['name'])
+        else:
+            raise RuntimeError(f'Unknown jailconf journal operation: {rec["op"]}')
+
+    @staticmethod
+    def _depend(entry) -> Iterable[str]:
+        dep = entry.get('depend', [])
+        if isinstance(dep, str):
+            dep = [ dep ]
+        return [ str(d) for d in dep ]
+
+    def _index(self, name: str, entry: dict, rendered: str):
+        self._discard(name)
+        self.entries[name] = entry
+        if rendered is not None:
+            self.rendered[name] = rendered
+        if 'path' in entry:
+            self.path_index[str(entry['path'])].add(name)
+        if 'host.hostname' in entry:
+            self.hostname_index[str(entry['host.hostname'])].add(name)
+        for dep in self._depend(entry):
+            self.depend_index[dep].add(name)
+
+    def _discard(self, name: str):
+        entry = self.entries.pop(name, None)
+        if entry is None:
+            return
+        self.rendered.pop(name, None)
+        if 'path' in entry:
+            self.path_index[str(entry['path'])].discard(name)
+        if 'host.hostname' in entry:
+            self.hostname_index[str(entry['host.hostname'])].discard(name)
+        for dep in self._depend(entry):
+            self.depend_index[dep].discard(name)
+
+
+#
+# Stores are kept in memory for the lifetime of the process and
+# revalidated on every access against the stat of the journal and
+# of its directory. Since the journal is only ever appended to or
+# atomically replaced, growth of the same inode usually means only
+# the new records need to be read. Inode numbers are reused though,
+# so the tail is only read if the generation record still matches.
+#
+
+class JailConfStoreCache:
+    def __init__(self):
+        self.stores = {}
+        self.hits = 0
+        self.misses = 0
+        self.tail_reads = 0
+        self.lock = threading.Lock()
+
+    def clear(self):
+        self.stores = {}
+
+    @staticmethod
+    def stat_key(fname: str):
+        st = os.stat(fname)
+        dst = os.stat(os.path.dirname(fname) or '.')
+        return [ st.st_mtime_ns, st.st_ino, st.st_size, dst.st_mtime_ns ]
+
+    def get(self, fname: str) -> JailConfStore:
+        with self.lock:
+            return self._get(fname)
+
+    def _get(self, fname: str) -> JailConfStore:
+        try:
+            key = self.stat_key(fname)
+        except FileNotFoundError:
+            self.stores.pop(fname, None)
+            return None
+        cached_key, store = self.stores.get(fname, (None, None))
+        if cached_key == key:
+            self.hits += 1
+            return store
+        if cached_key is not None and cached_key[1] == key[1] and \
+            key[2] >= store.offset and store.generation is not None:
+            generation = store.generation
+            store.load_tail()
+            if store.generation == generation:
+                self.tail_reads += 1
+            else:
+                self.misses += 1
+        else:
+            self.misses += 1
+            store = JailConfStore(fname).load()
+        self.stores[fname] = (key, store)
+        return store
+
+
+JAILCONF_STORE_CACHE = JailConfStoreCache()
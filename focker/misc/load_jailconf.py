@@ -6,10 +6,15 @@
 #
 
 
+from .jailconfstore import JailConfStore, \
+    JAILCONF_STORE_CACHE
 import os
 import json
 
 
+JAILCONF_JOURNAL = 'jailconf.journal'
+
+
 def jailconf_dir():
     from ..core.config import FOCKER_CONFIG
     return os.path.join(FOCKER_CONFIG.zfs.root_mountpoint, 'jailconf')
@@ -37,13 +42,8 @@ def _json_load(f):
     return _parse_str_values(json.load(f))
 
 
-def _json_dump(entry, f):
-    json.dump(_parse_str_values(entry), f)
-
-
-def load_jailconf():
+def load_jailconf_json_dir(dnam):
     conf = {}
-    dnam = jailconf_dir()
     for fnam in os.listdir(dnam):
         if not fnam.endswith('.json'):
             continue
@@ -54,24 +54,77 @@ def load_jailconf():
     return conf
 
 
+def jailconf_store() -> JailConfStore:
+    dnam = jailconf_dir()
+    fname = os.path.join(dnam, JAILCONF_JOURNAL)
+    store = JAILCONF_STORE_CACHE.get(fname)
+    if store is not None:
+        return store
+    store = JailConfStore(fname)
+    # One-time migration, the per-jail JSON files are
+    # left in place but no longer read afterwards.
+    return store.create(load_jailconf_json_dir(dnam))
+
+
+# The entries are shared with the in-memory cache
+# of the store and must not be modified in place.
+def load_jailconf():
+    return dict(jailconf_store().entries)
+
+
 def jailconf_load_jail(*, name):
-    fnam = os.path.join(jailconf_dir(), f'{name}.json')
-    with open(fnam) as f:
-        return _json_load(f)
+    return dict(jailconf_store()[name])
 
 
 def jailconf_jail_exists(*, name):
-    fnam = os.path.join(jailconf_dir(), f'{name}.json')
-    return os.path.exists(fnam)
+    return ( name in jailconf_store() )
+
+
+def jailconf_find_by_path(path):
+    return jailconf_store().find_by_path(path)
+
+
+def jailconf_find_by_hostname(hostname):
+    return jailconf_store().find_by_hostname(hostname)
+
+
+def jailconf_dependents(*, name):
+    return jailconf_store().dependents(name)
+
+
+def jailconf_closure(*, name):
+    return jailconf_store().closure(name)
+
+
+def jailconf_stop_closure(*, name):
+    # Dependents of the jail, together with everything they depend on
+    store = jailconf_store()
+    res = []
+    for n in reversed(store.reverse_closure(name)):
+        res += [ dep for dep in store.closure(n) if dep not in res ]
+    return res
+
+
+def jailconf_render_jail(name, entry):
+    from ..jailconf import JailBlock
+    return str(JailBlock.create(name, entry))
+
+
+def jailconf_render(names):
+    store = jailconf_store()
+    res = []
+    for name in names:
+        if name not in store.rendered:
+            store.rendered[name] = jailconf_render_jail(name, store[name])
+        res.append(store.rendered[name])
+    return ''.join(res)
 
 
 def jailconf_add_jail(*, name, entry):
-    fnam = os.path.join(jailconf_dir(), f'{name}.json')
-    with open(fnam + '.tmp', 'w') as f:
-        _json_dump(entry, f)
-    os.rename(fnam + '.tmp', fnam)
+    entry = _parse_str_values(entry)
+    jailconf_store().put(name, entry,
+        rendered=jailconf_render_jail(name, entry))
 
 
 def jailconf_remove_jail(*, name):
-    fnam = os.path.join(jailconf_dir(), f'{name}.json')
-    os.unlink(fnam)
+    jailconf_store().remove(name)
@@ -11,6 +11,14 @@ import fcntl
 from contextlib import ContextDecorator
 
 
+_RELOCK_CALLBACKS = []
+
+
+def on_focker_relock(fn):
+    _RELOCK_CALLBACKS.append(fn)
+    return fn
+
+
 class focker_lock(ContextDecorator):
     fd = None
 
@@ -38,8 +46,10 @@ class focker_unlock(ContextDecorator):
         print('Lock released temporarily')
 
     def __exit__(self, *_):
-        if focker_lock.fd is None:
-            return
-        print('Waiting for /var/lock/focker.lock ...')
-        fcntl.flock(focker_lock.fd, fcntl.LOCK_EX)
-        print('Lock reclaimed.')
+        if focker_lock.fd is not None:
+            print('Waiting for /var/lock/focker.lock ...')
+            fcntl.flock(focker_lock.fd, fcntl.LOCK_EX)
+            print('Lock reclaimed.')
+        # Other processes may have changed anything in the meantime
+        for fn in _RELOCK_CALLBACKS:
+            fn()
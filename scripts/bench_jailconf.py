@@ -0,0 +1,68 @@
+#
+# Copyright (C) Stanislaw Adaszewski, 2020-2021
+# License: GNU General Public License v3.0
+# URL: https://github.com/sadaszewski/focker
+# URL: https://adared.ch/focker
+#
+
+
+from focker.jailconf.parser import parse
+from argparse import ArgumentParser
+import random
+import time
+import tracemalloc
+
+
+def synthetic_jailconf(n_jails, n_params, seed=0):
+    rnd = random.Random(seed)
+    res = [ '# Synthetic jail.conf\n',
+        'exec.start = "/bin/sh /etc/rc";\n',
+        'exec.stop = "/bin/sh /etc/rc.shutdown";\n',
+        'mount.devfs;\n' ]
+    for i in range(n_jails):
+        res.append(f'\n/* jail {i} */\njail{i} {{\n')
+        res.append(f'  path = /focker/jails/{i:08x};\n')
+        res.append(f'  host.hostname = "jail{i}.example.org";\n')
+        res.append(f'  ip4.addr += 127.0.{i // 250}.{i % 250 + 1}, 10.0.{i // 250}.{i % 250 + 1};\n')
+        for k in range(n_params):
+            res.append(f'  exec.prestart += "mount -t nullfs /focker/volumes/{rnd.getrandbits(32):08x} ' \
+                f'/focker/jails/{i:08x}/mnt/{k}";\n')
+        if i > 0:
+            res.append(f'  depend = jail{rnd.randrange(i)};\n')
+        res.append('  persist;\n}\n')
+    return ''.join(res)
+
+
+def bench(name, fn, text):
+    t_0 = time.perf_counter()
+    conf = fn(text)
+    t_1 = time.perf_counter()
+    # Measured in a separate run, tracing slows down parsing considerably
+    tracemalloc.start()
+    fn(text)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{name}: {t_1 - t_0:.3f}s, peak memory {peak / 2**20:.1f} MiB, ' \
+        f'{len(conf.jail_blocks)} jail(s)')
+    return conf
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--jails', '-n', type=int, default=300)
+    parser.add_argument('--params', '-p', type=int, default=5)
+    parser.add_argument('--pyparsing', action='store_true',
+        help='also time the reference pyparsing grammar')
+    args = parser.parse_args()
+
+    text = synthetic_jailconf(args.jails, args.params)
+    print(f'Input: {len(text)} bytes, {text.count(chr(10))} lines')
+    conf = bench('parser', parse, text)
+    if args.pyparsing:
+        from focker.jailconf.grammar import top
+        ref = bench('pyparsing', lambda s: top.parseString(s, parseAll=True)[0], text)
+        print('Identical output:', str(conf) == str(ref))
+
+
+if __name__ == '__main__':
+    main()
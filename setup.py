@@ -19,5 +19,11 @@ setup(
         "tabulate",
         "pyparsing",
         "ruamel-yaml"
-    ]
+    ],
+    extras_require={
+        "test": [
+            "pytest",
+            "lupa"
+        ]
+    }
 )
@@ -7,3 +7,33 @@ def _read_file_if_exists(fname, default=None):
             return f.read()
 
     return default
+
+
+class stub_focker_zfs:
+    def __init__(self, monkeypatch, wrapper=None, root_mountpoint='/focker'):
+        self.monkeypatch = monkeypatch
+        self.wrapper = wrapper
+        self.root_mountpoint = root_mountpoint
+        self.backend = None
+        self.active = None
+
+    def __enter__(self):
+        from focker.core import StubZfsBackend, \
+            FOCKER_CONFIG
+        self.backend = StubZfsBackend()
+        self.active = self.wrapper(self.backend) if self.wrapper else self.backend
+        self.active.__enter__()
+        self.monkeypatch.setattr(FOCKER_CONFIG.zfs, 'root_dataset', 'zroot/focker')
+        self.monkeypatch.setattr(FOCKER_CONFIG.zfs, 'root_mountpoint', self.root_mountpoint)
+        self.backend.run([ 'zfs', 'create', '-o', 'canmount=off', '-o',
+            f'mountpoint={self.root_mountpoint}', 'zroot/focker' ])
+        for path in [ 'images', 'volumes', 'jails' ]:
+            self.backend.run([ 'zfs', 'create', '-o', 'canmount=off',
+                f'zroot/focker/{path}' ])
+        self.backend.commands.clear()
+        return self.backend
+
+    def __exit__(self, *excinfo):
+        self.active.__exit__(*excinfo)
+        self.active = None
+        self.backend = None
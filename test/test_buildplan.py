@@ -0,0 +1,374 @@
+from focker.core import DatasetIndex, \
+    Image, \
+    ImageBuilder, \
+    Volume
+import focker.core.mount as mount
+from common import stub_focker_zfs
+from focker.core.image import steps
+from focker.core.image.build import checkpoint_name
+from focker.core.image.trace import JsonLinesTraceSink, \
+    HumanTraceSink
+import io
+import json
+import focker.yaml as yaml
+import pytest
+import os
+
+
+def _write(d, fname, content):
+    with open(os.path.join(d, fname), 'w') as f:
+        f.write(content)
+
+
+class TestBuildPlan:
+    def _setup(self, d):
+        _write(d, 'a.txt', 'a')
+        _write(d, 'b.txt', 'b')
+        with open(os.path.join(d, 'Fockerfile'), 'w') as f:
+            yaml.safe_dump(dict(base='base', steps=[
+                dict(copy=[ 'a.txt', '/a.txt' ]),
+                dict(copy=[ 'b.txt', '/b.txt' ])
+            ]), f)
+        base = Image.create()
+        base.add_tags([ 'base' ])
+        base.finalize()
+        return base
+
+    def test00_plan_build(self, monkeypatch, tmp_path):
+        src = tmp_path / 'src'
+        src.mkdir()
+        with stub_focker_zfs(monkeypatch, root_mountpoint=str(tmp_path / 'focker')) as be:
+            base = self._setup(str(src))
+            for fname in [ 'a.txt', 'b.txt' ]:
+                os.utime(str(src / fname), (0, 0))
+            cache_fname = str(tmp_path / 'focker' / '.focker-filehash.json')
+            bld = ImageBuilder(str(src))
+            be.commands.clear()
+            plan = bld.plan()
+            assert plan.base.name == base.name
+            assert [ plan.status(i) for i in range(2) ] == [ 'build', 'build' ]
+            assert all(c[1] in ('list', 'get') for c in be.commands)
+            assert not os.path.exists(cache_fname)
+            im = bld.build()
+            assert os.path.exists(cache_fname)
+            with open(os.path.join(im.path, 'b.txt')) as f:
+                assert f.read() == 'b'
+            assert im.sha256 == plan.layers[-1].sha256
+
+            be.commands.clear()
+            with DatasetIndex():
+                im_2 = bld.build()
+            assert im_2.name == im.name
+            assert [ c[1] for c in be.commands ] == [ 'list', 'set' ]
+
+            _write(str(src), 'b.txt', 'c')
+            plan = bld.plan()
+            assert [ plan.status(i) for i in range(2) ] == [ 'cached', 'build' ]
+            assert plan.layers[0].image.name == im.origin.name
+
+    def _fake_jail(self, monkeypatch, events):
+        class FakeJailSpec:
+            @staticmethod
+            def from_image_and_dict(im, jailspec):
+                events.append(('jailspec', jailspec))
+                return im.path
+        class FakeJail:
+            def __init__(self, path):
+                self.path = path
+            def __enter__(self):
+                events.append(('start', self.path))
+                return self
+            def __exit__(self, *excinfo):
+                events.append(('stop', self.path))
+            def run(self, cmd):
+                events.append(('run', cmd[-1]))
+                if cmd[-1] == 'false':
+                    raise RuntimeError('Step failed')
+            def jexec_command(self, cmd):
+                return [ '/bin/sh', '-c', cmd[-1] ]
+        monkeypatch.setattr(steps, 'ImageBuildJailSpec', FakeJailSpec)
+        monkeypatch.setattr(steps, 'TemporaryOSJail', FakeJail)
+
+    def test01_one_jail_per_layer(self, monkeypatch, tmp_path):
+        events = []
+        self._fake_jail(monkeypatch, events)
+        src = tmp_path / 'src'
+        src.mkdir()
+        with stub_focker_zfs(monkeypatch, root_mountpoint=str(tmp_path / 'focker')):
+            base = Image.create()
+            base.add_tags([ 'base' ])
+            base.finalize()
+            _write(str(src), 'a.txt', 'a')
+            with open(os.path.join(str(src), 'Fockerfile'), 'w') as f:
+                yaml.safe_dump(dict(base='base', steps={
+                    1: [ dict(run='echo 1'), dict(copy=[ 'a.txt', '/a.txt' ]), dict(run='echo 2') ],
+                    2: [ dict(copy=[ 'a.txt', '/b.txt' ]) ],
+                    3: [ dict(run='echo 3'), dict(run='echo 4') ]
+                }), f)
+            im = ImageBuilder(str(src)).build()
+        events = [ e for e in events if e[0] != 'jailspec' ]
+        assert [ e[0] for e in events ] == [ 'start', 'run', 'run', 'stop',
+            'start', 'run', 'run', 'stop' ]
+        assert [ e[1] for e in events if e[0] == 'run' ] == [ 'echo 1', 'echo 2', 'echo 3', 'echo 4' ]
+        assert events[-1][1] == im.path
+
+    def test02_cache_mount(self, monkeypatch, tmp_path):
+        events = []
+        self._fake_jail(monkeypatch, events)
+        commands = []
+        def fake_check_output(cmd):
+            commands.append(cmd)
+            events.append((cmd[0], cmd[-1]))
+        monkeypatch.setattr(mount, 'focker_subprocess_check_output', fake_check_output)
+        src = tmp_path / 'src'
+        src.mkdir()
+        with stub_focker_zfs(monkeypatch, root_mountpoint=str(tmp_path / 'focker')):
+            base = Image.create()
+            base.add_tags([ 'base' ])
+            base.finalize()
+            with open(os.path.join(str(src), 'Fockerfile'), 'w') as f:
+                yaml.safe_dump(dict(base='base', steps=[
+                    dict(run='pkg install -y nginx', cache={ 'pkg-cache': '/var/cache/pkg' }) ]), f)
+            bld = ImageBuilder(str(src))
+            sha256 = bld.plan().layers[0].sha256
+            im = bld.build()
+            assert im.sha256 == sha256
+            vol = Volume.from_tag('pkg-cache')
+            mountpoint = os.path.join(im.path, 'var/cache/pkg')
+            assert events == [ ('jailspec', {}), ('start', im.path), ('mount', mountpoint),
+                ('run', 'pkg install -y nginx'), ('umount', mountpoint), ('stop', im.path) ]
+            with open(os.path.join(str(src), 'Fockerfile'), 'w') as f:
+                yaml.safe_dump(dict(base='base', steps=[
+                    dict(run='pkg install -y nginx') ]), f)
+            assert bld.plan().layers[0].sha256 == sha256
+        assert commands[0] == [ 'mount', '-t', 'nullfs', vol.path, mountpoint ]
+
+    def test03_scratch(self, monkeypatch, tmp_path):
+        events = []
+        self._fake_jail(monkeypatch, events)
+        commands = []
+        monkeypatch.setattr(mount, 'focker_subprocess_check_output', commands.append)
+        src = tmp_path / 'src'
+        src.mkdir()
+        with stub_focker_zfs(monkeypatch, root_mountpoint=str(tmp_path / 'focker')):
+            base = Image.create()
+            base.add_tags([ 'base' ])
+            base.finalize()
+            with open(os.path.join(str(src), 'Fockerfile'), 'w') as f:
+                yaml.safe_dump(dict(base='base', scratch=[ '/tmp' ], steps=[
+                    dict(run='make', scratch='/usr/obj'), dict(run='make install') ]), f)
+            im = ImageBuilder(str(src), squeeze=True).build()
+        assert events[0] == ('jailspec', { 'scratch': [ '/tmp' ] })
+        mountpoint = os.path.join(im.path, 'usr/obj')
+        assert commands == [ [ 'mount', '-t', 'tmpfs', 'tmpfs', mountpoint ],
+            [ 'umount', '-f', mountpoint ] ]
+
+    def test04_checkpoint_resume(self, monkeypatch, tmp_path):
+        events = []
+        self._fake_jail(monkeypatch, events)
+        src = tmp_path / 'src'
+        src.mkdir()
+        def write_fockerfile(last):
+            with open(os.path.join(str(src), 'Fockerfile'), 'w') as f:
+                yaml.safe_dump(dict(base='base', steps=[
+                    dict(run='echo 1'), dict(run='echo 2'), dict(run=last) ]), f)
+        def runs():
+            return [ e[1] for e in events if e[0] == 'run' ]
+        with stub_focker_zfs(monkeypatch, root_mountpoint=str(tmp_path / 'focker')) as be:
+            base = Image.create()
+            base.add_tags([ 'base' ])
+            base.finalize()
+            write_fockerfile('false')
+            bld = ImageBuilder(str(src), squeeze=True, checkpoint=True)
+            with pytest.raises(RuntimeError, match='Step failed'):
+                bld.build()
+            assert runs() == [ 'echo 1', 'echo 2', 'false' ]
+            partial, = [ im for im in Image.list() if im.name != base.name ]
+            assert len(bld.list_checkpoints(partial)) == 2
+            assert bld.plan().deepest_cached == -1
+
+            events.clear()
+            write_fockerfile('echo 3')
+            plan = bld.plan()
+            be.commands.clear()
+            im = bld.build()
+            assert not any(c[1] == 'list' and 'snapshot' in c and '-d' not in c \
+                for c in be.commands)
+            destroy, = [ c for c in be.commands if c[1] == 'destroy' ]
+            name, snapshots = destroy[2].split('@')
+            assert destroy[:2] == [ 'zfs', 'destroy' ] and name == partial.name
+            assert sorted(snapshots.split(',')) == \
+                sorted(checkpoint_name(p) for p in plan.layers[0].prefixes[:2])
+            assert be.get_property(im.name, 'focker:checkpoint') == '-'
+            assert runs() == [ 'echo 3' ]
+            assert im.sha256 == plan.layers[0].sha256
+            assert im.name.split('/')[-1] == im.sha256[:7]
+            assert im.is_finalized
+            assert bld.list_checkpoints(im) == []
+            assert sorted(i.name for i in Image.list()) == sorted([ base.name, im.name ])
+            assert be.get_property(im.name, 'origin') == base.snapshot_name
+
+            events.clear()
+            write_fockerfile('false')
+            with pytest.raises(RuntimeError):
+                ImageBuilder(str(src), squeeze=True).build()
+            assert sorted(i.name for i in Image.list()) == sorted([ base.name, im.name ])
+
+    def test05_checkpoint_first_step(self, monkeypatch, tmp_path):
+        events = []
+        self._fake_jail(monkeypatch, events)
+        src = tmp_path / 'src'
+        src.mkdir()
+        with stub_focker_zfs(monkeypatch, root_mountpoint=str(tmp_path / 'focker')):
+            base = Image.create()
+            base.add_tags([ 'base' ])
+            base.finalize()
+            with open(os.path.join(str(src), 'Fockerfile'), 'w') as f:
+                yaml.safe_dump(dict(base='base', steps=[ dict(run='false') ]), f)
+            with pytest.raises(RuntimeError, match='Step failed'):
+                ImageBuilder(str(src), checkpoint=True).build()
+            assert [ im.name for im in Image.list() ] == [ base.name ]
+        with pytest.raises(ValueError, match='checkpoints'):
+            _ = ImageBuilder(str(src), atomic=True, checkpoint=True)
+
+    def test06_trace(self, monkeypatch, tmp_path):
+        events = []
+        self._fake_jail(monkeypatch, events)
+        src = tmp_path / 'src'
+        src.mkdir()
+        with stub_focker_zfs(monkeypatch, root_mountpoint=str(tmp_path / 'focker')):
+            base = self._setup(str(src))
+            def write_fockerfile(cmd):
+                with open(os.path.join(str(src), 'Fockerfile'), 'w') as f:
+                    yaml.safe_dump(dict(base='base', steps=[
+                        dict(copy=[ 'a.txt', '/a.txt' ]),
+                        dict(run=cmd) ]), f)
+            write_fockerfile('echo 1')
+            ImageBuilder(str(src)).build()
+            write_fockerfile('echo 2')
+            out = io.StringIO()
+            im = ImageBuilder(str(src), trace=JsonLinesTraceSink(out)).build()
+        trace = [ json.loads(ln) for ln in out.getvalue().splitlines() ]
+        assert [ e['event'] for e in trace ] == [ 'build_start', 'plan', 'cache_hit',
+            'cache_miss', 'clone', 'step_start', 'step_end', 'finalize', 'build_end' ]
+        assert trace[1]['hit_ratio'] == 0.5
+        assert trace[6]['kind'] == 'run' and trace[6]['layer'] == 1
+        assert all(e['duration'] >= 0 for e in trace if 'duration' in e)
+        assert trace[-2]['used'] == 0 and trace[-2]['written'] == 0
+        assert trace[-1]['name'] == im.name
+
+        out = io.StringIO()
+        sink = HumanTraceSink(out)
+        for e in trace:
+            sink.emit(e)
+        lines = out.getvalue().splitlines()
+        assert len(lines) == len(trace)
+        assert 'cache hit ratio 50%' in lines[1]
+        assert 'layer 2: step 1 (run) done in' in lines[6]
+        assert 'used 0B, written 0B' in lines[7]
+
+    def test07_copy_from_image(self, monkeypatch, tmp_path):
+        src = tmp_path / 'src'
+        src.mkdir()
+        (src / 'builder').mkdir()
+        (src / 'runtime').mkdir()
+        with stub_focker_zfs(monkeypatch, root_mountpoint=str(tmp_path / 'focker')):
+            base = self._setup(str(src))
+            def build_builder(content):
+                _write(str(src / 'builder'), 'app', content)
+                with open(str(src / 'builder' / 'Fockerfile'), 'w') as f:
+                    yaml.safe_dump(dict(base='base', steps=[
+                        dict(copy=[ 'app', '/usr/obj/app' ]) ]), f)
+                im = ImageBuilder(str(src / 'builder')).build()
+                im.add_tags([ 'builder' ])
+                return im
+            builder = build_builder('binary')
+            with open(str(src / 'runtime' / 'Fockerfile'), 'w') as f:
+                yaml.safe_dump(dict(base='base', steps=[
+                    dict(copy=[ '/usr/obj/app', '/usr/local/bin/app', { 'from': 'builder' } ]) ]), f)
+            bld = ImageBuilder(str(src / 'runtime'))
+            im = bld.build()
+            with open(os.path.join(im.path, 'usr/local/bin/app')) as f:
+                assert f.read() == 'binary'
+            assert bld.plan().status(0) == 'cached'
+
+            builder_2 = build_builder('binary 2')
+            assert builder_2.name != builder.name
+            assert bld.plan().status(0) == 'build'
+
+            os.symlink('/etc', os.path.join(builder_2.path, 'usr/obj/etc'))
+            with open(str(src / 'runtime' / 'Fockerfile'), 'w') as f:
+                yaml.safe_dump(dict(base='base', steps=[
+                    dict(copy=[ '/usr/obj/etc/passwd', '/passwd', { 'from': 'builder' } ]) ]), f)
+            with pytest.raises(ValueError, match='outside of the image'):
+                bld.build()
+
+    def test08_parallel(self, monkeypatch, tmp_path, capsys):
+        events = []
+        self._fake_jail(monkeypatch, events)
+        src = tmp_path / 'src'
+        src.mkdir()
+        def write_fockerfile(step):
+            with open(os.path.join(str(src), 'Fockerfile'), 'w') as f:
+                yaml.safe_dump(dict(base='base', steps=[ step ]), f)
+        with stub_focker_zfs(monkeypatch, root_mountpoint=str(tmp_path / 'focker')):
+            base = self._setup(str(src))
+            write_fockerfile(dict(parallel=[ 'sleep 0.2 && echo a', [ 'echo b', 'echo c' ],
+                'echo ${{ FOO }}' ], jobs=2))
+            bld = ImageBuilder(str(src), fenv={ 'foo': 'd' })
+            sha256 = bld.plan().layers[0].sha256
+            assert bld.plan().layers[0].sha256 == sha256
+            capsys.readouterr()
+            im = bld.build()
+            out = capsys.readouterr().out.splitlines()
+            assert sorted(ln for ln in out if ln.startswith('[')) == \
+                [ '[1] a', '[2] b', '[2] c', '[3] d' ]
+            assert out.index('[3] d') < out.index('[1] a')
+            assert [ e[0] for e in events ] == [ 'jailspec', 'start', 'stop' ]
+            write_fockerfile(dict(run=[ 'sleep 0.2 && echo a', 'echo b && echo c', 'echo d' ]))
+            assert bld.plan().layers[0].sha256 != sha256
+
+            write_fockerfile(dict(parallel=[ 'echo a', 'exit 3', 'true' ]))
+            with pytest.raises(RuntimeError, match=r'\[2\] with exit code 3'):
+                bld.build()
+            assert sorted(i.name for i in Image.list()) == sorted([ base.name, im.name ])
+
+    def test09_mount_outside_image(self, monkeypatch, tmp_path):
+        im_path = tmp_path / 'im'
+        im_path.mkdir()
+        os.symlink('/', str(im_path / 'x'))
+        os.symlink('usr/obj', str(im_path / 'obj'))
+        class FakeImage:
+            path = str(im_path)
+        with stub_focker_zfs(monkeypatch, root_mountpoint=str(tmp_path / 'focker')):
+            st = steps.RunStep('true', str(tmp_path), {}, cache={ 'vol': '/x/etc' })
+            with pytest.raises(ValueError, match='outside of the image: /x/etc'):
+                st.mounts(FakeImage)
+        st = steps.RunStep('true', str(tmp_path), {}, scratch='/x/tmp')
+        with pytest.raises(ValueError, match='outside of the image: /x/tmp'):
+            st.mounts(FakeImage)
+        st = steps.RunStep('true', str(tmp_path), {}, scratch='/obj')
+        assert [ m.mountpoint for m in st.mounts(FakeImage) ] == \
+            [ os.path.join(os.path.realpath(str(im_path)), 'usr/obj') ]
+
+    def test10_scratch_hash(self, monkeypatch, tmp_path):
+        src = tmp_path / 'src'
+        src.mkdir()
+        def plan(**kwargs):
+            with open(os.path.join(str(src), 'Fockerfile'), 'w') as f:
+                yaml.safe_dump(dict(base='base', steps=[ dict(run='make', **kwargs) ]), f)
+            return ImageBuilder(str(src)).plan().layers[0].sha256
+        def plan_top(scratch):
+            with open(os.path.join(str(src), 'Fockerfile'), 'w') as f:
+                yaml.safe_dump(dict(base='base', scratch=scratch,
+                    steps=[ dict(parallel=[ 'make' ]) ]), f)
+            return ImageBuilder(str(src)).plan().layers[0].sha256
+        with stub_focker_zfs(monkeypatch, root_mountpoint=str(tmp_path / 'focker')):
+            self._setup(str(src))
+            plain = plan()
+            assert plan(scratch=[]) == plain
+            assert plan(scratch='/usr/obj') != plain
+            assert plan(scratch='/usr/obj') == plan(scratch=[ 'usr/obj/', '/usr/obj' ])
+            assert plan(scratch=[ '/tmp', '/usr/obj' ]) == plan(scratch=[ '/usr/obj', '/tmp' ])
+            assert plan_top([]) != plan_top([ '/tmp' ])
+            assert plan_top([ '/tmp' ]) == plan_top('/tmp/')
@@ -0,0 +1,92 @@
+from focker.misc import FileHashCache, \
+    filehash
+from focker.core.image.steps import CopyStepEntry
+import focker.misc.hashcache
+import os
+import stat
+
+
+def _write(fname, content, age=10):
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    with open(fname, 'w') as f:
+        f.write(content)
+    st = os.stat(fname)
+    os.utime(fname, ns=(st.st_atime_ns, st.st_mtime_ns - age * 10**9))
+
+
+def _make_tree(root):
+    _write(os.path.join(root, 'a.txt'), 'a')
+    _write(os.path.join(root, 'sub', 'b.conf'), 'b = ${{ FOO }}')
+    _write(os.path.join(root, 'sub', 'deep', 'c.txt'), 'c')
+    os.chmod(os.path.join(root, 'sub', 'deep', 'c.txt'), 0o751)
+    os.symlink('a.txt', os.path.join(root, 'link'))
+
+
+class FakeImage:
+    def __init__(self, path):
+        self.path = path
+
+
+class TestCopyTree:
+    def test00_tree_hash(self, tmp_path):
+        src = str(tmp_path / 'src')
+        _make_tree(src)
+        h_1 = CopyStepEntry([ 'src', '/dst' ], str(tmp_path), {}).hash()
+        assert h_1 == CopyStepEntry([ 'src', '/dst' ], str(tmp_path), {}).hash()
+        _write(os.path.join(src, 'sub', 'deep', 'c.txt'), 'd')
+        h_2 = CopyStepEntry([ 'src', '/dst' ], str(tmp_path), {}).hash()
+        assert h_1 != h_2
+        os.chmod(os.path.join(src, 'a.txt'), 0o600)
+        h_3 = CopyStepEntry([ 'src', '/dst' ], str(tmp_path), {}).hash()
+        assert h_2 != h_3
+
+    def test01_rehash_changed_only(self, monkeypatch, tmp_path):
+        src = str(tmp_path / 'src')
+        _make_tree(src)
+        calls = []
+        def counting_filehash(fname):
+            calls.append(fname)
+            return filehash(fname)
+        monkeypatch.setattr(focker.misc.hashcache, 'filehash', counting_filehash)
+        with FileHashCache(str(tmp_path / 'cache.json')):
+            _ = CopyStepEntry([ 'src', '/dst' ], str(tmp_path), {}).hash()
+        assert len(calls) == 3
+        _write(os.path.join(src, 'a.txt'), 'x', age=5)
+        with FileHashCache(str(tmp_path / 'cache.json')):
+            _ = CopyStepEntry([ 'src', '/dst' ], str(tmp_path), {}).hash()
+        assert calls[3:] == [ os.path.join(src, 'a.txt') ]
+
+    def test02_copy_tree(self, tmp_path):
+        src = str(tmp_path / 'src')
+        _make_tree(src)
+        os.chmod(os.path.join(src, 'sub', 'deep'), 0o500)
+        e = CopyStepEntry([ 'src', '/usr/local/dst', { 'use_fenv': True } ],
+            str(tmp_path), { 'foo': 'bar' })
+        im = FakeImage(str(tmp_path / 'im'))
+        e.execute(im)
+        dst = os.path.join(im.path, 'usr/local/dst')
+        with open(os.path.join(dst, 'sub', 'b.conf')) as f:
+            assert f.read() == 'b = bar'
+        st = os.stat(os.path.join(dst, 'sub', 'deep', 'c.txt'))
+        assert stat.S_IMODE(st.st_mode) == 0o751
+        assert st.st_uid == os.stat(src).st_uid
+        assert stat.S_IMODE(os.stat(os.path.join(dst, 'sub', 'deep')).st_mode) == 0o500
+        assert os.readlink(os.path.join(dst, 'link')) == 'a.txt'
+        os.chmod(os.path.join(dst, 'sub', 'deep'), 0o700)
+        os.chmod(os.path.join(src, 'sub', 'deep'), 0o700)
+
+    def test03_glob(self, tmp_path):
+        src = str(tmp_path / 'src')
+        _make_tree(src)
+        e = CopyStepEntry([ 'src', '/dst', { 'glob': '*.txt' } ], str(tmp_path), {})
+        h_1 = e.hash()
+        im = FakeImage(str(tmp_path / 'im'))
+        e.execute(im)
+        dst = os.path.join(im.path, 'dst')
+        assert os.path.exists(os.path.join(dst, 'a.txt'))
+        assert os.path.exists(os.path.join(dst, 'sub', 'deep', 'c.txt'))
+        assert not os.path.exists(os.path.join(dst, 'sub', 'b.conf'))
+        assert not os.path.lexists(os.path.join(dst, 'link'))
+        _write(os.path.join(src, 'sub', 'b.conf'), 'changed')
+        assert CopyStepEntry([ 'src', '/dst', { 'glob': '*.txt' } ],
+            str(tmp_path), {}).hash() == h_1
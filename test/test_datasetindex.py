@@ -0,0 +1,76 @@
+from focker.core import DatasetIndex, \
+    Image, \
+    Volume
+from focker.misc import focker_unlock
+from common import stub_focker_zfs
+import pytest
+
+
+class TestDatasetIndex:
+    def test00_lookups(self, monkeypatch):
+        with stub_focker_zfs(monkeypatch) as be:
+            v_1 = Volume.create(sha256='1234567xxx')
+            v_1.add_tags([ 'a', 'ab' ])
+            v_2 = Volume.create(sha256='1234567yyy')
+            be.commands.clear()
+            with DatasetIndex():
+                v = Volume.from_tag('a')
+                assert v.name == v_1.name
+                assert len(be.commands) == 1
+                assert Volume.from_sha256('1234567yyy') is Volume.from_any_id('1234567yyy')
+                assert Volume.from_partial_sha256('1234567x') is v
+                assert Volume.from_any_id('ab') is v
+                assert Volume.from_partial_tag('ab') is v
+                assert Volume.from_name(v_1.name) is v
+                assert Volume.exists_tag('a')
+                assert not Volume.exists_tag('b')
+                assert not Volume.exists_sha256('1234567')
+                with pytest.raises(RuntimeError, match='Ambiguous'):
+                    _ = Volume.from_partial_sha256('1234567')
+                with pytest.raises(RuntimeError, match='Ambiguous'):
+                    _ = Volume.from_any_id('1234567', strict=False)
+                assert Volume.from_any_id('b', raise_exc=False) is None
+                assert len(be.commands) == 1
+
+    def test01_mutations(self, monkeypatch):
+        with stub_focker_zfs(monkeypatch) as be, \
+            DatasetIndex():
+
+            assert not Volume.exists_tag('a')
+            v_1 = Volume.create()
+            v_1.add_tags([ 'a' ])
+            assert Volume.from_tag('a') is v_1
+            v_2 = Volume.create()
+            v_2.add_tags([ 'a', 'b' ])
+            assert Volume.from_tag('a') is v_2
+            v_2.remove_tags([ 'b' ])
+            assert not Volume.exists_tag('b')
+            Volume.untag([ 'a' ])
+            assert not Volume.exists_tag('a')
+            base = Image.create()
+            base.finalize()
+            base.add_tags([ 'a' ])
+            im = Image.clone_from(base)
+            assert Image.from_any_id(im.sha256) is im
+            assert Volume.from_tag('a', raise_exc=False) is None
+            assert Image.from_tag('a') is base
+            im.add_tags([ 'c' ])
+            im.destroy()
+            assert not Image.exists_tag('c')
+            assert Image.from_sha256(im.sha256, raise_exc=False) is None
+
+    def test02_refresh_after_unlock(self, monkeypatch):
+        with stub_focker_zfs(monkeypatch) as be, \
+            DatasetIndex():
+
+            v_1 = Volume.create(sha256='1234567xxx')
+            v_1.add_tags([ 'a' ])
+            assert Volume.from_tag('a') is v_1
+            assert not Volume.exists_tag('b')
+            with focker_unlock():
+                # Changes made by another process while unlocked
+                be.run([ 'zfs', 'destroy', '-r', '-f', v_1.name ])
+                be.run([ 'zfs', 'create', '-o', 'focker:sha256=1234567yyy',
+                    '-o', 'focker:tags=b', 'zroot/focker/volumes/1234567y' ])
+            assert Volume.from_tag('a', raise_exc=False) is None
+            assert Volume.from_tag('b').name == 'zroot/focker/volumes/1234567y'
@@ -11,7 +11,9 @@ from focker.core.fenv import substitute_focker_env_vars, \
     fenv_from_list, \
     fenv_from_arg, \
     lower_keys, \
-    rec_subst_fenv_vars
+    rec_subst_fenv_vars, \
+    iter_substitute_focker_env_vars, \
+    fenv_referenced_vars
 import tempfile
 import os
 import focker.yaml as yaml
@@ -291,3 +293,31 @@ class TestFEnv:
             assert len(fenv) == 1
             assert 'foo' in fenv
             assert fenv['foo'] == 'lorem'
+
+    def test17_fenv_stream_chunk_boundaries(self):
+        fenv = { 'foo': 'bar', 'baz': 'lorem' }
+        s = 'a ${{ FOO }}$ ${{ "x" }} ${ {${{baz}}\\\n${{ \'y\' }} ${{ foo'
+        expected = substitute_focker_env_vars(s, fenv)
+        for chunk_size in range(1, len(s) + 1):
+            chunks = [ s[i:i + chunk_size] for i in range(0, len(s), chunk_size) ]
+            referenced = set()
+            res = ''.join(iter_substitute_focker_env_vars(chunks, fenv, referenced))
+            assert res == expected
+            assert sorted(referenced) == fenv_referenced_vars(s)
+
+    def test18_fenv_stream_missing_var(self):
+        with pytest.raises(KeyError):
+            _ = ''.join(iter_substitute_focker_env_vars([ '${{ F', 'OO }}' ], {}))
+
+    def test19_copy_step_entry_streaming(self):
+        with tempfile.TemporaryDirectory() as d:
+            with open(os.path.join(d, 'src'), 'w') as f:
+                f.write('x' * 100000 + '${{ FOO }}' + 'y' * 100000)
+            e = CopyStepEntry([ 'src', '/dst', { 'use_fenv': True } ], d, { 'foo': 'bar' })
+            class FakeImage:
+                path = os.path.join(d, 'im')
+            e.execute(FakeImage())
+            with open(os.path.join(d, 'im', 'dst')) as f:
+                assert f.read() == 'x' * 100000 + 'bar' + 'y' * 100000
+            e_2 = CopyStepEntry([ 'dst', '/dst' ], os.path.join(d, 'im'), {})
+            assert e.hash() == e_2.hash()
@@ -0,0 +1,131 @@
+from focker.misc import FileHashCache, \
+    cached_filehash, \
+    filehash
+from focker.core.image.steps import CopyStep, \
+    CopyStepEntry, \
+    prehash_steps
+from focker.core.image import steps as steps_module
+import focker.misc.hashcache
+import threading
+import os
+
+
+def _write(fname, content, age=10):
+    with open(fname, 'w') as f:
+        f.write(content)
+    st = os.stat(fname)
+    os.utime(fname, ns=(st.st_atime_ns, st.st_mtime_ns - age * 10**9))
+
+
+class TestFileHashCache:
+    def test00_cached_filehash(self, monkeypatch, tmp_path):
+        calls = []
+        def counting_filehash(fname):
+            calls.append(fname)
+            return filehash(fname)
+        monkeypatch.setattr(focker.misc.hashcache, 'filehash', counting_filehash)
+        fname = str(tmp_path / 'a.txt')
+        cache_fname = str(tmp_path / 'cache.json')
+        _write(fname, 'a')
+        with FileHashCache(cache_fname):
+            h = cached_filehash(fname)
+            assert cached_filehash(fname) == h
+        assert len(calls) == 1
+        with FileHashCache(cache_fname):
+            assert cached_filehash(fname) == h
+        assert len(calls) == 1
+        _write(fname, 'b', age=5)
+        with FileHashCache(cache_fname):
+            assert cached_filehash(fname) == filehash(fname)
+        assert len(calls) == 2
+
+    def test01_racy(self, tmp_path):
+        fname = str(tmp_path / 'a.txt')
+        _write(fname, 'a', age=0)
+        with FileHashCache(str(tmp_path / 'cache.json')) as cache:
+            _ = cached_filehash(fname)
+            assert not cache.entries
+        assert not os.path.exists(str(tmp_path / 'cache.json'))
+
+    def test02_read_only(self, tmp_path):
+        fname = str(tmp_path / 'a.txt')
+        _write(fname, 'a')
+        with FileHashCache(str(tmp_path / 'cache.json'), save=False) as cache:
+            _ = cached_filehash(fname)
+            assert cache.entries
+        assert not os.path.exists(str(tmp_path / 'cache.json'))
+
+    def test03_prune(self, tmp_path):
+        cache_fname = str(tmp_path / 'cache.json')
+        fnames = [ str(tmp_path / f'{i}.txt') for i in range(3) ]
+        for i, fname in enumerate(fnames):
+            _write(fname, str(i))
+        with FileHashCache(cache_fname):
+            for fname in fnames:
+                _ = cached_filehash(fname)
+        os.unlink(fnames[1])
+        _write(fnames[2], 'changed', age=5)
+        with FileHashCache(cache_fname):
+            pass
+        with FileHashCache(cache_fname, save=False) as cache:
+            assert sorted(cache.entries) == [ fnames[0] ]
+
+    def test04_separate_sessions(self, tmp_path):
+        cache_fname = str(tmp_path / 'cache.json')
+        fnames = [ str(tmp_path / f'{i}.txt') for i in range(2) ]
+        for i, fname in enumerate(fnames):
+            _write(fname, str(i))
+            with FileHashCache(cache_fname):
+                _ = cached_filehash(fname)
+        with FileHashCache(cache_fname, save=False) as cache:
+            assert sorted(cache.entries) == fnames
+
+    def test05_fenv(self, tmp_path):
+        fname = str(tmp_path / 'a.txt')
+        _write(fname, 'x = ${{ FOO }}')
+        spec = [ 'a.txt', '/a.txt', { 'use_fenv': True } ]
+        with FileHashCache(str(tmp_path / 'cache.json')) as cache:
+            h_1 = CopyStepEntry(spec, str(tmp_path), { 'foo': '1', 'bar': '2' }).hash()
+            assert cache.entries[fname + '|fenv']['fenv_vars'] == [ 'foo' ]
+            h_2 = CopyStepEntry(spec, str(tmp_path), { 'foo': '1', 'bar': '3' }).hash()
+            h_3 = CopyStepEntry(spec, str(tmp_path), { 'foo': '2', 'bar': '3' }).hash()
+        assert h_1 == h_2
+        assert h_1 != h_3
+        assert h_3 == CopyStepEntry(spec, str(tmp_path), { 'foo': '2' }).hash()
+
+
+class TestPrehash:
+    def test00_parallel(self, monkeypatch, tmp_path):
+        for i in range(3):
+            _write(str(tmp_path / f'{i}.txt'), str(i))
+        expected = CopyStep([ [ '0.txt', '/0.txt' ], [ '1.txt', '/1.txt' ] ],
+            str(tmp_path), {}).hash('x')
+        barrier = threading.Barrier(3, timeout=10)
+        orig = CopyStepEntry.compute_hash
+        def compute_hash(self):
+            barrier.wait()
+            return orig(self)
+        monkeypatch.setattr(CopyStepEntry, 'compute_hash', compute_hash)
+        steps = [ CopyStep([ [ '0.txt', '/0.txt' ], [ '1.txt', '/1.txt' ] ], str(tmp_path), {}),
+            CopyStep([ '2.txt', '/2.txt' ], str(tmp_path), {}) ]
+        prehash_steps(steps, max_workers=3)
+        monkeypatch.setattr(CopyStepEntry, 'compute_hash', None)
+        assert steps[1].entries[0].hash() == filehash(str(tmp_path / '2.txt'))
+        assert steps[0].hash('x') == expected
+
+    def test01_shared_pool(self, monkeypatch, tmp_path):
+        for rel in [ 'a.txt', 'tree/b.txt', 'tree/sub/c.txt' ]:
+            os.makedirs(os.path.dirname(str(tmp_path / rel)), exist_ok=True)
+            _write(str(tmp_path / rel), rel)
+        expected = CopyStepEntry([ 'tree', '/tree' ], str(tmp_path), {}).hash()
+        pools = []
+        orig = steps_module.ThreadPoolExecutor
+        def executor(max_workers):
+            pools.append(max_workers)
+            return orig(max_workers=max_workers)
+        monkeypatch.setattr(steps_module, 'ThreadPoolExecutor', executor)
+        steps = [ CopyStep([ 'tree', '/tree' ], str(tmp_path), {}),
+            CopyStep([ 'a.txt', '/a.txt' ], str(tmp_path), {}) ]
+        prehash_steps(steps, max_workers=2)
+        assert pools == [ 2 ]
+        assert steps[0].entries[0].hash() == expected
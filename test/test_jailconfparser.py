@@ -0,0 +1,133 @@
+import focker.jailconf as jc
+from focker.jailconf.grammar import top
+from focker.jailconf.parser import parse
+from focker.jailconf.classes import *
+from focker.jailconf.misc import flatten
+from test_jailconf import _TXT
+import random
+import pytest
+
+
+_SAMPLES = [
+    '',
+    '\n\n',
+    '# only a comment',
+    'a;',
+    'a.nob;\n',
+    ' a = 1 ;',
+    'a += 1, 2 , 3;',
+    'a.b+=x;a.c=y;',
+    '"quoted key" = \'single quoted\';',
+    'a = "with \\" escaped quote";',
+    "a = 'with \\' escaped quote';",
+    'a = "tab\\there";',
+    'a = foo#bar;',
+    'path = /usr/jails/foo;',
+    'exec.start = "/bin/sh /etc/rc";\nexec.stop = "/bin/sh /etc/rc.shutdown";\n',
+    'a = foo\\\nbar;',
+    'a = foo\\  \n\\\nbar;',
+    'a = "foo \\\n  bar";',
+    'a = "multi\nline";',
+    '/* block\n * comment */ a = 1; // trailing\n# hash\n',
+    'foo { }',
+    'foo {}\nbar {\n}\n',
+    '"quoted name" { a = 1; }',
+    'foo {\n  // comment\n  a = 1;\n  b += 2, 3;\n  c;\n  /* c */ d.noe;\n}\n# end\n',
+    'a = 1;\r\nfoo {\r\n  b = 2;\r\n}\r\n',
+    'a = 1 , 2 ,\n 3;',
+    '* { a = 1; }',
+    'host.hostname = "$name.example.org";',
+    'x = a, /* inline */ b;',
+    _TXT,
+]
+
+
+_INVALID = [
+    'a',
+    'a = ;',
+    'a = 1',
+    'a = 1, ;',
+    'foo {',
+    'foo { bar { } }',
+    '}',
+    '/* unterminated',
+    'a = "unterminated;',
+    'a == 1;',
+    'a = foo \\\n  bar;',
+]
+
+
+def _tree(x):
+    if isinstance(x, (JailConf, JailBlock)):
+        return (x.__class__.__name__, [ _tree(t) for t in x.toks ])
+    if isinstance(x, (Statements, ListOfValues, KeyValuePair,
+        KeyValueAppendPair, KeyValueToggle)):
+        return (x.__class__.__name__, [ _tree(t) for t in x.toks ])
+    if isinstance(x, Value):
+        return (x.__class__.__name__, x.value.__class__.__name__, x.value)
+    assert isinstance(x, str)
+    return x
+
+
+def _reference(s):
+    return top.parseString(s, parseAll=True)[0]
+
+
+def _synthetic(rnd, n_jails):
+    def word():
+        return rnd.choice([ 'foo', 'bar', 'a.b', 'exec.start', '$name', '123',
+            '"quoted value"', "'single'", 'true', 'x\\\ny', '"x\\\n  y"' ])
+    def sp():
+        return rnd.choice([ '', ' ', '\n', '  ', '\n  ', ' /* c */ ',
+            ' // line\n', '\n# hash\n' ])
+    def stmt():
+        k = rnd.choice([ 'a', 'b.c', 'exec.prestart', 'persist', 'allow.nomount' ])
+        kind = rnd.randrange(3)
+        if kind == 0:
+            return f'{sp()}{k}{sp()};'
+        values = f'{sp()},{sp()}'.join(word() for _ in range(rnd.randint(1, 4)))
+        op = '=' if kind == 1 else '+='
+        return f'{sp()}{k}{sp()}{op}{sp()}{values}{sp()};'
+    res = [ stmt() for _ in range(rnd.randint(0, 3)) ]
+    for i in range(n_jails):
+        body = ''.join(stmt() for _ in range(rnd.randint(0, 6)))
+        res.append(f'{sp()}jail{i}{sp()}{{{body}{sp()}}}')
+    return ''.join(res) + sp()
+
+
+class TestJailconfParser:
+    def test00_flatten(self):
+        assert flatten([ 1, [ 2, [ 3, [ 4 ] ] ], 'ab', (5, 6) ]) == \
+            [ 1, 2, 3, 4, 'ab', (5, 6) ]
+        assert flatten('abc') == [ 'abc' ]
+        assert flatten([ [ x ] for x in range(10000) ]) == list(range(10000))
+
+    @pytest.mark.parametrize('s', _SAMPLES)
+    def test01_differential(self, s):
+        ref = _reference(s)
+        res = parse(s)
+        assert _tree(res) == _tree(ref)
+        assert str(res) == str(ref)
+        assert str(parse(str(res))) == str(res)
+
+    @pytest.mark.parametrize('s', _INVALID)
+    def test02_invalid(self, s):
+        with pytest.raises(Exception):
+            _reference(s)
+        with pytest.raises(ValueError, match='Syntax error'):
+            parse(s)
+
+    def test03_synthetic(self):
+        rnd = random.Random(1234)
+        for _ in range(50):
+            s = _synthetic(rnd, rnd.randint(0, 5))
+            assert _tree(parse(s)) == _tree(_reference(s)), s
+
+    def test04_loads_load(self, tmp_path):
+        fname = str(tmp_path / 'jail.conf')
+        with open(fname, 'w') as f:
+            f.write(_TXT)
+        conf = jc.load(fname)
+        assert _tree(conf) == _tree(_reference(_TXT))
+        assert conf['sameinjail']['a.d'] == 'ala ma kota'
+        assert jc.loads('a = 1, 2;')['a'] == [ 1, 2 ]
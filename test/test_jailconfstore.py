@@ -0,0 +1,195 @@
+from focker.misc import JailConfStore, \
+    JAILCONF_STORE_CACHE, \
+    jailconf_store, \
+    load_jailconf, \
+    jailconf_add_jail, \
+    jailconf_remove_jail, \
+    jailconf_load_jail, \
+    jailconf_jail_exists, \
+    jailconf_find_by_path, \
+    jailconf_dependents, \
+    jailconf_closure
+import focker.misc.jailconfstore
+import pytest
+import json
+import os
+
+
+def _root(monkeypatch, tmp_path):
+    from focker.core import FOCKER_CONFIG
+    monkeypatch.setattr(FOCKER_CONFIG.zfs, 'root_mountpoint', str(tmp_path))
+    os.makedirs(tmp_path / 'jailconf')
+    return tmp_path / 'jailconf'
+
+
+class TestJailConfStore:
+    def test00_migrate_json_dir(self, monkeypatch, tmp_path):
+        dnam = _root(monkeypatch, tmp_path)
+        with open(dnam / 'foo.json', 'w') as f:
+            json.dump({ 'path': '/jails/foo', 'exec.fib': '1' }, f)
+        with open(dnam / 'bar.json', 'w') as f:
+            json.dump({ 'path': '/jails/bar', 'depend': [ 'foo' ] }, f)
+        conf = load_jailconf()
+        assert conf == {
+            'foo': { 'path': '/jails/foo', 'exec.fib': 1 },
+            'bar': { 'path': '/jails/bar', 'depend': [ 'foo' ] } }
+        assert os.path.exists(dnam / 'jailconf.journal')
+        os.unlink(dnam / 'foo.json')
+        assert jailconf_jail_exists(name='foo')
+        assert jailconf_find_by_path('/jails/bar') == [ 'bar' ]
+        assert jailconf_dependents(name='foo') == [ 'bar' ]
+
+    def test01_add_remove(self, monkeypatch, tmp_path):
+        _root(monkeypatch, tmp_path)
+        jailconf_add_jail(name='foo', entry={ 'path': '/jails/foo',
+            'host.hostname': 'foo', 'persist': 'true' })
+        jailconf_add_jail(name='bar', entry={ 'path': '/jails/bar',
+            'depend': [ 'foo' ] })
+        assert jailconf_load_jail(name='foo') == { 'path': '/jails/foo',
+            'host.hostname': 'foo', 'persist': True }
+        assert jailconf_store().find_by_hostname('foo') == [ 'foo' ]
+        jailconf_add_jail(name='foo', entry={ 'path': '/jails/baz' })
+        assert jailconf_find_by_path('/jails/foo') == []
+        assert jailconf_find_by_path('/jails/baz') == [ 'foo' ]
+        assert jailconf_store().find_by_hostname('foo') == []
+        jailconf_remove_jail(name='bar')
+        assert jailconf_dependents(name='foo') == []
+        assert not jailconf_jail_exists(name='bar')
+        with pytest.raises(KeyError):
+            jailconf_remove_jail(name='bar')
+        with pytest.raises(KeyError):
+            jailconf_load_jail(name='bar')
+        assert list(load_jailconf()) == [ 'foo' ]
+
+    def test02_torn_record(self, tmp_path):
+        fname = str(tmp_path / 'jailconf.journal')
+        store = JailConfStore(fname).create({})
+        store.put('foo', { 'path': '/jails/foo' })
+        with open(fname, 'ab') as f:
+            f.write(b'{"op": "put", "name": "bar", "en')
+        store = JailConfStore(fname).load()
+        assert list(store.entries) == [ 'foo' ]
+        store.put('baz', { 'path': '/jails/baz' })
+        store = JailConfStore(fname).load()
+        assert list(store.entries) == [ 'foo', 'baz' ]
+        assert store.records == 2
+
+    def test03_two_writers(self, tmp_path):
+        fname = str(tmp_path / 'jailconf.journal')
+        store_1 = JailConfStore(fname).create({})
+        store_2 = JailConfStore(fname).load()
+        store_1.put('foo', { 'path': '/jails/foo' })
+        store_2.put('bar', { 'path': '/jails/bar' })
+        assert list(store_2.entries) == [ 'foo', 'bar' ]
+        assert list(JailConfStore(fname).load().entries) == [ 'foo', 'bar' ]
+        store_1.remove('bar')
+        store_1.compact()
+        store_2.put('baz', { 'path': '/jails/baz' })
+        assert list(store_2.entries) == [ 'foo', 'baz' ]
+        with open(fname, 'ab') as f:
+            f.write(b'{"op": "put", "name": "qux", "en')
+        with pytest.raises(KeyError):
+            store_1.remove('bar')
+        store_1.remove('foo')
+        store = JailConfStore(fname).load()
+        assert list(store.entries) == [ 'baz' ]
+        assert store.offset == os.path.getsize(fname)
+
+    def test04_corrupted_record(self, tmp_path):
+        fname = str(tmp_path / 'jailconf.journal')
+        with open(fname, 'w') as f:
+            f.write('garbage\n')
+        with pytest.raises(RuntimeError, match='Corrupted'):
+            JailConfStore(fname).load()
+
+    def test05_compact(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(focker.misc.jailconfstore, 'COMPACT_MIN_RECORDS', 4)
+        fname = str(tmp_path / 'jailconf.journal')
+        store = JailConfStore(fname).create({})
+        for i in range(5):
+            store.put('foo', { 'path': f'/jails/foo{i}' })
+        assert store.records == 1
+        store = JailConfStore(fname).load()
+        assert store.records == 1
+        assert store.find_by_path('/jails/foo4') == [ 'foo' ]
+        assert store.offset == os.path.getsize(fname)
+
+    def test06_cache(self, monkeypatch, tmp_path):
+        dnam = _root(monkeypatch, tmp_path)
+        fname = str(dnam / 'jailconf.journal')
+        monkeypatch.setattr(JAILCONF_STORE_CACHE, 'hits', 0)
+        monkeypatch.setattr(JAILCONF_STORE_CACHE, 'misses', 0)
+        monkeypatch.setattr(JAILCONF_STORE_CACHE, 'tail_reads', 0)
+        jailconf_add_jail(name='foo', entry={ 'path': '/jails/foo' })
+        assert JAILCONF_STORE_CACHE.misses == 0
+        assert load_jailconf() == { 'foo': { 'path': '/jails/foo' } }
+        assert JAILCONF_STORE_CACHE.misses == 1
+        assert jailconf_jail_exists(name='foo')
+        assert jailconf_find_by_path('/jails/foo') == [ 'foo' ]
+        assert JAILCONF_STORE_CACHE.hits == 2
+        JailConfStore(fname).load().put('bar', { 'path': '/jails/bar' })
+        assert jailconf_find_by_path('/jails/bar') == [ 'bar' ]
+        assert JAILCONF_STORE_CACHE.tail_reads == 1
+        assert JAILCONF_STORE_CACHE.misses == 1
+        JailConfStore(fname).load().compact()
+        assert sorted(load_jailconf()) == [ 'bar', 'foo' ]
+        assert JAILCONF_STORE_CACHE.misses == 2
+        assert JAILCONF_STORE_CACHE.tail_reads == 1
+        jailconf_remove_jail(name='foo')
+        assert list(load_jailconf()) == [ 'bar' ]
+        assert JAILCONF_STORE_CACHE.tail_reads == 2
+        assert JAILCONF_STORE_CACHE.misses == 2
+
+    def test07_cache_inode_reuse(self, monkeypatch, tmp_path):
+        dnam = _root(monkeypatch, tmp_path)
+        fname = str(dnam / 'jailconf.journal')
+        monkeypatch.setattr(JAILCONF_STORE_CACHE, 'misses', 0)
+        monkeypatch.setattr(JAILCONF_STORE_CACHE, 'tail_reads', 0)
+        jailconf_add_jail(name='foo', entry={ 'path': '/jails/foo' })
+        assert list(load_jailconf()) == [ 'foo' ]
+        other = str(tmp_path / 'other.journal')
+        JailConfStore(other).create({ 'bar': { 'path': '/jails/bar' },
+            'baz': { 'path': '/jails/baz' * 10 } })
+        with open(other, 'rb') as f:
+            data = f.read()
+        assert len(data) > os.path.getsize(fname)
+        ino = os.stat(fname).st_ino
+        # Same inode, larger size - as if a replaced journal reused it
+        with open(fname, 'r+b') as f:
+            f.write(data)
+        assert os.stat(fname).st_ino == ino
+        assert sorted(load_jailconf()) == [ 'bar', 'baz' ]
+        assert JAILCONF_STORE_CACHE.tail_reads == 0
+        assert JAILCONF_STORE_CACHE.misses == 2
+
+    def test08_render_closure(self, monkeypatch, tmp_path):
+        from focker.core.osjail import OSJail, \
+            osjail
+        from focker.jailconf import JailConf, \
+            JailBlock
+        _root(monkeypatch, tmp_path)
+        jailconf_add_jail(name='db', entry={ 'path': '/jails/db', 'persist': True })
+        jailconf_add_jail(name='app', entry={ 'path': '/jails/app', 'depend': [ 'db' ] })
+        jailconf_add_jail(name='web', entry={ 'path': '/jails/web', 'depend': [ 'app', 'db' ] })
+        jailconf_add_jail(name='other', entry={ 'path': '/jails/other' })
+        assert jailconf_closure(name='web') == [ 'db', 'app', 'web' ]
+        assert jailconf_closure(name='other') == [ 'other' ]
+        calls = []
+        monkeypatch.setattr(osjail, 'focker_subprocess_run',
+            lambda cmd, input, **kwargs: calls.append((cmd, input.decode('utf-8'))))
+        OSJail.from_name('app').start()
+        jc = JailConf()
+        for k in [ 'db', 'app' ]:
+            jc[k] = JailBlock.create(k, jailconf_load_jail(name=k))
+        assert calls == [ ([ 'jail', '-f', '-', '-c', 'app' ], str(jc)) ]
+        store = jailconf_store()
+        assert store.rendered['app'] == str(JailBlock.create('app', store['app']))
+        del store.rendered['app']
+        assert store.reverse_closure('db') == [ 'web', 'app', 'db' ]
+        OSJail.from_name('app').stop()
+        jc['web'] = JailBlock.create('web', jailconf_load_jail(name='web'))
+        assert calls[1] == ([ 'jail', '-f', '-', '-r', 'app' ], str(jc))
+        OSJail.from_name('db').stop()
+        assert calls[2] == ([ 'jail', '-f', '-', '-r', 'db' ], str(jc))
+        OSJail.from_name('web').stop()
+        assert calls[3] == ([ 'jail', '-f', '-', '-r', 'web' ], str(jc))
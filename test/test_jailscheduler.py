@@ -0,0 +1,120 @@
+from focker.core import JailScheduler, \
+    OSJail, \
+    parallel_start_jails, \
+    parallel_stop_jails
+from focker.core.osjail import osjail
+from focker.misc import jailconf_add_jail
+from subprocess import CalledProcessError
+import threading
+import pytest
+import time
+import os
+
+
+DEPEND = {
+    'db': [],
+    'cache': [],
+    'app': [ 'db', 'cache' ],
+    'web': [ 'app' ],
+    'other': [ 'missing' ]
+}
+
+
+def _recorder(delay=0.05, fail=()):
+    lock = threading.Lock()
+    events = []
+    active = [ 0, 0 ]
+    def fn(name):
+        with lock:
+            events.append(('start', name))
+            active[0] += 1
+            active[1] = max(active)
+        time.sleep(delay)
+        with lock:
+            events.append(('end', name))
+            active[0] -= 1
+        if name in fail:
+            raise RuntimeError(f'{name} broke')
+    return fn, events, active
+
+
+class TestJailScheduler:
+    def test00_batches(self):
+        sched = JailScheduler(DEPEND)
+        assert sched.batches() == [ [ 'cache', 'db', 'other' ], [ 'app' ], [ 'web' ] ]
+        assert sched.batches(reverse=True) == [ [ 'other', 'web' ], [ 'app' ], [ 'cache', 'db' ] ]
+
+    def test01_cycle(self):
+        sched = JailScheduler({ 'a': [ 'b' ], 'b': [ 'c' ], 'c': [ 'a' ], 'd': [] })
+        with pytest.raises(ValueError, match='cycle between jails: a, b, c'):
+            sched.batches()
+        with pytest.raises(ValueError, match='cycle'):
+            sched.run(lambda name: None)
+
+    def test02_run(self):
+        fn, events, active = _recorder()
+        results = JailScheduler(DEPEND, jobs=2).run(fn)
+        assert sorted(results) == sorted(DEPEND)
+        assert all(r.status == 'ok' and r.duration > 0 for r in results.values())
+        assert active[1] == 2
+        def pos(ev, name):
+            return events.index((ev, name))
+        assert pos('end', 'db') < pos('start', 'app')
+        assert pos('end', 'cache') < pos('start', 'app')
+        assert pos('end', 'app') < pos('start', 'web')
+
+    def test03_reverse(self):
+        fn, events, _ = _recorder(delay=0.01)
+        JailScheduler(DEPEND).run(fn, reverse=True)
+        assert events.index(('end', 'web')) < events.index(('start', 'app'))
+        assert events.index(('end', 'app')) < events.index(('start', 'db'))
+
+    def test04_failure(self):
+        fn, events, _ = _recorder(delay=0.01, fail=('db',))
+        reported = []
+        results = JailScheduler(DEPEND).run(fn, callback=reported.append)
+        assert results['db'].status == 'failed'
+        assert results['db'].error == 'db broke'
+        assert results['app'].status == 'skipped'
+        assert results['web'].status == 'skipped'
+        assert results['web'].error == 'app skipped'
+        assert results['cache'].status == 'ok'
+        assert ('start', 'app') not in events
+        assert sorted(r.name for r in reported) == sorted(DEPEND)
+
+    def test05_start_stop_jails(self, monkeypatch, tmp_path):
+        from focker.core import FOCKER_CONFIG
+        monkeypatch.setattr(FOCKER_CONFIG.zfs, 'root_mountpoint', str(tmp_path))
+        os.makedirs(tmp_path / 'jailconf')
+        for name, deps in DEPEND.items():
+            jailconf_add_jail(name=name, entry={ 'path': f'/jails/{name}', 'depend': deps })
+        running = set([ 'cache' ])
+        lock = threading.Lock()
+        def fake_run(cmd, input, **kwargs):
+            with lock:
+                if cmd[3] == '-c':
+                    running.add(cmd[4])
+                elif cmd[4] == 'app':
+                    raise CalledProcessError(1, cmd, output=b'jail: app: busy\n')
+                else:
+                    running.discard(cmd[4])
+        monkeypatch.setattr(osjail, 'focker_subprocess_run', fake_run)
+        monkeypatch.setattr(OSJail, 'is_running',
+            property(lambda self: self.name in running))
+        results = parallel_start_jails([ 'web' ])
+        assert sorted(results) == [ 'app', 'cache', 'db', 'web' ]
+        assert results['cache'].status == 'noop'
+        assert results['web'].status == 'ok'
+        assert running == set([ 'app', 'cache', 'db', 'web' ])
+        results = parallel_stop_jails([ 'web', 'app', 'db' ])
+        assert results['web'].status == 'ok'
+        assert results['app'].status == 'failed'
+        assert results['app'].error == 'jail: app: busy'
+        assert results['db'].status == 'skipped'
+        assert running == set([ 'app', 'cache', 'db' ])
+        results = parallel_stop_jails([ 'cache' ])
+        assert sorted(results) == [ 'app', 'cache', 'web' ]
+        assert results['web'].status == 'noop'
+        assert results['app'].status == 'failed'
+        assert results['cache'].status == 'skipped'
+        assert running == set([ 'app', 'cache', 'db' ])
@@ -1,7 +1,9 @@
 from focker.misc.lock import focker_lock, \
     focker_unlock
 from focker.misc import load_jailconf, \
-    backup_file
+    backup_file, \
+    fast_copyfile, \
+    filehash
 from focker.jailconf import JailConf
 from focker.jailconf.classes import Value
 from focker.jailconf.misc import quote_value
@@ -84,3 +86,14 @@ class TestMisc:
             with pytest.raises(RuntimeError, match='expected to be None'):
                 with focker_lock():
                     pass
+
+    def test09_fast_copyfile(self, monkeypatch):
+        with tempfile.TemporaryDirectory() as d:
+            src = os.path.join(d, 'src')
+            with open(src, 'wb') as f:
+                f.write(os.urandom(5 * 1024 * 1024 + 17))
+            fast_copyfile(src, os.path.join(d, 'dst'))
+            assert filehash(os.path.join(d, 'dst')) == filehash(src)
+            monkeypatch.delattr(os, 'copy_file_range', raising=False)
+            fast_copyfile(src, os.path.join(d, 'dst_2'))
+            assert filehash(os.path.join(d, 'dst_2')) == filehash(src)
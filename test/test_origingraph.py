@@ -0,0 +1,123 @@
+from focker.core import OriginGraph, \
+    Image, \
+    JailFs, \
+    zfs_exists, \
+    zfs_protect
+import pytest
+from common import stub_focker_zfs
+
+
+class TestOriginGraph:
+    def test00_graph(self):
+        g = OriginGraph()
+        g.add('a', 'image', tags=[ 'base' ])
+        g.add('b', 'image', 'a', [ '-' ])
+        g.add('c', 'image', 'b')
+        g.add('d', 'image', 'b')
+        g.add('j', 'jail', 'd')
+        assert g.refcount('b') == 2
+        assert g.in_use('d')
+        assert not g.in_use('c')
+        assert sorted(g.unused('image')) == [ 'c' ]
+        assert g.prune_order('image') == [ 'c' ]
+        g.remove('j')
+        assert g.prune_order('image') == [ 'c', 'd', 'b' ]
+        assert g.prune_batches('image') == [ [ 'c', 'd' ], [ 'b' ] ]
+        g.remove('c')
+        assert g.refcount('b') == 1
+
+    def test01_prune(self, monkeypatch):
+        with stub_focker_zfs(monkeypatch) as be:
+            base = Image.create()
+            base.add_tags([ 'base' ])
+            base.finalize()
+            ims = [ base ]
+            for _ in range(5):
+                ims.append(Image.clone_from(ims[-1]))
+                ims[-1].finalize()
+            side = Image.clone_from(ims[2])
+            side.finalize()
+            jail_base = Image.clone_from(ims[3])
+            jail_base.finalize()
+            jfs = JailFs.clone_from(jail_base)
+            be.commands.clear()
+            assert [ im.name for im in Image.list_unused() ] == \
+                sorted([ ims[-1].name, side.name ])
+            assert len(be.commands) == 1
+            be.commands.clear()
+            assert jail_base.in_use()
+            assert not side.in_use()
+            assert len(be.commands) == 2
+            be.commands.clear()
+            destroyed = []
+            Image.prune(max_workers=3, progress=lambda name, used: destroyed.append(name))
+            assert sorted(destroyed) == sorted([ im.name for im in ims[4:] ] + [ side.name ])
+            assert [ c[1] for c in be.commands ] == [ 'list' ] + \
+                [ 'get', 'destroy', 'destroy' ] + [ 'get', 'destroy' ]
+            assert all(zfs_exists(im.name) for im in ims[:4])
+            assert not any(zfs_exists(im.name) for im in ims[4:])
+            assert not zfs_exists(side.name)
+            assert zfs_exists(jail_base.name)
+            assert zfs_exists(jfs.name)
+
+    def test02_prune_protected(self, monkeypatch):
+        with stub_focker_zfs(monkeypatch) as be:
+            base = Image.create()
+            base.add_tags([ 'base' ])
+            base.finalize()
+            im_1 = Image.clone_from(base)
+            im_2 = Image.clone_from(base)
+            zfs_protect(im_2.name)
+            graph = OriginGraph.from_zfs()
+            assert graph.protected == set([ im_2.name ])
+            assert graph.prune_order() == [ im_1.name ]
+            assert graph.evict_order() == [ im_1.name ]
+            Image.prune()
+            assert not zfs_exists(im_1.name)
+            assert zfs_exists(im_2.name)
+            im_3 = Image.clone_from(base)
+            graph = OriginGraph.from_zfs()
+            zfs_protect(im_3.name)
+            with pytest.raises(RuntimeError, match='protected'):
+                Image.prune(graph)
+            assert zfs_exists(im_3.name)
+
+    def test03_evict_order(self):
+        g = OriginGraph()
+        g.add('a', 'image', tags=[ 'base' ], used=100, last_used=1)
+        g.add('b', 'image', 'a', used=10, last_used=5)
+        g.add('c', 'image', 'b', used=10, last_used=2)
+        g.add('d', 'image', 'b', used=10, last_used=3)
+        g.add('e', 'image', 'a', used=10, last_used=4)
+        g.add('f', 'image', 'a', used=10, last_used=0, protected=True)
+        assert g.evict_order('image', max_size=135) == [ 'c', 'd' ]
+        assert g.evict_order('image', max_size=110) == [ 'c', 'd', 'e', 'b' ]
+        assert g.evict_order('image', max_size=1000) == []
+        assert g.evict_order('image', keep_recent=2) == [ 'c', 'd' ]
+        assert g.batches([ 'c', 'd', 'e', 'b' ]) == [ [ 'c', 'd', 'e' ], [ 'b' ] ]
+
+    def test04_prune_lru(self, monkeypatch):
+        with stub_focker_zfs(monkeypatch) as be:
+            base = Image.create()
+            base.add_tags([ 'base' ])
+            base.finalize()
+            old = Image.clone_from(base)
+            new = Image.clone_from(base)
+            assert base.last_used is not None
+            assert new.last_used is None
+            new.touch()
+            Image.prune(keep_recent=1)
+            assert not zfs_exists(old.name)
+            assert zfs_exists(new.name)
+            assert zfs_exists(base.name)
+
+    def test05_keep_recent_untagged(self):
+        g = OriginGraph()
+        g.add('a', 'image', tags=[ 'base' ], last_used=10)
+        g.add('b', 'image', 'a', tags=[ 'tagged' ], last_used=9)
+        g.add('c', 'image', 'a', protected=True, last_used=8)
+        g.add('d', 'image', 'a', last_used=7)
+        g.add('e', 'image', 'a', last_used=6)
+        g.add('f', 'image', 'a', last_used=5)
+        assert g.evict_order('image', keep_recent=2) == [ 'f' ]
+        assert g.evict_order('image', keep_recent=0) == [ 'f', 'e', 'd' ]
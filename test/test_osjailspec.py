@@ -56,3 +56,10 @@ class TestOSJailSpec:
         assert 'command' not in ospec.params
         assert 'exec.start' in ospec.params
         assert ospec.params['exec.start'] == 'ls -al'
+
+    def test10_scratch(self):
+        spec = JailSpec.from_dict({ 'name': 'focker_unit_test_osjailspec',
+            'path': '/tmp', 'scratch': [ '/tmp', '/var/tmp' ] })
+        ospec = OSJailSpec.from_jailspec(spec)
+        assert 'mount -t tmpfs tmpfs /tmp/var/tmp' in ospec.params['exec.prestart']
+        assert 'umount -f /tmp/var/tmp && umount -f /tmp/tmp' in ospec.params['exec.poststop']
@@ -0,0 +1,29 @@
+from focker.core import PrefixIndex
+import pytest
+
+
+class TestPrefixIndex:
+    def test00_find_prefix(self):
+        index = PrefixIndex([ ('abc1', 1), ('abd', 2), ('ab', 3), ('b', 4) ])
+        assert index.find_prefix('ab') == [ ('ab', 3), ('abc1', 1), ('abd', 2) ]
+        assert index.find_prefix('abc') == [ ('abc1', 1) ]
+        assert index.find_prefix('c') == []
+        assert 'abd' in index
+        assert 'abc' not in index
+
+    def test01_add_remove(self):
+        index = PrefixIndex.from_keys([ 'b', 'a' ])
+        index.add('ab')
+        assert index.keys == [ 'a', 'ab', 'b' ]
+        index.remove('a')
+        assert index.keys == [ 'ab', 'b' ]
+        with pytest.raises(KeyError):
+            index.remove('a')
+
+    def test02_shortest_unique(self):
+        index = PrefixIndex.from_keys([ '1234567', '1234567a', '1234567ab' ])
+        assert index.shortest_unique('1234567abc') == '1234567abc'
+        assert index.shortest_unique('1234567b00') == '1234567b'
+        assert index.shortest_unique('7654321000') == '7654321'
+        index.add('1234567abc')
+        assert index.shortest_unique('1234567abc') == '1234567abc'
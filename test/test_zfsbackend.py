@@ -0,0 +1,146 @@
+from focker.core import StubZfsBackend, \
+    ZfsBatch, \
+    zfs_backend, \
+    zfs_exists, \
+    zfs_tag, \
+    zfs_untag, \
+    zfs_set_props, \
+    zfs_get_property, \
+    zfs_list, \
+    Image, \
+    Volume, \
+    CalledProcessError
+from common import stub_focker_zfs
+import pytest
+
+
+class TestStubZfsBackend:
+    def test00_context(self):
+        default = zfs_backend()
+        with StubZfsBackend() as be:
+            assert zfs_backend() is be
+        assert zfs_backend() is default
+
+    def test01_create_list_destroy(self):
+        with StubZfsBackend() as be:
+            be.run([ 'zfs', 'create', '-o', 'focker:sha256=abc', 'zroot/a' ])
+            assert zfs_exists('zroot/a')
+            assert not zfs_exists('zroot/b')
+            res = be.parse_output([ 'zfs', 'list', '-H', '-o', 'name,mountpoint,focker:sha256', '-r', 'zroot' ])
+            assert res == [ [ 'zroot', '/zroot', '-' ], [ 'zroot/a', '/zroot/a', 'abc' ] ]
+            be.run([ 'zfs', 'destroy', '-r', '-f', 'zroot/a' ])
+            assert not zfs_exists('zroot/a')
+
+    def test02_clone_snapshot_inherit(self):
+        with StubZfsBackend() as be:
+            be.run([ 'zfs', 'create', '-o', 'focker:tags=x', 'zroot/a' ])
+            be.run([ 'zfs', 'snapshot', 'zroot/a@1' ])
+            be.run([ 'zfs', 'clone', '-o', 'focker:sha256=def', 'zroot/a@1', 'zroot/b' ])
+            assert zfs_get_property('zroot/b', 'origin') == 'zroot/a@1'
+            assert zfs_get_property('zroot/a@1', 'focker:tags') == 'x'
+            with pytest.raises(CalledProcessError) as excinfo:
+                be.run([ 'zfs', 'destroy', 'zroot/a' ])
+            assert b'filesystem has children' in excinfo.value.output
+            be.run([ 'zfs', 'inherit', 'focker:tags', 'zroot/a' ])
+            assert zfs_get_property('zroot/a', 'focker:tags') == '-'
+
+
+class TestZfsBatch:
+    def test00_coalesce_set(self):
+        with StubZfsBackend() as be:
+            be.run([ 'zfs', 'create', 'zroot/a' ])
+            be.commands.clear()
+            with ZfsBatch() as batch:
+                batch.set_props('zroot/a', { 'focker:x': '1' })
+                batch.set_props('zroot/a', { 'focker:y': '2', 'rdonly': 'on' })
+            assert be.commands == [ [ 'zfs', 'set', 'focker:x=1', 'focker:y=2', 'rdonly=on', 'zroot/a' ] ]
+            assert zfs_get_property('zroot/a', 'rdonly') == 'on'
+
+    def test01_coalesce_snapshot(self):
+        with StubZfsBackend() as be:
+            be.run([ 'zfs', 'create', 'zroot/a' ])
+            be.run([ 'zfs', 'create', 'zroot/b' ])
+            be.commands.clear()
+            with ZfsBatch() as batch:
+                batch.snapshot('zroot/a@s')
+                batch.set_props('zroot/b', { 'focker:x': '1' })
+                batch.snapshot('zroot/b@s')
+                batch.inherit('zroot/a', 'focker:tags')
+                batch.inherit('zroot/b', 'focker:tags')
+            assert be.commands == [
+                [ 'zfs', 'snapshot', 'zroot/a@s' ],
+                [ 'zfs', 'set', 'focker:x=1', 'zroot/b' ],
+                [ 'zfs', 'snapshot', 'zroot/b@s' ],
+                [ 'zfs', 'inherit', 'focker:tags', 'zroot/a', 'zroot/b' ]
+            ]
+
+    def test02_reorder_disjoint(self):
+        batch = ZfsBatch()
+        batch.snapshot('zroot/a@s')
+        batch.set_props('zroot/c', { 'focker:x': '1' })
+        batch.snapshot('zroot/b@s')
+        assert batch.commands() == [
+            [ 'zfs', 'snapshot', 'zroot/a@s', 'zroot/b@s' ],
+            [ 'zfs', 'set', 'focker:x=1', 'zroot/c' ]
+        ]
+
+    def test03_discard_on_error(self):
+        with StubZfsBackend() as be:
+            with pytest.raises(RuntimeError):
+                with ZfsBatch() as batch:
+                    batch.snapshot('zroot@s')
+                    raise RuntimeError
+            assert be.commands == []
+
+
+class TestZfsHelpersStub:
+    def test00_set_props_single_call(self, monkeypatch):
+        with stub_focker_zfs(monkeypatch) as be:
+            v = Volume.create()
+            be.commands.clear()
+            zfs_set_props(v.name, { 'focker:a': '1', 'focker:b': '2' })
+            assert len(be.commands) == 1
+
+    def test01_tag_untag(self, monkeypatch):
+        with stub_focker_zfs(monkeypatch) as be:
+            v_1 = Volume.create()
+            v_2 = Volume.create()
+            zfs_tag(v_1.name, [ 'a', 'b' ])
+            zfs_tag(v_2.name, [ 'a' ])
+            be.commands.clear()
+            zfs_untag([ 'a' ], focker_type='volume')
+            assert len(be.commands) == 3
+            assert v_1.tags == { 'b' }
+            assert v_2.tags == set()
+
+    def test02_clone_finalize(self, monkeypatch):
+        with stub_focker_zfs(monkeypatch) as be:
+            base = Image.create()
+            base.finalize()
+            im = Image.clone_from(base)
+            assert im.mountpoint == f'/focker/images/{im.name.split("/")[-1]}'
+            im.finalize()
+            assert im.is_finalized
+            assert zfs_get_property(im.name, 'origin') == base.snapshot_name
+            lst = zfs_list([ 'name' ], focker_type='image')
+            assert sorted(r[0] for r in lst) == sorted([ base.name, im.name ])
+
+    def test03_unique_names(self, monkeypatch):
+        with stub_focker_zfs(monkeypatch) as be:
+            im_1 = Image.create(sha256='1234567xxx')
+            im_2 = Image.create(sha256='1234567xyy')
+            be.commands.clear()
+            im_3 = Image.create(sha256='1234567xyz')
+            assert [ c[1] for c in be.commands ] == [ 'list', 'create', 'list' ]
+            assert im_1.name == 'zroot/focker/images/1234567'
+            assert im_2.name == 'zroot/focker/images/1234567x'
+            assert im_3.name == 'zroot/focker/images/1234567xy'
+            with pytest.raises(RuntimeError, match='already exists'):
+                _ = Image.create(sha256='1234567xyz')
+            be.commands.clear()
+            assert Image.from_partial_sha256('1234567xx').name == im_1.name
+            assert len(be.commands) == 1
+            with pytest.raises(RuntimeError, match='Ambiguous'):
+                _ = Image.from_partial_sha256('1234567xy')
+            with pytest.raises(RuntimeError, match='not found'):
+                _ = Image.from_partial_sha256('7654321')
@@ -0,0 +1,126 @@
+from focker.core import ChannelProgramZfsBackend, \
+    Image, \
+    Volume, \
+    ZfsPropertyCache, \
+    zfs_get_property, \
+    zfs_program, \
+    zfs_nicenum
+from focker.core.zfsprogram import PROBE_UNIQUE_NAME, \
+    TAGS, \
+    PROPERTIES
+from common import stub_focker_zfs
+from subprocess import CalledProcessError
+import importlib.util
+import pytest
+
+
+requires_lupa = pytest.mark.skipif(importlib.util.find_spec('lupa') is None,
+    reason='running channel programs requires lupa')
+
+
+class TestChannelProgramZfsBackend:
+    @requires_lupa
+    def test00_probe_readonly(self, monkeypatch):
+        with stub_focker_zfs(monkeypatch, ChannelProgramZfsBackend) as be:
+            res = zfs_program('zroot', PROBE_UNIQUE_NAME,
+                [ 'zroot/focker/images', '1234567xxx', '7' ], readonly=True)
+            assert res == { 'name': 'zroot/focker/images/1234567',
+                'mountpoint': '/focker/images/1234567' }
+            assert be.commands[0][:4] == [ 'zfs', 'program', '-j', '-n' ]
+
+    @requires_lupa
+    def test01_create_clone(self, monkeypatch):
+        with stub_focker_zfs(monkeypatch, ChannelProgramZfsBackend) as be:
+            base = Image.create(sha256='1234567xxx')
+            assert len(be.commands) == 2
+            assert base.name == 'zroot/focker/images/1234567'
+            assert base.mountpoint == '/focker/images/1234567'
+            base.finalize()
+            be.commands.clear()
+            im = Image.clone_from(base, sha256='1234567yyy')
+            assert [ c[1] for c in be.commands ] == [ 'get', 'program', 'clone', 'set' ]
+            assert im.name == 'zroot/focker/images/1234567y'
+            assert zfs_get_property(im.name, 'origin') == base.snapshot_name
+            with pytest.raises(RuntimeError, match='already exists'):
+                _ = Image.clone_from(base, sha256='1234567yyy')
+
+    @requires_lupa
+    def test02_tags(self, monkeypatch):
+        with stub_focker_zfs(monkeypatch, ChannelProgramZfsBackend) as be:
+            v_1 = Volume.create()
+            v_2 = Volume.create()
+            v_1.add_tags([ 'a', 'b' ])
+            be.commands.clear()
+            v_2.add_tags([ 'b', 'c' ])
+            assert len(be.commands) == 1
+            assert v_1.tags == { 'a' }
+            assert v_2.tags == { 'b', 'c' }
+            Volume.untag([ 'a', 'c' ])
+            assert v_1.tags == set()
+            assert v_2.tags == { 'b' }
+            with pytest.raises(ValueError, match='spaces'):
+                v_1.add_tags([ 'x y' ])
+
+    @requires_lupa
+    def test03_properties_cache(self, monkeypatch):
+        with stub_focker_zfs(monkeypatch, ChannelProgramZfsBackend) as be:
+            base = Image.create(sha256='1234567xxx')
+            base.add_tags([ 'base' ])
+            base.finalize()
+            im = Image.clone_from(base, sha256='1234567yyy')
+            v = Volume.create()
+            be.commands.clear()
+            with ZfsPropertyCache(focker_type=['image', 'volume']) as zc:
+                assert len(be.commands) == 1
+                assert be.commands[0][:4] == [ 'zfs', 'program', '-j', '-n' ]
+                assert im.name in zc and v.name in zc
+                assert base.snapshot_name in zc
+                assert zc[im.name]['origin'] == base.snapshot_name
+                assert zc[base.name]['rdonly'] == 'on'
+                assert zc[base.name]['focker:tags'] == 'base'
+                assert zc[base.name]['used'] == '0B'
+                assert zc[base.snapshot_name]['focker:sha256'] == '1234567xxx'
+                assert zc.get_property(v.name, 'mountpoint') == v.mountpoint
+                assert zc.get_property(v.name, 'origin') == '-'
+                assert 'canmount' not in zc[v.name]
+                assert im.is_finalized == False
+                assert base.is_finalized == True
+                assert base.tags == { 'base' }
+                assert len(be.commands) == 1
+
+    def test04_nicenum(self):
+        assert zfs_nicenum(0) == '0B'
+        assert zfs_nicenum(512) == '512B'
+        assert zfs_nicenum(96 * 1024) == '96K'
+        assert zfs_nicenum(1536 * 1024) == '1.50M'
+        assert zfs_nicenum(int(12.34 * 1024 ** 3)) == '12.3G'
+        assert zfs_nicenum(int(123.4 * 1024 ** 3)) == '123G'
+
+    @requires_lupa
+    def test05_lua_errors(self, monkeypatch):
+        with stub_focker_zfs(monkeypatch, ChannelProgramZfsBackend) as be:
+            v = Volume.create()
+            with pytest.raises(CalledProcessError) as excinfo:
+                zfs_program('zroot', 'return { x = ')
+            assert b'Channel program execution failed' in excinfo.value.output
+            with pytest.raises(CalledProcessError) as excinfo:
+                zfs_program('zroot', TAGS, [ 'zroot/focker/volumes', v.name, 'a' ],
+                    readonly=True)
+            assert b'Read-only channel program' in excinfo.value.output
+            with pytest.raises(CalledProcessError) as excinfo:
+                zfs_program('zroot', 'error("broken")')
+            assert b'broken' in excinfo.value.output
+            assert v.tags == set()
+
+    @requires_lupa
+    def test06_lua_results(self, monkeypatch):
+        with stub_focker_zfs(monkeypatch, ChannelProgramZfsBackend) as be:
+            v = Volume.create(sha256='1234567xxx')
+            res = zfs_program('zroot', PROBE_UNIQUE_NAME,
+                [ 'zroot/focker/volumes', '1234567xxx', '7' ], readonly=True)
+            assert res == { 'exists': v.name }
+            res = zfs_program('zroot', TAGS, [ 'zroot/focker/volumes', v.name, 'a', 'b', 'a' ])
+            assert res == { 'tags': 'a b' }
+            res = zfs_program('zroot', PROPERTIES, [ v.name ], readonly=True)
+            assert res[v.name]['focker:tags'] == 'a b'
+            assert res[v.name]['used'] == 0